@@ -0,0 +1,147 @@
+""" Pipelined asyncio DHT client. """
+import asyncio
+import itertools
+import logging
+from utils import dht_hash, ring_size, M_BITS
+from codec import encode, fragment, Reassembler, CodecError
+
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+    """Hands every datagram received on the client socket to the client."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client.reply_received(data, addr)
+
+    def error_received(self, exc):
+        self.client.logger.error("Socket error: %s", exc)
+
+
+class AsyncDHTClient:
+    """DHT client with many PUT/GET in flight over a single UDP socket.
+
+    Every request carries a request_id that the owning node echoes in its
+    ACK/NACK, so replies are matched to the request that caused them no matter
+    which node answers or in which order they arrive.
+    """
+
+    def __init__(self, address, m_bits=M_BITS, timeout=1.0, retries=3, max_in_flight=4096):
+        """ Initialize client.
+
+        Parameters:
+            address: address of a node in the DHT
+            m_bits: identifier size of the ring behind address
+            timeout: seconds to wait for a reply before sending the request again
+            retries: extra attempts before giving up with asyncio.TimeoutError
+            max_in_flight: maximum number of requests awaiting a reply
+        """
+        self.dht_addr = address
+        self.m_bits = m_bits
+        self.maximum = ring_size(m_bits)
+        self.timeout = timeout
+        self.retries = retries
+        self.max_in_flight = max_in_flight
+        self.request_ids = itertools.count(1)
+        self.pending = {}  # request_id -> future with the reply
+        self.msg_ids = itertools.count()
+        self.reassembler = Reassembler()
+        self.transport = None
+        self.window = None
+        self.logger = logging.getLogger("AsyncDHTClient")
+
+    async def connect(self):
+        """ Open the UDP socket (any node may answer, so it is not connected)."""
+        loop = asyncio.get_running_loop()
+        self.window = asyncio.Semaphore(self.max_in_flight)
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _ClientProtocol(self), local_addr=("0.0.0.0", 0))
+        return self
+
+    def close(self):
+        """ Close the socket and fail every request still waiting."""
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        for future in self.pending.values():
+            if not future.done():
+                future.cancel()
+        self.pending.clear()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def key_id(self, key):
+        """ Identifier of key in the ring (same hash the nodes use)."""
+        return dht_hash(key, maximum=self.maximum)
+
+    def reply_received(self, data, addr):
+        """ Resolve the request a reply belongs to; unknown or late replies are dropped."""
+        try:
+            out = self.reassembler.feed(data, addr)
+            if out is None:
+                return  # more fragments to come
+            future = self.pending.pop(out["request_id"], None)
+        except (CodecError, KeyError, TypeError) as err:
+            self.logger.error("Invalid msg from %s: %s", addr, err)
+            return
+        if future is None:
+            self.logger.debug("Discarding stale reply: %s", out)
+        elif not future.done():
+            future.set_result(out)
+
+    async def request(self, method, args):
+        """ Send method with args and return the reply, retrying on timeout.
+
+        A retry reuses the request id, so a slow reply to an earlier attempt
+        still completes the request. Note that a PUT whose first attempt was
+        stored but whose ACK was lost is answered NACK on retry.
+        """
+        async with self.window:
+            request_id = next(self.request_ids)
+            args = dict(args, request_id=request_id)
+            datagrams = fragment(encode({"method": method, "args": args}), next(self.msg_ids))
+            future = asyncio.get_running_loop().create_future()
+            self.pending[request_id] = future
+            try:
+                for attempt in range(self.retries + 1):
+                    for datagram in datagrams:
+                        self.transport.sendto(datagram, self.dht_addr)
+                    try:
+                        return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+                    except asyncio.TimeoutError:
+                        self.logger.debug("Request %d timed out (attempt %d)", request_id, attempt + 1)
+                raise asyncio.TimeoutError("no reply to {} {}".format(method, request_id))
+            finally:
+                self.pending.pop(request_id, None)
+
+    async def put(self, key, value):
+        """ Store value to key in the DHT."""
+        out = await self.request("PUT", {"key": key, "value": value})
+        if out["method"] != "ACK":
+            self.logger.error("Invalid msg: %s", out)
+            return False
+        return True
+
+    async def get(self, key):
+        """ Retrieve key from DHT."""
+        out = await self.request("GET", {"key": key})
+        if out["method"] != "ACK":
+            self.logger.error("Invalid msg: %s", out)
+            return None
+        return out["args"]
+
+
+async def main():
+    async with AsyncDHTClient(("localhost", 5000)) as client:
+        # all requests are in flight at the same time
+        print(await asyncio.gather(*(client.put(str(i), i) for i in range(10))))
+        print(await asyncio.gather(*(client.get(str(i)) for i in range(10))))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
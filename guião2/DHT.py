@@ -2,18 +2,33 @@ import logging
 import time
 import sys
 import argparse
+import os
 from DHTNode import DHTNode
+from utils import M_BITS, load_imbalance
+from storage import LogStore
 
 
-def main(number_nodes, timeout):
+def main(number_nodes, timeout, m_bits=M_BITS, replicas=0, write_quorum=1, read_quorum=1, data_dir=None,
+         workers=0, vnodes=1, log_every=100, successors=3, cache=0, cache_ttl=10):
     """ Script to launch several DHT nodes. """
 
     # logger for the main
     logger = logging.getLogger("DHT")
     # list with all the nodes
     dht = []
+    # settings shared by every node
+    settings = {"replicas": replicas, "write_quorum": write_quorum, "read_quorum": read_quorum,
+                "workers": workers, "vnodes": vnodes, "log_every": log_every,
+                "successors": successors, "cache": cache, "cache_ttl": cache_ttl}
+
+    def keystore(port):
+        """ Each node logs to its own directory, so a restart finds its keys again. """
+        if data_dir is None:
+            return None
+        return LogStore(os.path.join(data_dir, str(port)))
+
     # initial node on DHT
-    node = DHTNode(("localhost", 5000))
+    node = DHTNode(("localhost", 5000), m_bits=m_bits, keystore=keystore(5000), **settings)
     node.start()
     dht.append(node)
     logger.info(node)
@@ -21,7 +36,8 @@ def main(number_nodes, timeout):
     for i in range(number_nodes - 1):
         time.sleep(0.2)
         # Create DHT_Node threads on ports 5001++ and with initial DHT_Node on port 5000
-        node = DHTNode(("localhost", 5001 + i), ("localhost", 5000), timeout)
+        node = DHTNode(("localhost", 5001 + i), ("localhost", 5000), timeout, m_bits,
+                       keystore=keystore(5001 + i), **settings)
         node.start()
         dht.append(node)
         logger.info(node)
@@ -29,6 +45,12 @@ def main(number_nodes, timeout):
     # Await for DHT to get stable
     time.sleep(10)
 
+    # share of the ring each node owns; the imbalance shows whether more vnodes are needed
+    shares = [node.ring_share() for node in dht]
+    for node, share in zip(dht, shares):
+        logger.info("Node %d (%d ids) owns %.1f%% of the ring", node.identification, len(node.vnodes), share * 100)
+    logger.info("Load imbalance (max / mean share): %.2f", load_imbalance(shares))
+
     # Await for all nodes to stop
     for node in dht:
         node.join()
@@ -41,6 +63,17 @@ if __name__ == "__main__":
     parser.add_argument("--savelog", default=False, action="store_true")
     parser.add_argument("--nodes", type=int, default=5)
     parser.add_argument("--timeout", type=int, default=3)
+    parser.add_argument("--bits", type=int, default=M_BITS)
+    parser.add_argument("--replicas", type=int, default=0)
+    parser.add_argument("--write-quorum", type=int, default=1)
+    parser.add_argument("--read-quorum", type=int, default=1)
+    parser.add_argument("--data-dir", default=None, help="persist keys (one log per node) under this directory")
+    parser.add_argument("--workers", type=int, default=0, help="threads per node handling PUT/GET")
+    parser.add_argument("--vnodes", type=int, default=1, help="ids (virtual nodes) per node in the ring")
+    parser.add_argument("--successors", type=int, default=3, help="successors each node can fall back on")
+    parser.add_argument("--cache", type=int, default=0, help="values of hot keys each node caches (0: none)")
+    parser.add_argument("--cache-ttl", type=float, default=10, help="seconds a cached value is served for")
+    parser.add_argument("--log-every", type=int, default=100, help="log one received message in this many (0: none)")
     args = parser.parse_args()
 
     logfile = {}
@@ -55,4 +88,7 @@ if __name__ == "__main__":
         )
 
 
-    main(args.nodes, timeout=args.timeout)
+    main(args.nodes, timeout=args.timeout, m_bits=args.bits, replicas=args.replicas,
+         write_quorum=args.write_quorum, read_quorum=args.read_quorum, data_dir=args.data_dir,
+         workers=args.workers, vnodes=args.vnodes, log_every=args.log_every, successors=args.successors,
+         cache=args.cache, cache_ttl=args.cache_ttl)
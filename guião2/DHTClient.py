@@ -1,22 +1,185 @@
 import socket
-import pickle
+import itertools
 import logging
+from bisect import bisect_left, insort
+from utils import dht_hash, contains, ring_size, M_BITS, DATAGRAM_SIZE
+from codec import encode, fragment, pack_batch, Reassembler, CodecError
+
+
+class RingCache:
+    """Nodes of the ring a client has heard of, sorted by id.
+
+    Each node is kept with the range ]predecessor_id, id] it owns, as given
+    in the "owner" field of replies. A node whose range is contradicted by
+    newer information is dropped.
+    """
+
+    def __init__(self):
+        self.ids = []  # sorted node ids
+        self.nodes = {}  # id -> (addr, predecessor_id)
+
+    def learn(self, node_id, addr, predecessor_id):
+        """Add a node, dropping the ones that overlap its range."""
+        if predecessor_id is None:
+            return  # not stabilized yet, its range is unknown
+        for other in list(self.ids):
+            if other == node_id:
+                continue
+            other_predecessor = self.nodes[other][1]
+            # other sits inside the new range, or the new node inside other's
+            if (predecessor_id == node_id or contains(predecessor_id, node_id, other)
+                    or other_predecessor == other or contains(other_predecessor, other, node_id)):
+                self.forget(other)
+        if node_id not in self.nodes:
+            insort(self.ids, node_id)
+        self.nodes[node_id] = (addr, predecessor_id)
+
+    def forget(self, node_id):
+        if self.nodes.pop(node_id, None) is not None:
+            self.ids.remove(node_id)
+
+    def lookup(self, key_hash):
+        """(id, addr) of the cached node owning key_hash, None if unknown."""
+        if not self.ids:
+            return None
+        node_id = self.ids[bisect_left(self.ids, key_hash) % len(self.ids)]
+        addr, predecessor_id = self.nodes[node_id]
+        # a node that is its own predecessor is alone and owns everything
+        if predecessor_id == node_id or contains(predecessor_id, node_id, key_hash):
+            return node_id, addr
+        return None
+
+    def __len__(self):
+        return len(self.ids)
 
 
 class DHTClient:
-    def __init__(self, address):
-        """ Initialize client."""
+    def __init__(self, address, m_bits=M_BITS, timeout=1.0, retries=2):
+        """ Initialize client.
+
+        m_bits must match the identifier size of the ring behind address.
+        Requests for keys whose owner is cached go straight to it; if it does
+        not answer within timeout seconds the request is sent to address.
+        A request lost there (e.g. forwarded to a node that crashed) is sent
+        again up to retries times, timeout seconds apart, before giving up:
+        put() then returns False and get() None. A repeated PUT that did get
+        through the first time is answered NACK, as the key exists.
+        """
         self.dht_addr = address
+        self.m_bits = m_bits
+        self.maximum = ring_size(m_bits)
+        self.timeout = timeout
+        self.retries = retries
+        self.ring = RingCache()
+        self.request_id = 0
+        self.msg_ids = itertools.count()
+        self.reassembler = Reassembler()
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.logger = logging.getLogger("DHTClient")
 
+    def key_id(self, key):
+        """ Identifier of key in the ring (same hash the nodes use)."""
+        return dht_hash(key, maximum=self.maximum)
+
+    def send(self, payload, address=None):
+        """ Send an encoded message to address (the DHT entry node by default), in fragments if needed."""
+        for datagram in fragment(payload, next(self.msg_ids)):
+            self.socket.sendto(datagram, self.dht_addr if address is None else address)
+
+    def receive(self):
+        """ Block until a whole message arrives and return it."""
+        while True:
+            datagram, addr = self.socket.recvfrom(DATAGRAM_SIZE)
+            try:
+                out = self.reassembler.feed(datagram, addr)
+            except CodecError as err:
+                self.logger.error("Invalid datagram from %s: %s", addr, err)
+                continue
+            if out is not None:
+                return out
+
+    def wait_reply(self, timeout=None):
+        """ Reply to the current request, None if timeout seconds pass first.
+
+        Replies to earlier requests (e.g. late ones) are discarded instead of
+        being taken as the answer to this one.
+        """
+        self.socket.settimeout(timeout)
+        try:
+            while True:
+                out = self.receive()
+                if out.get("request_id", self.request_id) == self.request_id:
+                    return out
+                self.logger.debug("Discarding stale reply: %s", out)
+        except socket.timeout:
+            return None
+        finally:
+            self.socket.settimeout(None)
+
+    def ask(self, payload, address=None):
+        """ Send payload to address (the DHT entry node by default) until it is answered.
+
+        Returns the reply, None if retries + 1 attempts went unanswered.
+        """
+        for _ in range(self.retries + 1):
+            self.send(payload, address)
+            out = self.wait_reply(self.timeout)
+            if out is not None:
+                return out
+        self.logger.error("No reply from %s", self.dht_addr if address is None else address)
+        return None
+
+    def learn(self, out, target=None):
+        """ Update the ring cache from the owner field of a reply.
+
+        target is the cached (id, addr) the request was sent to; if someone
+        else owns the key that entry is stale.
+        """
+        owner = out.get("owner")
+        if target is not None and (not owner or owner["id"] != target[0]):
+            self.logger.debug("Node %d no longer owns the key, forgetting it", target[0])
+            self.ring.forget(target[0])
+        if owner:
+            self.ring.learn(owner["id"], owner["addr"], owner["predecessor_id"])
+
+    def request(self, msg, key=None, key_hash=None):
+        """ Send msg tagged with a fresh request id and wait for its reply.
+
+        With a key (or the ring position key_hash) whose owner is in the ring
+        cache the request goes straight to it (one hop) and falls back to the
+        entry node if it is silent.
+        """
+        self.request_id += 1
+        msg["args"]["request_id"] = self.request_id
+        payload = encode(msg)
+
+        if key is not None:
+            key_hash = self.key_id(key)
+        target = None if key_hash is None else self.ring.lookup(key_hash)
+        if target is not None:
+            address = target[1]
+            if len(address) > 2:
+                # a virtual node: its host's socket, told which of its nodes it is for
+                self.send(encode(dict(msg, vnode=address[2])), address[:2])
+            else:
+                self.send(payload, address)
+            out = self.wait_reply(self.timeout)
+            if out is not None:
+                self.learn(out, target)
+                return out
+            self.logger.debug("No reply from node %d, forgetting it", target[0])
+            self.ring.forget(target[0])
+
+        out = self.ask(payload)
+        if out is not None:
+            self.learn(out)
+        return out
+
     def put(self, key, value):
         """ Store value to key in the DHT."""
-        msg = {"method": "PUT", "args": {"key": key, "value": value}}
-        pickled_msg = pickle.dumps(msg)
-        self.socket.sendto(pickled_msg, self.dht_addr)
-        pickled_msg, addr = self.socket.recvfrom(1024)
-        out = pickle.loads(pickled_msg)
+        out = self.request({"method": "PUT", "args": {"key": key, "value": value}}, key)
+        if out is None:
+            return False
         if out["method"] != "ACK":
             self.logger.error("Invalid msg: %s", out)
             return False
@@ -24,16 +187,98 @@ class DHTClient:
 
     def get(self, key):
         """ Retrieve key from DHT."""
-        msg = {"method": "GET", "args": {"key": key}}
-        pickled_msg = pickle.dumps(msg)
-        self.socket.sendto(pickled_msg, self.dht_addr)
-        pickled_msg, addr = self.socket.recvfrom(1024)
-        out = pickle.loads(pickled_msg)
+        out = self.request({"method": "GET", "args": {"key": key}}, key)
+        if out is None:
+            return None
         if out["method"] != "ACK":
             self.logger.error("Invalid msg: %s", out)
             return None
         return out["args"]
 
+    def request_many(self, msg, field):
+        """ Send a batch request and merge the per-owner replies to it.
+
+        Every node owning some of the keys answers its share, so replies are
+        collected until each key in msg["args"][field] has a result. Keys
+        left unanswered for timeout seconds are asked for again, up to
+        retries times; the ones still missing then have no result.
+        """
+        self.request_id += 1
+        msg["args"]["request_id"] = self.request_id
+        batch = msg["args"][field]
+        remaining = set(batch)
+        results = {}
+        for _ in range(self.retries + 1):
+            for payload in pack_batch(msg, field):
+                self.send(payload)
+            while remaining:
+                out = self.wait_reply(self.timeout)
+                if out is None:
+                    break
+                self.learn(out)
+                results.update(out["args"]["results"])
+                remaining.difference_update(out["args"]["results"])
+            if not remaining:
+                return results
+            missing = {key: batch[key] for key in remaining} if isinstance(batch, dict) else list(remaining)
+            msg = dict(msg, args=dict(msg["args"], **{field: missing}))
+        self.logger.error("No reply for %d keys", len(remaining))
+        return results
+
+    def put_many(self, items):
+        """ Store every key -> value of items, return key -> True if stored."""
+        items = dict(items)
+        results = self.request_many({"method": "PUT_MANY", "args": {"items": items}}, "items")
+        return {key: results.get(key, False) for key in items}
+
+    def get_many(self, keys):
+        """ Retrieve keys from DHT, return key -> value (None if not found)."""
+        keys = list(keys)
+        results = self.request_many({"method": "GET_MANY", "args": {"keys": keys}}, "keys")
+        return {key: results.get(key, (False, None))[1] for key in keys}
+
+    def scan_page(self, token=None, limit=100):
+        """ One page of the keys in ring order: (list of (key, value), token of the next page).
+
+        Start with token None; a None token back means the whole ring was walked.
+        """
+        position = 0
+        if token is not None:
+            position = token[0] + 1 if token[1] is None else token[0]
+        out = self.request({"method": "SCAN", "args": {"token": token, "limit": limit}}, key_hash=position)
+        if out is None:
+            raise TimeoutError("no reply to SCAN")
+        # the node holding the next page, when it is another one
+        successor = out["args"].get("next")
+        if successor:
+            self.ring.learn(successor["id"], successor["addr"], successor["predecessor_id"])
+        return [tuple(item) for item in out["args"]["items"]], out["args"]["token"]
+
+    def scan(self, limit=100):
+        """ Iterate over every (key, value) in the DHT, a page of limit pairs at a time.
+
+        Pairs come ordered by the hash of their key. Keys stored or handed
+        off meanwhile may or may not show up.
+        """
+        items, token = self.scan_page(None, limit)
+        yield from items
+        while token is not None:
+            items, token = self.scan_page(token, limit)
+            yield from items
+
+    def stats(self, address=None, prometheus=False):
+        """ Metrics of the node at address (the entry node by default).
+
+        A dict (see DHTNode.stats), or Prometheus text with prometheus set;
+        None if the node does not answer.
+        """
+        self.request_id += 1
+        args = {"request_id": self.request_id}
+        if prometheus:
+            args["format"] = "prometheus"
+        out = self.ask(encode({"method": "STATS", "args": args}), address)
+        return None if out is None else out["args"]
+
 
 if __name__ == "__main__":
     client = DHTClient(("localhost", 5000))
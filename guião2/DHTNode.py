@@ -2,72 +2,122 @@
 import socket
 import threading
 import logging
-import pickle
-from utils import dht_hash, contains
+import random
+import itertools
+import queue
+import time
+import heapq
+from bisect import bisect_left
+from utils import dht_hash, dht_hash_many, contains, ring_size, M_BITS, DATAGRAM_SIZE
+from codec import encode, fragment, pack_batch, Reassembler, CodecError
+from storage import DictStore
+from metrics import Metrics, prometheus
+from cache import ReadCache
+
+
+# keys per TRANSFER message when handing keys over to another node
+TRANSFER_CHUNK = 256
+# times keys handed over are sent again, timeout seconds apart, before they stay where they are
+TRANSFER_RETRIES = 5
+
+# client requests handled by the worker pool, the rest stays on the node thread
+WORKER_METHODS = {"PUT", "GET", "PUT_MANY", "GET_MANY", "SCAN"}
+# locks making "store unless present" atomic, shared by keys with the same hash
+KEY_LOCKS = 64
+# pairs per SCAN page when the client does not say
+SCAN_LIMIT = 100
+# heartbeats in a row my successor may leave unanswered before it is taken for dead
+HEARTBEAT_MISSES = 2
 
 
 class FingerTable:
-    """Finger Table."""
+    """Finger Table.
 
-    def __init__(self, node_id, node_addr, m_bits=10):
+    The start keys (n + 2^i mod 2^m) never change for a given node, so they are
+    computed once. Lookups rotate the ring so that node_id sits at 0 and then
+    bisect over the sorted distances instead of scanning all m entries.
+    """
+
+    def __init__(self, node_id, node_addr, m_bits=M_BITS):
         """ Initialize Finger Table."""
 
         self.finger_table = []
         self.node_id = node_id
         self.node_addr = node_addr
         self.max_size = m_bits
-        for i in range(self.max_size):
-            key = (self.node_id + pow(2, i))    # key = n + 2^i
-            # key = key % 2^m para nao ultrapassar o valor máximo
-            key = key % pow(2, m_bits)
+        self.ring_size = ring_size(m_bits)
+
+        # distance (clockwise) of each start key to node_id: 2^i
+        self.offsets = [pow(2, i) for i in range(self.max_size)]
+        # key = n + 2^i % 2^m para nao ultrapassar o valor máximo
+        self.starts = [(self.node_id + offset) % self.ring_size for offset in self.offsets]
+
+        for key in self.starts:
             self.finger_table.append((key, None))
 
+        self._reach = None    # lazily rebuilt on lookups after an update
+
+    def _distance(self, identification):
+        """Clockwise distance from node_id to identification, in ]0, 2^m].
+
+        node_id itself maps to 2^m, so it is never inside ]node_id, x].
+        """
+        return (identification - self.node_id - 1) % self.ring_size + 1
+
+    def _boundaries(self):
+        """Sorted boundary array for find().
+
+        Entry i holds the farthest distance covered by fingers 0..i, so the
+        first index whose boundary reaches a distance is the same one the
+        linear scan would stop at, even while stale entries are out of order.
+        """
+        reach = self._reach  # read once: the node thread may reset it meanwhile
+        if reach is None:
+            reach = []
+            farthest = 0
+            for finger_id, _ in self.finger_table:
+                farthest = max(farthest, (finger_id - self.node_id) % self.ring_size)
+                reach.append(farthest)
+            self._reach = reach
+        return reach
+
     def fill(self, node_id, node_addr):
         """ Fill all entries of finger_table with node_id, node_addr."""
         self.finger_table = [(node_id, node_addr) for i in range(self.max_size)]
+        self._reach = None
 
     def update(self, index, node_id, node_addr):
         """Update index of table with node_id and node_addr."""
         self.finger_table[index-1] = (node_id, node_addr)
+        self._reach = None
 
     def find(self, identification):
         """ Get node address of closest preceding node (in finger table) of identification. """
 
-        # check from start to end
-        for i in range(self.max_size):
-            if(contains(self.node_id, self.finger_table[i][0], identification)):
-                return self.finger_table[i-1][1]
+        reach = self._boundaries()
+        i = bisect_left(reach, self._distance(identification))
+        if i < self.max_size:
+            return self.finger_table[i-1][1]
 
-        # if not between start and end, then it's between end and start
-        return self.finger_table[self.max_size - 1][1]
+        # if not between start and end, then it's between end and start: go to
+        # the farthest finger (the last one, unless its start wrapped around to me)
+        return self.finger_table[bisect_left(reach, reach[-1])][1]
 
     def refresh(self):
         """ Retrieve finger table entries."""
 
-        results = []
-        for i in range(self.max_size):
-            key = (self.node_id + pow(2, i))    # key = n + 2^i
-            # key = key % 2^m para nao ultrapassar o valor máximo
-            key = key % pow(2, self.max_size)
-            results.append(key)
-
-        refreshed = []
-        for i in range(self.max_size):
-            refreshed.append((i + 1, results[i], self.finger_table[i][1]))
-        return refreshed
+        return [
+            (i + 1, self.starts[i], self.finger_table[i][1])
+            for i in range(self.max_size)
+        ]
 
     def getIdxFromId(self, id):
-        results = []
-        for i in range(self.max_size):
-            key = (self.node_id + pow(2, i))    # key = n + 2^i
-            # key = key % 2^m para nao ultrapassar o valor máximo
-            key = key % pow(2, self.max_size)
-            results.append(key)
+        """Index (1-based) of the first finger whose start key covers id."""
 
-        # for all table entries
-        for i in range(self.max_size):
-            if contains(self.node_id, results[i], id):
-                return i + 1
+        i = bisect_left(self.offsets, self._distance(id))
+        if i < self.max_size:
+            return i + 1
+        return None
 
     def __repr__(self):
         return str(self.finger_table)
@@ -85,21 +135,118 @@ class FingerTable:
         return lst
 
 
+class StabilizeScheduler:
+    """Decides when the next stabilize round is due.
+
+    Rounds start min_interval apart. After patience rounds in a row without a
+    topology change (one full sweep of the finger table) the interval is
+    multiplied by backoff, up to max_interval; any change brings it back down.
+    """
+
+    def __init__(self, min_interval, max_interval, patience, backoff=2, clock=time.monotonic):
+        self.clock = clock  # seconds, a virtual clock in simulator.py
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.patience = patience
+        self.backoff = backoff
+        self.interval = min_interval
+        self.quiet = 0  # rounds since the last change
+        self.dirty = False  # changes seen since the last round
+        self.deadline = clock()
+
+    def changed(self):
+        """Something moved (join, leave, new successor or finger): hurry up."""
+        self.dirty = True
+        self.interval = self.min_interval
+        self.deadline = min(self.deadline, self.clock() + self.min_interval)
+
+    def due(self):
+        return self.clock() >= self.deadline
+
+    def wait(self):
+        """Seconds until the next round (never 0, which would make a socket non-blocking)."""
+        return max(self.deadline - self.clock(), 0.001)
+
+    def schedule(self):
+        """A round was just run, set the deadline of the next one."""
+        if self.dirty:
+            self.quiet = 0
+            self.interval = self.min_interval
+        else:
+            self.quiet += 1
+            if self.quiet >= self.patience:
+                self.quiet = 0
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+        self.dirty = False
+        self.deadline = self.clock() + self.interval
+
+
+def virtual_addresses(address, vnodes, maximum):
+    """Addresses of the vnodes virtual nodes hosted at address.
+
+    The first one is address itself, the others (host, port, index) with the
+    index skipping any whose id collides with an earlier one of the same host.
+    """
+    addresses = [address]
+    ids = {dht_hash(str(address), maximum=maximum)}
+    for index in itertools.count(1):
+        if len(addresses) >= min(vnodes, maximum):
+            return addresses
+        virtual = (address[0], address[1], index)
+        node_id = dht_hash(str(virtual), maximum=maximum)
+        if node_id not in ids:
+            ids.add(node_id)
+            addresses.append(virtual)
+
+
 class DHTNode(threading.Thread):
     """ DHT Node Agent. """
 
-    def __init__(self, address, dht_address=None, timeout=3):
+    def __init__(self, address, dht_address=None, timeout=3, m_bits=M_BITS,
+                 replicas=0, write_quorum=1, read_quorum=1, keystore=None,
+                 workers=0, queue_size=1024, vnodes=1, host=None, clock=time.monotonic, transport=None,
+                 log_every=100, successors=3, cache=0, cache_ttl=10):
         """Constructor
 
         Parameters:
             address: self's address
             dht_address: address of a node in the DHT
-            timeout: impacts how often stabilize algorithm is carried out
+            timeout: longest wait for a message; stabilize rounds run between
+                timeout / 8 and timeout * 4 seconds apart depending on churn
+            m_bits: identifier size of the ring, must match every other node
+            replicas: extra copies of every key, kept on the next successors
+            write_quorum: copies stored before a PUT is acknowledged
+            read_quorum: copies consulted before a GET is answered
+            keystore: storage backend (see storage.py), in memory by default
+            workers: threads handling PUT/GET (0: all on the node thread)
+            queue_size: requests waiting for a worker, more are dropped
+            vnodes: ids this node takes in the ring, each a virtual node with
+                its own successor, predecessor and finger table
+            host: virtual node owning the socket, keystore and workers this
+                one shares (None for the node started as a thread)
+            clock: time source in seconds for stabilize and join rounds
+            transport: socket-like object (sendto, recvfrom, bind,
+                settimeout, close) used instead of a UDP socket
+            log_every: log one received message in log_every (0: none)
+            successors: nodes kept in the successor list (at least
+                replicas + 1), the ones to fall back on when my successor
+                stops answering its heartbeats
+            cache: values of keys this node forwards GETs for that are kept
+                to answer the next GETs right away (0: none)
+            cache_ttl: seconds a cached value is served for
         """
         threading.Thread.__init__(self)
+        if not 1 <= write_quorum <= replicas + 1 or not 1 <= read_quorum <= replicas + 1:
+            raise ValueError("quorums must be between 1 and replicas + 1")
         self.done = False
-        self.identification = dht_hash(address.__str__())
-        self.addr = address  # My address
+        self.m_bits = m_bits
+        self.replicas = replicas
+        self.write_quorum = write_quorum
+        self.read_quorum = read_quorum
+        self.maximum = ring_size(m_bits)
+        self.identification = dht_hash(address.__str__(), maximum=self.maximum)
+        self.addr = address  # My address, (host, port, index) for the virtual nodes after the first
+        self.vnode = address[2] if len(address) > 2 else 0
         self.dht_address = dht_address  # Address of the initial Node
         if dht_address is None:
             self.inside_dht = True
@@ -115,22 +262,109 @@ class DHTNode(threading.Thread):
             self.predecessor_id = None
             self.predecessor_addr = None
 
-        self.finger_table = FingerTable(self.identification, self.addr)
+        # next successor_count nodes after me: [(id, addr)], successor first
+        self.successor_count = max(successors, replicas + 1)
+        self.successor_list = [(self.successor_id, self.successor_addr)] if dht_address is None else []
 
-        self.keystore = {}  # Where all data is stored
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.settimeout(timeout)
+        self.finger_table = FingerTable(self.identification, self.addr, m_bits)
+        if dht_address is None:
+            # alone in the DHT: I am the successor of every key
+            self.finger_table.fill(self.identification, self.addr)
+        self.next_finger = 0  # finger refreshed by the next stabilize round
+        self.clock = clock
+        self.finger_checked = [clock()] * m_bits  # when each finger was last confirmed by a lookup
+        self.scheduler = StabilizeScheduler(timeout / 8, timeout * 4, patience=m_bits, clock=clock)
+        # my successor is sent a heartbeat (PREDECESSOR) every timeout seconds
+        # and has timeout / 2 seconds to answer it (STABILIZE)
+        self.heartbeat_at = clock()  # when the next heartbeat is due
+        self.heartbeat_deadline = None  # when the answer to the one in flight is due
+        self.misses = 0  # heartbeats in a row my successor did not answer
+        self.failed = {}  # id -> when it was found dead; not taken back as successor for a while
+        self.unannounced = []  # dead successors to tell others about once a live one answers
+        self.pings = {}  # finger id -> [addr, when its PONG is due, pings missed]
+        self.next_ping = 0  # turn of the finger pinged with the next heartbeat
+
+        self.replica_store = {}  # Copies of keys owned by my predecessors
+        self.tokens = itertools.count(1)
+        self.pending_writes = {}  # token -> [acks missing, client address, request_id, deadline]
+        self.pending_reads = {}  # token -> [replies missing, client address, request_id, value, owner, key, deadline]
+        self.pending_transfers = {}  # key handed off -> [keep it as a replica once acknowledged, to, resend at, resends]
+        self.replica_holders = set()  # ids of the replicas given a copy of my keys
+        self.workers = workers
+        self.timeout = timeout
+        self.log_every = log_every
         self.logger = logging.getLogger("Node {}".format(self.identification))
+        self.host = self if host is None else host
+        if host is None:
+            self.keystore = DictStore() if keystore is None else keystore  # Where all data is stored
+            self.msg_ids = itertools.count()  # tags the fragments of large messages
+            self.requests = queue.Queue(maxsize=queue_size)  # (node, msg, addr) for the workers
+            self.key_locks = [threading.Lock() for _ in range(KEY_LOCKS)]
+            self.reassembler = Reassembler()
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if transport is None else transport
+            self.socket.settimeout(timeout)
+            self.joining, self.join_at = None, 0  # virtual node asking to join the DHT, when to ask again
+            self.vnodes = {}  # index -> virtual node behind this socket, me included
+            self.metrics = Metrics()
+            self.key_hashes = {}  # key -> hash of the keys scanned, hashes never change
+            self.cache = ReadCache(cache, cache_ttl, clock) if cache else None
+            self.received = itertools.count()  # picks the messages that are logged
+        else:
+            self.keystore = host.keystore
+            self.msg_ids = host.msg_ids
+            self.requests = host.requests
+            self.key_locks = host.key_locks
+            self.reassembler = host.reassembler
+            self.socket = host.socket
+            self.vnodes = host.vnodes
+            self.metrics = host.metrics
+            self.cache = host.cache
+        self.vnodes[self.vnode] = self
+        if host is None:
+            # the others join through me once I am in the DHT
+            for virtual in virtual_addresses(address, vnodes, self.maximum)[1:]:
+                DHTNode(virtual, address, timeout, m_bits, replicas, write_quorum, read_quorum,
+                        host=self, clock=clock, successors=successors)
+
+    def envelope(self, address, msg):
+        """ Socket address and msg to send for a message from me to address.
+
+        Virtual nodes share their host's socket: msg names the one it is for
+        in "vnode" and the one sending it in "from_vnode" (0, the host, is left
+        out), so the receiver can tell them apart.
+        """
+        if len(address) == 2 and not self.vnode:
+            return address, msg
+        msg = dict(msg)
+        if len(address) > 2:
+            msg["vnode"] = address[2]
+        if self.vnode:
+            msg["from_vnode"] = self.vnode
+        return address[:2], msg
 
     def send(self, address, msg):
         """ Send msg to address. """
-        payload = pickle.dumps(msg)
-        self.socket.sendto(payload, address)
+        address, msg = self.envelope(address, msg)
+        self.send_payload(address, encode(msg))
+
+    def send_payload(self, address, payload):
+        """ Send an encoded message to address, in fragments if it needs more than one datagram."""
+        if len(payload) <= DATAGRAM_SIZE:
+            self.socket.sendto(payload, address)
+            return
+        for datagram in fragment(payload, next(self.msg_ids)):
+            self.socket.sendto(datagram, address)
+
+    def send_batch(self, address, msg, field):
+        """ Send msg to address, split over as many datagrams as msg["args"][field] needs."""
+        address, msg = self.envelope(address, msg)
+        for payload in pack_batch(msg, field):
+            self.send_payload(address, payload)
 
     def recv(self):
         """ Retrieve msg payload and from address."""
         try:
-            payload, addr = self.socket.recvfrom(1024)
+            payload, addr = self.socket.recvfrom(DATAGRAM_SIZE)
         except socket.timeout:
             return None, None
 
@@ -138,6 +372,14 @@ class DHTNode(threading.Thread):
             return None, addr
         return payload, addr
 
+    def decode(self, payload, addr):
+        """ Message completed by payload, None for a fragment of a pending or an invalid one."""
+        try:
+            return self.reassembler.feed(payload, addr)
+        except CodecError as err:
+            self.logger.error("Invalid datagram from %s: %s", addr, err)
+            return None
+
     def node_join(self, args):
         """Process JOIN_REQ message.
 
@@ -148,24 +390,42 @@ class DHTNode(threading.Thread):
         self.logger.debug("Node join: %s", args)
         addr = args["addr"]
         identification = args["id"]
+        self.failed.pop(identification, None)  # back after a crash
+        if args.get("m_bits", M_BITS) != self.m_bits:
+            self.refuse_join(addr, "ring uses {} bits, node {}".format(self.m_bits, args.get("m_bits", M_BITS)))
+            return
         if self.identification == self.successor_id:  # I'm the only node in the DHT
+            if identification == self.identification:
+                self.refuse_join(addr, "id {} is taken".format(identification))
+                return
             self.successor_id = identification
             self.successor_addr = addr
+            self.update_successor_list()
+            self.scheduler.changed()
 
             #TODO update finger table -- done
             # if im the only node, finger_table is only me
             self.finger_table.fill(self.successor_id, self.successor_addr)
 
-            args = {"successor_id": self.identification, "successor_addr": self.addr}
+            args = {"successor_id": self.identification, "successor_addr": self.addr, "successors": []}
             self.send(addr, {"method": "JOIN_REP", "args": args})
 
         elif contains(self.identification, self.successor_id, identification):
+            if identification == self.successor_id:
+                # a repeated request of my successor was answered already
+                if addr != self.successor_addr:
+                    self.refuse_join(addr, "id {} is taken".format(identification))
+                return
             args = {
                 "successor_id": self.successor_id,
                 "successor_addr": self.successor_addr,
+                # its own successors to fall back on, should it crash early on
+                "successors": self.successor_list,
             }
             self.successor_id = identification
             self.successor_addr = addr
+            self.update_successor_list()
+            self.scheduler.changed()
 
             #TODO update finger table -- done
             self.finger_table.fill(self.successor_id, self.successor_addr)
@@ -173,7 +433,36 @@ class DHTNode(threading.Thread):
             self.send(addr, {"method": "JOIN_REP", "args": args})
         else:
             self.logger.debug("Find Successor(%d)", args["id"])
-            self.send(self.successor_addr, {"method": "JOIN_REQ", "args": args})
+            self.send(self.finger_table.find(identification), {"method": "JOIN_REQ", "args": args})
+        self.logger.info(self)
+
+    def refuse_join(self, addr, reason):
+        """ Answer a JOIN_REQ from addr with an error instead of a successor."""
+        self.logger.error("Refusing join of %s: %s", addr, reason)
+        self.send(addr, {"method": "JOIN_REP", "args": {"error": reason}})
+
+    def joined(self, args):
+        """Process JOIN_REP message: take my place in the DHT before my new successor.
+
+        A refused virtual node is dropped, a refused host stops.
+        """
+        if "error" in args:
+            self.logger.error("Join refused: %s", args["error"])
+            if self.host is self:
+                self.done = True
+            else:
+                del self.vnodes[self.vnode]
+            return
+        self.successor_id = args["successor_id"]
+        self.successor_addr = args["successor_addr"]
+
+        self.update_successor_list(args.get("successors", ()))
+        self.finger_table.fill(
+            self.successor_id, self.successor_addr)
+
+        self.inside_dht = True
+        self.scheduler.changed()
+        self.announce()
         self.logger.info(self)
 
     def get_successor(self, args):
@@ -188,7 +477,8 @@ class DHTNode(threading.Thread):
         id_ = args["id"]
         addr = args["from"]
 
-        if(contains(self.identification, self.successor_id, id_)):
+        # alone in the DHT, every id is mine
+        if self.successor_id == self.identification or contains(self.identification, self.successor_id, id_):
             self.send(addr, {"method": "SUCCESSOR_REP", "args": {"req_id": id_, "successor_id": self.successor_id, "successor_addr": self.successor_addr}})
         else:
             self.send(self.finger_table.find(id_), {"method": "SUCCESSOR", "args": {"id": id_, "from": addr}})
@@ -202,148 +492,1134 @@ class DHTNode(threading.Thread):
         """
 
         self.logger.debug("Notify: %s", args)
-        if self.predecessor_id is None or contains(self.predecessor_id, self.identification, args["predecessor_id"]):
+        # my predecessor crashed if the node before it says so
+        crashed = self.predecessor_id in args.get("failed", ())
+        # a lone node notifies itself; that is no reason to ignore the next node
+        if (self.predecessor_id in (None, self.identification) or crashed
+                or contains(self.predecessor_id, self.identification, args["predecessor_id"])):
+            self.predecessor_id = args["predecessor_id"]
+            self.predecessor_addr = args["predecessor_addr"]
+            self.scheduler.changed()
+            if crashed:
+                self.take_over()
+            self.handoff()
+        self.logger.info(self)
+
+    def take_over(self):
+        """Own the keys of a crashed predecessor: my replicas of them become mine, and are replicated."""
+        keys = list(self.replica_store)
+        promoted = {}
+        for key, key_hash in zip(keys, dht_hash_many(keys, maximum=self.maximum)):
+            if self.owns(key_hash):
+                with self.key_lock(key):
+                    self.keystore.setdefault(key, self.replica_store.pop(key))
+                    promoted[key] = self.keystore[key]
+        if promoted:
+            self.logger.info("Took over %d keys of a crashed predecessor", len(promoted))
+            self.replicate(promoted)
+
+    def holders(self, keys):
+        """Split keys by the virtual node of this host they fall to, the first one at or after their hash.
+
+        Every virtual node keeps its keys in the shared keystore; this tells
+        which of them answers for each key when handing keys over.
+        """
+        nodes = {node.identification: node for node in list(self.vnodes.values()) if node.inside_dht}
+        ids = sorted(nodes)
+        if not ids:
+            return {}
+        held = {}
+        for key, key_hash in zip(keys, dht_hash_many(keys, maximum=self.maximum)):
+            held.setdefault(nodes[ids[bisect_left(ids, key_hash) % len(ids)]], []).append((key, key_hash))
+        return held
+
+    def handoff(self):
+        """Hand the keys no longer in ]predecessor, me] over to my (new) predecessor."""
+        moving = {
+            key: self.keystore[key]
+            for key, key_hash in self.holders(list(self.keystore)).get(self, ())
+            if not self.owns(key_hash)
+        }
+        if moving and self.predecessor_addr != self.addr:
+            self.logger.debug("Handoff of %d keys to %s", len(moving), self.predecessor_id)
+            # I am the first successor of the new owner, hence one of its replicas
+            self.transfer(moving, self.predecessor_addr, keep_replica=self.replicas > 0)
+
+    def transfer(self, items, address, keep_replica=False):
+        """Stream items to the node at address in TRANSFER messages.
+
+        Every key stays here until the receiver acknowledges it, then it is
+        dropped or, with keep_replica, moved to the replica store. Keys not
+        acknowledged within timeout seconds are sent again (see
+        retry_transfers).
+        """
+        resend_at = self.clock() + self.timeout
+        for key in items:
+            self.pending_transfers[key] = [keep_replica, address, resend_at, 0]
+        self.send_transfer(items, address)
+
+    def send_transfer(self, items, address):
+        """Send items to the node at address, TRANSFER_CHUNK keys per TRANSFER message."""
+        keys = list(items)
+        for start in range(0, len(keys), TRANSFER_CHUNK):
+            chunk = {key: items[key] for key in keys[start:start + TRANSFER_CHUNK]}
+            self.send_batch(address, {"method": "TRANSFER", "args": {"items": chunk}}, "items")
+
+    def retry_transfers(self):
+        """Send again the keys handed over whose TRANSFER_ACK is overdue.
+
+        A TRANSFER or its ack may be lost on the way. After TRANSFER_RETRIES
+        resends a key is given up on and stays here, until a later handoff.
+        """
+        now = self.clock()
+        resend = {}  # address -> items
+        given_up = 0
+        for key, pending in list(self.pending_transfers.items()):
+            keep_replica, address, resend_at, resends = pending
+            if resend_at > now:
+                continue
+            found, value = self.owned_value(key)
+            if not found or resends >= TRANSFER_RETRIES:
+                if self.pending_transfers.pop(key, None) is not None:
+                    given_up += found
+                continue
+            pending[2:] = [now + self.timeout, resends + 1]
+            resend.setdefault(tuple(address), {})[key] = value
+        if given_up:
+            self.logger.warning("Gave up handing over %d keys, they stay here", given_up)
+        for address, items in resend.items():
+            self.logger.debug("Sending %d keys again to %s", len(items), address)
+            self.send_transfer(items, address)
+
+    def receive_transfer(self, args, addr):
+        """Process TRANSFER message: take ownership of items and acknowledge them."""
+        self.keystore.update(args["items"])
+        for key in args["items"]:
+            self.replica_store.pop(key, None)
+        self.send_batch(addr, {"method": "TRANSFER_ACK", "args": {"keys": list(args["items"])}}, "keys")
+
+    def transfer_done(self, args):
+        """Process TRANSFER_ACK message: let go of the acknowledged keys."""
+        for key in args["keys"]:
+            pending = self.pending_transfers.pop(key, None)
+            if pending is None:
+                continue
+            with self.key_lock(key):
+                value = self.keystore.pop(key, None)
+            if pending[0]:
+                self.replica_store[key] = value
+
+    def neighbour_outside(self, nodes, side):
+        """First node past me on side ("successor" or "predecessor") not in nodes (id -> node).
+
+        Returns its (id, addr), None if it is unknown or every node is in nodes.
+        """
+        node = self
+        for _ in range(len(nodes)):
+            node_id = getattr(node, side + "_id")
+            if node_id not in nodes:
+                return None if node_id is None else (node_id, getattr(node, side + "_addr"))
+            node = nodes[node_id]
+        return None
+
+    def leave(self, timeout=5):
+        """Leave the DHT gracefully and stop the node.
+
+        All keys are handed to my successor (waiting up to timeout seconds for
+        it to acknowledge them) and my neighbours are pointed at each other.
+        Every virtual node leaves; keys and neighbours go to the first nodes
+        around each one that are not hosted here.
+        """
+        nodes = {node.identification: node for node in list(self.vnodes.values()) if node.inside_dht}
+        for node, held in self.holders(list(self.keystore)).items():
+            successor = node.neighbour_outside(nodes, "successor")
+            if successor is not None:
+                node.transfer({key: self.keystore[key] for key, _ in held}, successor[1])
+        deadline = time.time() + timeout
+        while any(node.pending_transfers for node in nodes.values()) and time.time() < deadline:
+            time.sleep(0.05)
+        missing = sum(len(node.pending_transfers) for node in nodes.values())
+        if missing:
+            self.logger.warning("Leaving with %d keys not acknowledged", missing)
+
+        for node in nodes.values():
+            successor = node.neighbour_outside(nodes, "successor")
+            predecessor = node.neighbour_outside(nodes, "predecessor") or (None, None)
+            if successor is None:
+                continue  # alone in the DHT
+            if node.successor_id not in nodes:
+                args = {"id": node.identification, "predecessor_id": predecessor[0],
+                        "predecessor_addr": predecessor[1]}
+                node.send(node.successor_addr, {"method": "LEAVE", "args": args})
+            if node.predecessor_addr is not None and node.predecessor_id not in nodes:
+                args = {"id": node.identification, "successor_id": successor[0],
+                        "successor_addr": successor[1]}
+                node.send(node.predecessor_addr, {"method": "LEAVE", "args": args})
+        self.done = True
+
+    def node_leave(self, args):
+        """Process LEAVE message: bypass a neighbour that left the DHT.
+
+        Parameters:
+            args (dict): id of the node leaving and its predecessor or successor
+        """
+        self.logger.debug("Node leave: %s", args)
+        if "predecessor_id" in args and self.predecessor_id == args["id"]:
             self.predecessor_id = args["predecessor_id"]
             self.predecessor_addr = args["predecessor_addr"]
+        if "successor_id" in args and self.successor_id == args["id"]:
+            self.successor_id = args["successor_id"]
+            self.successor_addr = args["successor_addr"]
+            self.update_successor_list(self.successor_list[2:])
+            self.scheduler.changed()
+            # fingers on the node that left now point to whoever took its keys
+            for i, (finger_id, _) in enumerate(self.finger_table.as_list):
+                if finger_id == args["id"]:
+                    self.finger_table.update(i + 1, self.successor_id, self.successor_addr)
         self.logger.info(self)
 
-    def stabilize(self, from_id, addr):
+    def update_successor_list(self, successors=()):
+        """Rebuild successor_list from my successor followed by its own successors.
+
+        Parameters:
+            successors: successor_list of my successor, [(id, addr)]
+        """
+        successor_list = [(self.successor_id, self.successor_addr)]
+        for node_id, node_addr in successors:
+            if len(successor_list) >= self.successor_count or node_id == self.identification:
+                break
+            if node_id != self.successor_id and node_id not in self.failed:
+                successor_list.append((node_id, node_addr))
+        if self.successor_list[:1] != successor_list[:1]:
+            # a heartbeat in flight was for the one before
+            self.heartbeat_deadline = None
+            self.misses = 0
+        self.successor_list = successor_list
+
+    def refresh_replicas(self):
+        """Copy my keys to the nodes that became my replicas since the last call.
+
+        A join or a crash moves nodes up my successor list; the new replicas
+        have none of my keys until given them here.
+        """
+        replicas = [(node_id, node_addr) for node_id, node_addr in self.successor_list[:self.replicas]
+                    if node_id != self.identification and node_addr[:2] != self.addr[:2]]
+        new = [node_addr for node_id, node_addr in replicas if node_id not in self.replica_holders]
+        self.replica_holders = {node_id for node_id, _ in replicas}
+        if not new:
+            return
+        mine = self.holders(list(self.keystore)).get(self, ())
+        if mine:
+            items = {key: self.keystore[key] for key, _ in mine}
+            for node_addr in new:
+                args = {"items": items, "token": None, "from": self.addr}
+                self.send_batch(node_addr, {"method": "REPLICATE", "args": args}, "items")
+
+    def stabilize(self, from_id, addr, from_addr=None, successors=(), sender=None):
         """Process STABILIZE protocol.
             Updates all successor pointers.
 
         Parameters:
             from_id: id of the predecessor of node with address addr
             addr: address of the node sending stabilize message
+            from_addr: address of from_id (older nodes only send the id)
+            successors: successor_list of the node sending stabilize message
+            sender: id of the node sending stabilize message (older nodes
+                leave it out)
         """
 
         self.logger.debug("Stabilize: %s %s", from_id, addr)
-
-        if from_id is not None and contains(self.identification, self.successor_id, from_id):
-            # Update our successor
+        if sender in (None, self.successor_id):
+            # the heartbeat was answered
+            self.heartbeat_deadline = None
+            self.misses = 0
+            if self.unannounced:
+                self.announce_failures()
+
+        # a crashed node may still be the predecessor of my successor
+        if (from_id is not None and from_id not in self.failed
+                and contains(self.identification, self.successor_id, from_id)):
+            # Update our successor, the old one now comes right after it
+            successors = [(self.successor_id, addr)] + list(successors)
             self.successor_id = from_id
-            self.successor_addr = addr
+            self.successor_addr = from_addr if from_addr is not None else addr
+            self.scheduler.changed()
 
-            for i in range(1, self.finger_table.getIdxFromId(from_id)):
+            # fingers starting before from_id (all of them if it is past the last start)
+            for i in range(1, self.finger_table.getIdxFromId(from_id) or self.m_bits + 1):
                 self.finger_table.update(i, self.successor_id, self.successor_addr)
 
+        self.update_successor_list(successors)
+        # my successor answered, so it is in the DHT and can take copies
+        self.refresh_replicas()
+
         # notify successor of our existence, so it can update its predecessor record
         args = {"predecessor_id": self.identification, "predecessor_addr": self.addr}
+        if self.failed:
+            args["failed"] = list(self.failed)  # its predecessor may be one of them
         self.send(self.successor_addr, {"method": "NOTIFY", "args": args})
 
-        for i in self.finger_table.refresh():
-            args = {"id": i[1], "from": self.addr}
-            self.send(i[2], {"method": "SUCCESSOR", "args": args})
+    def heartbeat(self):
+        """Send my successor a PREDECESSOR, whose STABILIZE answer shows it is alive.
 
-    def put(self, key, value, address):
+        One of my other fingers, each in turn, gets a PING along with it:
+        fingers on a crashed node would swallow the very lookups meant to fix them.
+        """
+        now = self.clock()
+        self.send(self.successor_addr, {"method": "PREDECESSOR"})
+        self.heartbeat_at = now + self.timeout
+        if self.heartbeat_deadline is None:
+            self.heartbeat_deadline = now + self.timeout / 2
+
+        fingers = dict(self.finger_table.as_list)
+        fingers.pop(self.identification, None)
+        fingers.pop(self.successor_id, None)
+        if fingers:
+            node_id = sorted(fingers)[self.next_ping % len(fingers)]
+            self.next_ping += 1
+            if node_id not in self.pings:
+                self.ping(node_id, fingers[node_id])
+
+    def check_successor(self):
+        """Send the heartbeat that is due, and drop my successor if it missed HEARTBEAT_MISSES of them.
+
+        Returns the seconds until the next check is due.
+        """
+        if self.successor_id == self.identification:
+            return self.timeout  # alone in the DHT
+        now = self.clock()
+        if self.failed:
+            self.failed = {node_id: since for node_id, since in self.failed.items()
+                           if now - since < self.timeout * 20}
+        if self.heartbeat_deadline is not None and now >= self.heartbeat_deadline:
+            self.heartbeat_deadline = None
+            self.misses += 1
+            if self.misses >= HEARTBEAT_MISSES:
+                self.successor_failed()
+            if self.successor_id != self.identification:
+                self.heartbeat()
+        elif self.heartbeat_deadline is None and now >= self.heartbeat_at:
+            self.heartbeat()
+        due = self.heartbeat_at if self.heartbeat_deadline is None else self.heartbeat_deadline
+        return max(due - self.clock(), 0.001)
+
+    def ping(self, node_id, addr, missed=0):
+        """Send PING to the finger node_id, expecting its PONG within timeout / 2 seconds."""
+        self.pings[node_id] = [addr, self.clock() + self.timeout / 2, missed]
+        self.send(addr, {"method": "PING", "args": {"id": self.identification}})
+
+    def check_fingers(self):
+        """Ping again the fingers that did not answer, drop the ones that missed HEARTBEAT_MISSES pings.
+
+        A dead finger is replaced by the finger before it (or my successor),
+        which precedes everything it covered, so lookups still make progress.
+        Returns the seconds until a PONG is due, None if none is awaited.
+        """
+        now = self.clock()
+        for node_id, (addr, deadline, missed) in list(self.pings.items()):
+            if now < deadline:
+                continue
+            if missed + 1 < HEARTBEAT_MISSES:
+                self.ping(node_id, addr, missed + 1)
+                continue
+            del self.pings[node_id]
+            self.logger.warning("Finger %d stopped answering", node_id)
+            self.failed[node_id] = now
+            previous = (self.successor_id, self.successor_addr)
+            for i, finger in enumerate(self.finger_table.as_list):
+                if finger[0] in self.failed:
+                    self.finger_table.update(i + 1, *previous)
+                else:
+                    previous = finger
+            self.scheduler.changed()
+        if not self.pings:
+            return None
+        return max(min(deadline for _, deadline, _ in self.pings.values()) - now, 0.001)
+
+    def successor_failed(self):
+        """My successor stopped answering: skip to the next live node in my successor list.
+
+        Failing that, to the closest finger that is not dead, or to my
+        predecessor (stabilize then walks back to the true successor), or I
+        am alone.
+        Fingers on the dead node are pointed at the new successor, which now
+        holds its keys (as replicas). The nodes whose fingers may point at it
+        are told once the new successor answers (it may be dead too).
+        """
+        dead = self.successor_id
+        self.logger.warning("Successor %d stopped answering", dead)
+        self.failed[dead] = self.clock()
+        alive = [node for node in self.successor_list if node[0] not in self.failed]
+        if not alive:
+            fingers = {node for node in self.finger_table.as_list
+                       if node[0] not in self.failed and node[0] != self.identification}
+            alive = sorted(fingers, key=lambda node: (node[0] - self.identification) % self.maximum)
+        if not alive and self.predecessor_id not in (None, self.identification) \
+                and self.predecessor_id not in self.failed:
+            alive = [(self.predecessor_id, self.predecessor_addr)]
+        if not alive:
+            alive = [(self.identification, self.addr)]
+            self.predecessor_id = self.predecessor_addr = None
+        self.successor_id, self.successor_addr = alive[0]
+        self.update_successor_list(alive[1:])
+        if self.predecessor_id in self.failed:
+            self.predecessor_id = self.predecessor_addr = None
+        self.replace_finger(dead, self.successor_id, self.successor_addr)
+        self.scheduler.changed()
+        self.unannounced.append(dead)
+
+    def announce_failures(self):
+        """Tell the nodes whose fingers may point at my dead successors that my successor took their place.
+
+        One FINGER_FAILED per finger and dead node, routed to the node
+        preceding dead - 2^i, as announce() does for a join.
+        """
+        for dead in self.unannounced:
+            for offset in self.finger_table.offsets:
+                target = (dead - offset) % self.maximum
+                if not contains(self.identification, self.successor_id, target):
+                    args = {"id": dead, "successor_id": self.successor_id, "successor_addr": self.successor_addr,
+                            "target": target}
+                    self.send(self.finger_table.find(target), {"method": "FINGER_FAILED", "args": args})
+        self.unannounced = []
+
+    def replace_finger(self, node_id, successor_id, successor_addr):
+        """Point the fingers on node_id at its successor; return whether there were any."""
+        replaced = False
+        for i, (finger_id, _) in enumerate(self.finger_table.as_list):
+            if finger_id == node_id:
+                self.finger_table.update(i + 1, successor_id, successor_addr)
+                replaced = True
+        return replaced
+
+    def finger_failed(self, args):
+        """Process FINGER_FAILED message: node args["id"] crashed, args["successor_id"] holds its keys now.
+
+        Every node on the way drops its fingers on the dead node. Once at the
+        node preceding args["target"], the message moves on to my predecessor
+        while that changes something, as FINGER_HINT does.
+        """
+        replaced = self.replace_finger(args["id"], args["successor_id"], args["successor_addr"])
+        if replaced:
+            self.scheduler.changed()
+        if not contains(self.identification, self.successor_id, args["target"]):
+            self.send(self.finger_table.find(args["target"]), {"method": "FINGER_FAILED", "args": args})
+        elif replaced and self.predecessor_addr is not None and self.predecessor_id != args["id"]:
+            args = dict(args, target=self.identification)
+            self.send(self.predecessor_addr, {"method": "FINGER_FAILED", "args": args})
+
+    def tick(self):
+        """Run one stabilize round.
+
+        Asks my successor for its predecessor (answered with STABILIZE) and
+        looks up the successor of a single finger start, so a full pass over
+        the finger table takes m rounds instead of every round sending m probes.
+        The lookup starts at the closest finger before the start, not at the
+        finger itself, which may have left the DHT; lower fingers are fixed
+        first, down to my successor, which is kept up to date by stabilize.
+        """
+        self.heartbeat()
+        start = self.finger_table.starts[self.next_finger]
+        if contains(self.identification, self.successor_id, start):
+            self.fix_finger({"req_id": start, "successor_id": self.successor_id,
+                             "successor_addr": self.successor_addr})
+        else:
+            self.send(self.finger_table.find(start), {"method": "SUCCESSOR", "args": {"id": start, "from": self.addr}})
+        self.next_finger = (self.next_finger + 1) % self.m_bits
+        self.scheduler.schedule()
+
+    def fix_finger(self, args):
+        """Process SUCCESSOR_REP message: store the successor of a finger start."""
+        if args["successor_id"] in self.failed:
+            return  # an answer from before the crash was known there
+        index = self.finger_table.getIdxFromId(args["req_id"])
+        finger = (args["successor_id"], args["successor_addr"])
+        self.finger_checked[index - 1] = self.clock()
+        if self.finger_table.as_list[index - 1] != finger:
+            self.finger_table.update(index, *finger)
+            self.scheduler.changed()
+
+    def announce(self):
+        """Point the fingers that should now be me at me (update_others in Chord).
+
+        One FINGER_HINT per finger, routed to the node preceding
+        me - 2^i, the last node whose i-th finger can start at or before me.
+        """
+        for offset in self.finger_table.offsets:
+            target = (self.identification - offset) % self.maximum
+            if not contains(self.identification, self.successor_id, target):
+                args = {"id": self.identification, "addr": self.addr, "target": target}
+                self.send(self.finger_table.find(target), {"method": "FINGER_HINT", "args": args})
+
+    def finger_hint(self, args):
+        """Process FINGER_HINT message: node args["id"] joined the DHT.
+
+        Once at the node preceding args["target"], every finger the new node
+        is closer to than the current one is pointed at it, and while that
+        changes something the hint moves on to my predecessor.
+        """
+        if args["id"] == self.identification:
+            return  # my own hint came back around the ring
+        if not contains(self.identification, self.successor_id, args["target"]):
+            self.send(self.finger_table.find(args["target"]), {"method": "FINGER_HINT", "args": args})
+            return
+
+        updated = False
+        for i, start in enumerate(self.finger_table.starts):
+            finger_id = self.finger_table.as_list[i][0]
+            if finger_id != args["id"] and contains((start - 1) % self.maximum, finger_id, args["id"]):
+                self.finger_table.update(i + 1, args["id"], args["addr"])
+                updated = True
+        if updated:
+            self.scheduler.changed()
+            if self.predecessor_addr is not None and self.predecessor_id != args["id"]:
+                args = dict(args, target=self.identification)
+                self.send(self.predecessor_addr, {"method": "FINGER_HINT", "args": args})
+
+    def owner_info(self, node_id=None, node_addr=None, predecessor_id=None):
+        """Owner field of replies: a node and the ring range ]predecessor_id, id] it owns.
+
+        Clients cache it to send their next requests straight to the owner.
+        Defaults to this node.
+        """
+        if node_id is None:
+            return {"id": self.identification, "addr": self.addr, "predecessor_id": self.predecessor_id}
+        return {"id": node_id, "addr": node_addr, "predecessor_id": predecessor_id}
+
+    def reply(self, address, msg, request_id=None, owner=None):
+        """Send ACK/NACK msg to a client, echoing the id of the request it answers.
+
+        owner (see owner_info) is the node owning the key, me if not given,
+        left out if empty.
+        """
+        if request_id is not None:
+            msg["request_id"] = request_id
+        owner = self.owner_info() if owner is None else owner
+        if owner:
+            msg["owner"] = owner
+        self.send(address, msg)
+
+    def owns(self, key_hash):
+        """Whether key_hash is in ]predecessor, me], the part of the ring I store."""
+        if self.successor_id == self.identification:
+            return True  # alone in the DHT
+        return self.predecessor_id is not None and contains(self.predecessor_id, self.identification, key_hash)
+
+    def key_lock(self, key):
+        """Lock guarding key in the keystore against concurrent workers."""
+        return self.key_locks[hash(key) % KEY_LOCKS]
+
+    def store(self, key, value):
+        """Store value unless key is already present, return whether it was stored."""
+        with self.key_lock(key):
+            if key in self.keystore:
+                return False
+            self.keystore[key] = value
+            return True
+
+    def put(self, key, value, address, request_id=None):
         """Store value in DHT.
 
         Parameters:
         key: key of the data
         value: data to be stored
         address: address where to send ack/nack
+        request_id: client tag echoed in the ack/nack (optional)
         """
-        key_hash = dht_hash(key)
+        key_hash = dht_hash(key, maximum=self.maximum)
         self.logger.debug("Put: %s %s", key, key_hash)
 
+        self.metrics.route("PUT", self.owns(key_hash))
+        if self.cache is not None and not self.owns(key_hash):
+            self.cache.discard(key)  # only there after the key was lost, which this PUT may fix
         # if key_hash belongs to this node
-        if contains(self.predecessor_id, self.identification, key_hash):
-            if key not in self.keystore:
-                self.keystore[key] = value
-                self.send(address, {"method": "ACK"})
+        if self.owns(key_hash):
+            if self.store(key, value):
+                self.replicate({key: value}, address, request_id)
             else:
-                self.send(address, {"method": "NACK"})
+                self.reply(address, {"method": "NACK"}, request_id)
         # if key_hash belongs to this node's successor
         elif contains(self.identification, self.successor_id, key_hash):
-            args = {"key": key, "value": value, "from": address}
+            args = {"key": key, "value": value, "from": address, "request_id": request_id}
             self.send(self.successor_addr, {"method": "PUT", "args": args})
         # if belongs to some other node, send it through finger_table
         else:
-            args = {"key": key, "value": value, "from": address}
+            args = {"key": key, "value": value, "from": address, "request_id": request_id}
             self.send(self.finger_table.find(key_hash), {"method": "PUT", "args": args})
 
-    def get(self, key, address):
+    def replicate(self, items, address=None, request_id=None):
+        """Copy items just stored here to my replicas.
+
+        The client at address gets its ACK once write_quorum copies (this one
+        included) are stored; with no address nobody waits for the copies.
+        """
+        # a copy on another virtual node of this host would not survive it
+        targets = [node_addr for node_id, node_addr in self.successor_list[:self.replicas]
+                   if node_addr[:2] != self.addr[:2]]
+        needed = self.write_quorum - 1
+        token = None
+        if address is not None:
+            if needed > len(targets):
+                self.logger.warning("Write quorum %d unreachable with %d replicas",
+                                    self.write_quorum, len(targets))
+                self.reply(address, {"method": "NACK"}, request_id)
+            elif needed == 0:
+                self.reply(address, {"method": "ACK"}, request_id)
+            else:
+                token = next(self.tokens)
+                self.pending_writes[token] = [needed, address, request_id, self.clock() + self.timeout]
+
+        for target in targets:
+            args = {"items": items, "token": token, "from": self.addr}
+            self.send_batch(target, {"method": "REPLICATE", "args": args}, "items")
+
+    def store_replica(self, args):
+        """Process REPLICATE message: keep copies of a predecessor's keys."""
+        self.replica_store.update(args["items"])
+        if args["token"] is not None:
+            self.send(args["from"], {"method": "REPLICATE_ACK", "args": {"token": args["token"]}})
+
+    def replica_stored(self, args):
+        """Process REPLICATE_ACK message: ACK the client once the write quorum is met."""
+        pending = self.pending_writes.get(args["token"])
+        if pending is None:
+            return
+        pending[0] -= 1
+        if pending[0] == 0 and self.pending_writes.pop(args["token"], None) is not None:
+            self.reply(pending[1], {"method": "ACK"}, pending[2])
+
+    def owned_value(self, key):
+        """(found, value) of key in the keystore."""
+        with self.key_lock(key):
+            if key in self.keystore:
+                return True, self.keystore[key]
+            return False, None
+
+    def local_value(self, key):
+        """(found, value) of key among the keys owned or replicated here."""
+        found, value = self.owned_value(key)
+        if found:
+            return found, value
+        if key in self.replica_store:
+            return True, self.replica_store[key]
+        return False, None
+
+    def read_replicas(self, key, replica_set, address, request_id=None, owner=None):
+        """Answer a GET from the copies in replica_set [(id, addr)].
+
+        With read_quorum 1 a random copy answers the client directly, which
+        spreads reads of hot keys; otherwise read_quorum copies are asked and
+        this node answers once all of them replied. owner is passed on to
+        reply().
+        """
+        owner = self.owner_info() if owner is None else owner
+        if self.read_quorum == 1:
+            node_id, node_addr = random.choice(replica_set)
+            if node_id == self.identification:
+                found, value = self.local_value(key)
+                self.reply(address, {"method": "ACK", "args": value} if found else {"method": "NACK"},
+                           request_id, owner)
+            else:
+                args = {"key": key, "from": address, "request_id": request_id, "replica": True, "owner": owner}
+                if self.cache is not None and owner["id"] != self.identification:
+                    args["via"] = self.addr
+                self.send(node_addr, {"method": "GET", "args": args})
+            return
+
+        if len(replica_set) < self.read_quorum:
+            self.logger.warning("Read quorum %d unreachable with %d copies", self.read_quorum, len(replica_set))
+            self.reply(address, {"method": "NACK"}, request_id, owner)
+            return
+        token = next(self.tokens)
+        self.pending_reads[token] = [self.read_quorum, address, request_id, None, owner, key,
+                                     self.clock() + self.timeout]
+        for node_id, node_addr in random.sample(replica_set, self.read_quorum):
+            if node_id == self.identification:
+                found, value = self.local_value(key)
+                self.replica_read({"token": token, "found": found, "value": value})
+            else:
+                self.send(node_addr, {"method": "GET_REPLICA", "args": {"key": key, "token": token, "from": self.addr}})
+
+    def replica_read(self, args):
+        """Process GET_REPLICA_REP message: answer the client once the read quorum replied."""
+        pending = self.pending_reads.get(args["token"])
+        if pending is None:
+            return
+        pending[0] -= 1
+        if args["found"]:
+            # keys are never overwritten, any copy that has it is current
+            pending[3] = (args["value"],)
+        if pending[0] == 0 and self.pending_reads.pop(args["token"], None) is not None:
+            self.answer_read(pending)
+
+    def answer_read(self, pending):
+        """Answer the client of a quorum read (an entry of pending_reads) with the value found, if any."""
+        if pending[3] is None:
+            self.reply(pending[1], {"method": "NACK"}, pending[2], pending[4])
+        else:
+            self.reply(pending[1], {"method": "ACK", "args": pending[3][0]}, pending[2], pending[4])
+            if self.cache is not None and pending[4]["id"] != self.identification:
+                self.cache.put(pending[5], pending[3][0])
+
+    def expire_requests(self):
+        """Answer the quorum requests whose replicas did not all reply within timeout seconds.
+
+        A write is NACKed. A read is answered with the value if a replica
+        that did reply has it (keys are never overwritten), NACKed otherwise.
+        """
+        now = self.clock()
+        for token, pending in list(self.pending_writes.items()):
+            if pending[3] <= now and self.pending_writes.pop(token, None) is not None:
+                self.logger.debug("Write %s expired with %d acks missing", token, pending[0])
+                self.reply(pending[1], {"method": "NACK"}, pending[2])
+        for token, pending in list(self.pending_reads.items()):
+            if pending[6] <= now and self.pending_reads.pop(token, None) is not None:
+                self.logger.debug("Read %s expired with %d replies missing", token, pending[0])
+                self.answer_read(pending)
+
+    def get(self, key, address, request_id=None, replica=False, owner=None, via=None):
         """Retrieve value from DHT.
 
         Parameters:
         key: key of the data
         address: address where to send ack/nack
+        request_id: client tag echoed in the ack/nack (optional)
+        replica: answer from my own copy, wherever the key hashes to
+        owner: node owning the key, reported to the client with a replica answer
+        via: node that forwarded the GET here, to be given the value found for its cache
+
+        With a cache, a GET for a key cached here is answered right away.
+        Every answer is also offered to the node the GET came from, so copies
+        of a hot key spread back along the lookup paths leading to its owner,
+        one hop per GET, and its reads are shared out among them.
         """
-        key_hash = dht_hash(key)
+        key_hash = dht_hash(key, maximum=self.maximum)
         self.logger.debug("Get: %s %s", key, key_hash)
 
+        if not replica and self.cache is not None and not self.owns(key_hash):
+            found, value = self.cache.get(key)
+            if found:
+                self.metrics.route("GET", True)
+                # no owner: the client keeps asking through the ring, where the copies are
+                self.reply(address, {"method": "ACK", "args": value}, request_id, {})
+                self.offer(via, key, found, value)
+                return
+
+        self.metrics.route("GET", replica or self.owns(key_hash))
+        if replica:
+            found, value = self.local_value(key)
+            # no owner from the node that sent me here: better unknown than me
+            self.reply(address, {"method": "ACK", "args": value} if found else {"method": "NACK"},
+                       request_id, owner or {})
+            self.offer(via, key, found, value)
         # if key_hash belongs to this node
-        if contains(self.predecessor_id, self.identification, key_hash):
-            if key in self.keystore:
-                value = self.keystore[key]
-                self.send(address, {"method": "ACK", "args": value})
+        elif self.owns(key_hash):
+            if self.read_quorum > 1:
+                replica_set = [(self.identification, self.addr)] + self.successor_list[:self.replicas]
+                self.read_replicas(key, replica_set, address, request_id)
             else:
-                self.send(address, {"method": "NACK"})
-        # if key_hash belongs to this node's successor
+                found, value = self.owned_value(key)
+                self.reply(address, {"method": "ACK", "args": value} if found else {"method": "NACK"}, request_id)
+                self.offer(via, key, found, value)
+        # if key_hash belongs to this node's successor, its replicas follow it
         elif contains(self.identification, self.successor_id, key_hash):
-            self.send(self.successor_addr, {"method": "GET", "args": {"key": key, "from": address}})
+            if self.replicas:
+                owner = self.owner_info(self.successor_id, self.successor_addr, self.identification)
+                self.read_replicas(key, self.successor_list[:self.replicas + 1], address, request_id, owner)
+            else:
+                args = {"key": key, "from": address, "request_id": request_id}
+                if self.cache is not None:
+                    args["via"] = self.addr
+                self.send(self.successor_addr, {"method": "GET", "args": args})
         # if belongs to some other node, send it through finger_table
         else:
-            self.send(self.finger_table.find(key_hash), {"method": "GET", "args": {"key": key, "from": address}})
+            args = {"key": key, "from": address, "request_id": request_id}
+            if self.cache is not None:
+                args["via"] = self.addr
+            self.send(self.finger_table.find(key_hash), {"method": "GET", "args": args})
+
+    def offer(self, via, key, found, value):
+        """Send the value a GET found to via, the node it came through, for its cache."""
+        if found and via is not None:
+            self.send(via, {"method": "CACHE", "args": {"key": key, "value": value}})
+
+    def next_hop(self, key_hash):
+        """ Address key_hash is forwarded to, None if it belongs to this node."""
+        if self.owns(key_hash):
+            return None
+        if contains(self.identification, self.successor_id, key_hash):
+            return self.successor_addr
+        return self.finger_table.find(key_hash)
+
+    def group_by_hop(self, keys):
+        """ Split keys into the ones stored here and the ones for each next hop."""
+        local = []
+        forward = {}
+        for key, key_hash in zip(keys, dht_hash_many(keys, maximum=self.maximum)):
+            hop = self.next_hop(key_hash)
+            if hop is None:
+                local.append(key)
+            else:
+                forward.setdefault(hop, []).append(key)
+        return local, forward
 
-    def run(self):
-        self.socket.bind(self.addr)
+    def put_many(self, items, address, request_id=None):
+        """Store several values in DHT.
 
-        # Loop untiln joining the DHT
-        while not self.inside_dht:
-            join_msg = {
-                "method": "JOIN_REQ",
-                "args": {"addr": self.addr, "id": self.identification},
-            }
-            self.send(self.dht_address, join_msg)
-            payload, addr = self.recv()
-            if payload is not None:
-                output = pickle.loads(payload)
-                self.logger.debug("O: %s", output)
-                if output["method"] == "JOIN_REP":
-                    args = output["args"]
-                    self.successor_id = args["successor_id"]
-                    self.successor_addr = args["successor_addr"]
+        Keys owned by this node are stored and answered in a single
+        PUT_MANY_REP, the others leave in one PUT_MANY per next hop.
 
-                    self.finger_table.fill(
-                        self.successor_id, self.successor_addr)
+        Parameters:
+        items: dict of key -> data to be stored
+        address: address where to send the replies
+        request_id: client tag echoed in the replies (optional)
+        """
+        self.logger.debug("Put many: %d keys", len(items))
+        local, forward = self.group_by_hop(list(items))
+        self.metrics.route("PUT_MANY", True, len(local))
+        self.metrics.route("PUT_MANY", False, len(items) - len(local))
+
+        for hop, keys in forward.items():
+            if self.cache is not None:
+                for key in keys:
+                    self.cache.discard(key)
+            args = {"items": {key: items[key] for key in keys}, "from": address, "request_id": request_id}
+            self.send_batch(hop, {"method": "PUT_MANY", "args": args}, "items")
+
+        if local:
+            # True if stored, False if the key already existed (NACK)
+            results = {key: self.store(key, items[key]) for key in local}
+            stored = {key: items[key] for key in local if results[key]}
+            if stored:
+                self.replicate(stored)
+            msg = {"method": "PUT_MANY_REP", "args": {"results": results}, "owner": self.owner_info()}
+            if request_id is not None:
+                msg["request_id"] = request_id
+            self.send_batch(address, msg, "results")
+
+    def get_many(self, keys, address, request_id=None):
+        """Retrieve several values from DHT.
+
+        Keys owned by this node are answered in a single GET_MANY_REP, the
+        others leave in one GET_MANY per next hop.
+
+        Parameters:
+        keys: list of keys of the data
+        address: address where to send the replies
+        request_id: client tag echoed in the replies (optional)
+        """
+        self.logger.debug("Get many: %d keys", len(keys))
+        local, forward = self.group_by_hop(keys)
+        self.metrics.route("GET_MANY", True, len(local))
+        self.metrics.route("GET_MANY", False, len(keys) - len(local))
+
+        for hop, hop_keys in forward.items():
+            args = {"keys": hop_keys, "from": address, "request_id": request_id}
+            self.send_batch(hop, {"method": "GET_MANY", "args": args}, "keys")
+
+        if local:
+            # (True, value) if found, (False, None) if not (NACK)
+            results = {key: self.owned_value(key) for key in local}
+            msg = {"method": "GET_MANY_REP", "args": {"results": results}, "owner": self.owner_info()}
+            if request_id is not None:
+                msg["request_id"] = request_id
+            self.send_batch(address, msg, "results")
+
+    def scan(self, token, limit, address, request_id=None):
+        """Answer a SCAN with the next page of (key, value) pairs in ring order.
+
+        Keys are walked by (hash, key), from hash 0 around the ring. The node
+        owning the position after token answers with up to limit pairs from
+        its part of the ring, and the token of the following page.
 
-                    self.inside_dht = True
-                    self.logger.info(self)
+        Parameters:
+        token: [hash, key] of the last pair returned ([hash, None]: every key
+            up to hash was returned), None for the first page
+        limit: pairs per page
+        address: address where to send the page
+        request_id: client tag echoed in the page (optional)
+        """
+        after = (-1, None) if token is None else tuple(token)
+        position = after[0] + 1 if after[1] is None else after[0]
+        hop = self.next_hop(position)
+        self.metrics.route("SCAN", hop is None)
+        if hop is not None:
+            args = {"token": token, "limit": limit, "from": address, "request_id": request_id}
+            self.send(hop, {"method": "SCAN", "args": args})
+            return
+
+        if self.successor_id == self.identification or position > self.identification:
+            end = self.maximum - 1  # alone, or in the range wrapping past the top of the ring
+        else:
+            end = self.identification
+        keys = list(self.keystore)
+        hashes = self.host.key_hashes
+        if len(hashes) > 2 * len(keys):
+            hashes = self.host.key_hashes = {}  # mostly keys handed off since
+        missing = [key for key in keys if key not in hashes]
+        hashes.update(zip(missing, dht_hash_many(missing, maximum=self.maximum)))
+        # vnodes share the keystore, only pairs between the position and the end of my range
+        pairs = ((hashes[key], key) for key in keys)
+        if after[1] is None:
+            pairs = (pair for pair in pairs if position <= pair[0] <= end)
+        else:
+            pairs = (pair for pair in pairs if pair > after and pair[0] <= end)
+        page = heapq.nsmallest(limit + 1, pairs)
+
+        items = []
+        for _, key in page[:limit]:
+            found, value = self.owned_value(key)
+            if found:
+                items.append([key, value])
+        args = {"items": items}
+        if len(page) > limit:
+            args["token"] = list(page[limit - 1])
+        elif end < self.maximum - 1:
+            args["token"] = [end, None]
+            # where the next page is, so the client asks there directly
+            args["next"] = self.owner_info(self.successor_id, self.successor_addr, self.identification)
+        else:
+            args["token"] = None  # the whole ring was walked
+        self.reply(address, {"method": "SCAN_REP", "args": args}, request_id)
+
+    def run(self):
+        self.socket.bind(self.addr)
+
+        workers = [threading.Thread(target=self.work, daemon=True) for _ in range(self.workers)]
+        for worker in workers:
+            worker.start()
 
         while not self.done:
+            self.socket.settimeout(self.maintain())
             payload, addr = self.recv()
-            if payload is not None:
-                output = pickle.loads(payload)
+            if payload is None:
+                continue
+            output = self.decode(payload, addr)
+            if output is None:
+                continue
+            if self.log_every and next(self.received) % self.log_every == 0:
                 self.logger.info("O: %s", output)
-                if output["method"] == "JOIN_REQ":
-                    self.node_join(output["args"])
-                elif output["method"] == "NOTIFY":
-                    self.notify(output["args"])
-                elif output["method"] == "PUT":
-                    self.put(
-                        output["args"]["key"],
-                        output["args"]["value"],
-                        output["args"].get("from", addr),
-                    )
-                elif output["method"] == "GET":
-                    self.get(output["args"]["key"],
-                             output["args"].get("from", addr))
-                elif output["method"] == "PREDECESSOR":
-                    # Reply with predecessor id
-                    self.send(addr, {"method": "STABILIZE", "args": self.predecessor_id})
-                elif output["method"] == "SUCCESSOR":
-                    # Reply with successor of id
-                    self.get_successor(output["args"])
-                elif output["method"] == "STABILIZE":
-                    # Initiate stabilize protocol
-                    self.stabilize(output["args"], addr)
-                elif output["method"] == "SUCCESSOR_REP":
-                    # Update finger table with requested successor
-                    self.finger_table.update(self.finger_table.getIdxFromId(output["args"]["req_id"]), output["args"]["successor_id"], output["args"]["successor_addr"])
-
-            else:  # timeout occurred, lets run the stabilize algorithm
-                # Ask successor for predecessor, to start the stabilize process
-                self.send(self.successor_addr, {"method": "PREDECESSOR"})
+            self.deliver(output, addr)
+
+        for worker in workers:
+            self.requests.put(None)
+        for worker in workers:
+            worker.join()
+        self.keystore.close()
+        self.socket.close()
+
+    def maintain(self):
+        """Send the JOIN_REQ, run the stabilize rounds that are due, expire quorum requests and resend transfers.
+
+        Virtual nodes join one after the other, each through dht_address.
+        Stabilize runs on a timer, not when the socket goes quiet, so busy
+        nodes do it too. Returns the seconds until something is due again.
+        """
+        nodes = list(self.vnodes.values())
+        waiting = [node for node in nodes if not node.inside_dht]
+        if waiting and (waiting[0] is not self.joining or self.clock() >= self.join_at):
+            self.joining, self.join_at = waiting[0], self.clock() + self.timeout
+            join_msg = {
+                "method": "JOIN_REQ",
+                "args": {"addr": self.joining.addr, "id": self.joining.identification, "m_bits": self.m_bits},
+            }
+            self.joining.send(self.joining.dht_address, join_msg)
+
+        waits = [self.timeout]
+        for node in nodes:
+            if node.inside_dht:
+                if node.scheduler.due():
+                    node.tick()
+                node.expire_requests()
+                node.retry_transfers()
+                waits.append(node.check_successor())
+                pong = node.check_fingers()
+                if pong is not None:
+                    waits.append(pong)
+                waits.append(node.scheduler.wait())
+        if waiting:
+            waits.append(max(self.join_at - self.clock(), 0.001))
+        return min(waits)
+
+    def deliver(self, output, addr):
+        """Hand a message received from addr to the virtual node it is for.
+
+        Client requests go to the worker pool if there is one, the rest is
+        handled right away on the node thread. A message that fails to be
+        handled (fields missing, of the wrong type) is logged and dropped,
+        as in the workers, so the node thread goes on.
+        """
+        if "from_vnode" in output:
+            addr = tuple(addr[:2]) + (output.pop("from_vnode"),)
+        vnode = output.pop("vnode", 0)
+        node = self.vnodes.get(vnode) if isinstance(vnode, int) else None
+        if node is None:
+            self.logger.warning("No virtual node for %s", output)
+            return
+        if not node.inside_dht:
+            # nobody knows about a node outside the DHT, only its JOIN_REP is expected
+            if output["method"] == "JOIN_REP":
+                try:
+                    node.joined(output["args"])
+                except Exception:
+                    self.logger.exception("Failed to handle %s", output)
+            return
+        if self.workers and output["method"] in WORKER_METHODS:
+            try:
+                self.requests.put_nowait((node, output, addr))
+            except queue.Full:
+                # like a full socket buffer: the client retries, ring upkeep goes on
+                self.logger.warning("Request queue full, dropping %s", output["method"])
+                self.metrics.drop(output["method"])
+        else:
+            start = time.perf_counter()
+            try:
+                node.handle(output, addr)
+            except Exception:
+                self.logger.exception("Failed to handle %s", output)
+            self.metrics.observe(output["method"], time.perf_counter() - start)
+
+    def work(self):
+        """Worker thread: handle queued client requests until given None."""
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            node, output, addr = item
+            start = time.perf_counter()
+            try:
+                node.handle(output, addr)
+            except Exception:
+                self.logger.exception("Failed to handle %s", output)
+            self.metrics.observe(output["method"], time.perf_counter() - start)
+
+    def stats(self):
+        """Metrics of this node (all its virtual nodes) plus gauges read right now.
+
+        Finger ages are the seconds since a lookup last confirmed each finger.
+        """
+        nodes = list(self.vnodes.values())
+        now = self.clock()
+        ages = [now - checked for node in nodes for checked in node.finger_checked]
+        stats = self.metrics.snapshot()
+        stats["node"] = self.identification
+        stats["gauges"] = {
+            "keys": len(self.keystore),
+            "replica_keys": sum(len(node.replica_store) for node in nodes),
+            "pending_writes": sum(len(node.pending_writes) for node in nodes),
+            "pending_reads": sum(len(node.pending_reads) for node in nodes),
+            "pending_transfers": sum(len(node.pending_transfers) for node in nodes),
+            "queue_depth": self.requests.qsize(),
+            "vnodes": len(nodes),
+            "finger_age_max_seconds": max(ages),
+            "finger_age_mean_seconds": sum(ages) / len(ages),
+            "ring_share": self.ring_share(),
+        }
+        if self.cache is not None:
+            stats["cache"] = {"hits": self.cache.hits, "misses": self.cache.misses}
+            stats["gauges"]["cache_entries"] = len(self.cache)
+        return stats
+
+    def ring_share(self):
+        """Fraction of the ring, hence of the keys, owned by the virtual nodes of this host."""
+        owned = 0
+        for node in list(self.vnodes.values()):
+            if node.successor_id == node.identification:
+                return 1.0  # alone in the DHT
+            if node.predecessor_id is not None:
+                owned += (node.identification - node.predecessor_id) % self.maximum
+        return owned / self.maximum
+
+    def handle(self, output, addr):
+        """Dispatch a message received from addr to its handler."""
+        if output["method"] == "JOIN_REQ":
+            self.node_join(output["args"])
+        elif output["method"] == "NOTIFY":
+            self.notify(output["args"])
+        elif output["method"] == "PUT":
+            self.put(
+                output["args"]["key"],
+                output["args"]["value"],
+                output["args"].get("from", addr),
+                output["args"].get("request_id"),
+            )
+        elif output["method"] == "GET":
+            self.get(output["args"]["key"],
+                     output["args"].get("from", addr),
+                     output["args"].get("request_id"),
+                     output["args"].get("replica", False),
+                     output["args"].get("owner"),
+                     output["args"].get("via"))
+        elif output["method"] == "TRANSFER":
+            self.receive_transfer(output["args"], addr)
+        elif output["method"] == "TRANSFER_ACK":
+            self.transfer_done(output["args"])
+        elif output["method"] == "LEAVE":
+            self.node_leave(output["args"])
+        elif output["method"] == "REPLICATE":
+            self.store_replica(output["args"])
+        elif output["method"] == "REPLICATE_ACK":
+            self.replica_stored(output["args"])
+        elif output["method"] == "GET_REPLICA":
+            found, value = self.local_value(output["args"]["key"])
+            args = {"token": output["args"]["token"], "found": found, "value": value}
+            self.send(output["args"]["from"], {"method": "GET_REPLICA_REP", "args": args})
+        elif output["method"] == "GET_REPLICA_REP":
+            self.replica_read(output["args"])
+        elif output["method"] == "PUT_MANY":
+            self.put_many(output["args"]["items"],
+                          output["args"].get("from", addr),
+                          output["args"].get("request_id"))
+        elif output["method"] == "GET_MANY":
+            self.get_many(output["args"]["keys"],
+                          output["args"].get("from", addr),
+                          output["args"].get("request_id"))
+        elif output["method"] == "PREDECESSOR":
+            # Reply with predecessor id (plus its address and my successors)
+            self.send(addr, {
+                "method": "STABILIZE",
+                "args": self.predecessor_id,
+                "predecessor_addr": self.predecessor_addr,
+                "successors": self.successor_list,
+                "id": self.identification,
+            })
+        elif output["method"] == "SUCCESSOR":
+            # Reply with successor of id
+            self.get_successor(output["args"])
+        elif output["method"] == "STABILIZE":
+            # Initiate stabilize protocol
+            self.stabilize(output["args"], addr,
+                           output.get("predecessor_addr"),
+                           output.get("successors", ()),
+                           output.get("id"))
+        elif output["method"] == "SUCCESSOR_REP":
+            # Update finger table with requested successor
+            self.fix_finger(output["args"])
+        elif output["method"] == "FINGER_HINT":
+            self.finger_hint(output["args"])
+        elif output["method"] == "FINGER_FAILED":
+            self.finger_failed(output["args"])
+        elif output["method"] == "PING":
+            self.send(addr, {"method": "PONG", "args": {"id": self.identification}})
+        elif output["method"] == "PONG":
+            self.pings.pop(output["args"]["id"], None)
+        elif output["method"] == "CACHE":
+            # value found by a GET I forwarded
+            if self.cache is not None:
+                self.cache.put(output["args"]["key"], output["args"]["value"])
+        elif output["method"] == "SCAN":
+            self.scan(
+                output["args"].get("token"),
+                max(1, output["args"].get("limit", SCAN_LIMIT)),
+                output["args"].get("from", addr),
+                output["args"].get("request_id"),
+            )
+        elif output["method"] == "STATS":
+            args = output.get("args") or {}
+            stats = self.host.stats()
+            if args.get("format") == "prometheus":
+                stats = prometheus(stats)
+            self.reply(args.get("from", addr), {"method": "STATS_REP", "args": stats}, args.get("request_id"), {})
 
     def __str__(self):
         return "Node ID: {}; DHT: {}; Successor: {}; Predecessor: {}; FingerTable: {}".format(
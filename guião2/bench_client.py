@@ -0,0 +1,64 @@
+""" Throughput benchmark of DHTClient vs AsyncDHTClient against a running ring.
+
+Start the ring first (python3 DHT.py) and wait for it to stabilize.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+from DHTClient import DHTClient
+from AsyncDHTClient import AsyncDHTClient
+
+
+def bench_sync(address, keys):
+    client = DHTClient(address)
+    start = time.perf_counter()
+    for key in keys:
+        client.put(key, key)
+    put_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for key in keys:
+        client.get(key)
+    return put_time, time.perf_counter() - start
+
+
+async def bench_async(address, keys, in_flight, timeout):
+    async with AsyncDHTClient(address, timeout=timeout, max_in_flight=in_flight) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(client.put(key, key) for key in keys))
+        put_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        values = await asyncio.gather(*(client.get(key) for key in keys))
+        get_time = time.perf_counter() - start
+    assert values == keys, "lost or mismatched replies"
+    return put_time, get_time
+
+
+def main(address, number, in_flight, timeout):
+    # fresh keys every run, PUT of an existing key is a NACK
+    prefix = uuid.uuid4().hex[:8]
+    print("{:>22} {:>12} {:>12}".format("client", "PUT ops/s", "GET ops/s"))
+
+    keys = ["{}-sync-{}".format(prefix, i) for i in range(number)]
+    put_time, get_time = bench_sync(address, keys)
+    print("{:>22} {:>12.0f} {:>12.0f}".format("DHTClient", number / put_time, number / get_time))
+
+    for window in in_flight:
+        keys = ["{}-async{}-{}".format(prefix, window, i) for i in range(number)]
+        put_time, get_time = asyncio.run(bench_async(address, keys, window, timeout))
+        print("{:>22} {:>12.0f} {:>12.0f}".format(
+            "AsyncDHTClient ({})".format(window), number / put_time, number / get_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--in-flight", type=int, nargs="+", default=[1, 16, 256, 4096])
+    parser.add_argument("--timeout", type=float, default=1.0)
+    args = parser.parse_args()
+
+    main((args.host, args.port), args.number, args.in_flight, args.timeout)
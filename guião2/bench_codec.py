@@ -0,0 +1,44 @@
+""" Encode/decode benchmark: binary codec vs the old pickle path. """
+import argparse
+import pickle
+import timeit
+from codec import encode, decode
+
+MESSAGES = {
+    "SUCCESSOR": {"method": "SUCCESSOR", "args": {"id": 709, "from": ("localhost", 4000)}},
+    "PUT": {"method": "PUT", "args": {"key": "10", "value": "Aveiro", "from": ("localhost", 40000), "request_id": 1}},
+    "ACK": {"method": "ACK", "args": [0, 1, 2], "request_id": 7},
+    "STABILIZE": {"method": "STABILIZE", "args": 654, "predecessor_addr": ("localhost", 5004),
+                  "successors": [(770, ("localhost", 5000)), (895, ("localhost", 6000))]},
+    "PUT 8KB": {"method": "PUT", "args": {"key": "blob", "value": "x" * 8192, "from": ("localhost", 40000)}},
+    "PUT_MANY x100": {"method": "PUT_MANY", "args": {
+        "items": {"key-%d" % i: "value-%d" % i for i in range(100)}, "from": ("localhost", 40000)}},
+}
+
+
+def main(number):
+    print("{:>14} {:>6} {:>6} {:>10} {:>10} {:>10} {:>10}".format(
+        "message", "pickle", "codec", "pickle enc", "codec enc", "pickle dec", "codec dec"))
+    for name, msg in MESSAGES.items():
+        pickled = pickle.dumps(msg)
+        encoded = encode(msg)
+        assert decode(encoded) == msg
+
+        timings = [
+            timeit.timeit(lambda: pickle.dumps(msg), number=number),
+            timeit.timeit(lambda: encode(msg), number=number),
+            timeit.timeit(lambda: pickle.loads(pickled), number=number),
+            timeit.timeit(lambda: decode(encoded), number=number),
+        ]
+        # microseconds per message
+        per_op = [t / number * 1e6 for t in timings]
+        print("{:>14} {:>5}B {:>5}B {:>8.2f}us {:>8.2f}us {:>8.2f}us {:>8.2f}us".format(
+            name, len(pickled), len(encoded), *per_op))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    main(args.number)
@@ -0,0 +1,70 @@
+""" Microbenchmark: linear finger table scan vs bisect over precomputed boundaries. """
+import argparse
+import random
+import timeit
+from DHTNode import FingerTable
+from utils import contains
+
+
+def linear_find(table, identification):
+    """Reference closest preceding finger lookup (one contains() per entry)."""
+    for i in range(table.max_size):
+        if contains(table.node_id, table.finger_table[i][0], identification):
+            return table.finger_table[i-1][1]
+    return table.finger_table[table.max_size - 1][1]
+
+
+def linear_idx(table, identification):
+    """Reference finger index lookup (recomputes n + 2^i mod 2^m every call)."""
+    results = []
+    for i in range(table.max_size):
+        results.append((table.node_id + pow(2, i)) % pow(2, table.max_size))
+    for i in range(table.max_size):
+        if contains(table.node_id, results[i], identification):
+            return i + 1
+
+
+def build_table(m_bits, nodes, rng):
+    """Finger table of a random node in a random ring of `nodes` members."""
+    ring = sorted(rng.sample(range(pow(2, m_bits)), nodes)) if m_bits < 63 else \
+        sorted(rng.getrandbits(m_bits) for _ in range(nodes))
+    node_id = ring[0]
+    table = FingerTable(node_id, ("localhost", 5000), m_bits)
+    for i, start in enumerate(table.starts):
+        # successor of start in the ring
+        succ = next((n for n in ring if n >= start), ring[0])
+        table.update(i + 1, succ, ("localhost", 5000 + ring.index(succ)))
+    return table
+
+
+def main(number, nodes, seed):
+    rng = random.Random(seed)
+    print("{:>5} {:>14} {:>14} {:>14} {:>14}".format(
+        "m", "find linear", "find bisect", "idx linear", "idx bisect"))
+    for m_bits in (10, 32, 160):
+        table = build_table(m_bits, min(nodes, pow(2, m_bits)), rng)
+        ids = [rng.getrandbits(m_bits) for _ in range(1000)]
+
+        for ident in ids:
+            assert linear_find(table, ident) == table.find(ident)
+            assert linear_idx(table, ident) == table.getIdxFromId(ident)
+
+        timings = [
+            timeit.timeit(lambda: [linear_find(table, i) for i in ids], number=number),
+            timeit.timeit(lambda: [table.find(i) for i in ids], number=number),
+            timeit.timeit(lambda: [linear_idx(table, i) for i in ids], number=number),
+            timeit.timeit(lambda: [table.getIdxFromId(i) for i in ids], number=number),
+        ]
+        # microseconds per lookup
+        per_op = [t / (number * len(ids)) * 1e6 for t in timings]
+        print("{:>5} {:>12.2f}us {:>12.2f}us {:>12.2f}us {:>12.2f}us".format(m_bits, *per_op))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20)
+    parser.add_argument("--nodes", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.number, args.nodes, args.seed)
@@ -0,0 +1,183 @@
+""" Lookup hops, stabilization time and churn of simulated Chord rings (see simulator.py).
+
+Everything runs in virtual time, so rings far larger than the ports of one
+machine allow are measured in seconds and every run with the same seed
+gives the same figures.
+"""
+import argparse
+import logging
+import math
+from simulator import Simulator
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def lookups(sizes, number, seed, settings):
+    """Hop count and messages per lookup on converged rings of each size."""
+    print("{:>7} {:>9} {:>6} {:>6} {:>6} {:>6} {:>10} {:>10}".format(
+        "nodes", "log2(n)/2", "hops", "p50", "p99", "max", "msgs/op", "latency"))
+    for size in sizes:
+        sim = Simulator(seed=seed, **settings)
+        sim.build(size)
+        requests = [sim.put("key{}".format(i), i) for i in range(number)]
+        sim.run(5)
+        requests += [sim.get("key{}".format(i)) for i in range(number)]
+        sim.run(5)
+        done = [request for request in requests if request.reply is not None]
+        hops = [request.hops for request in done]
+        print("{:>7} {:>9.1f} {:>6.2f} {:>6} {:>6} {:>6} {:>10.2f} {:>8.1f}ms".format(
+            size, math.log2(size) / 2, sum(hops) / len(hops), percentile(hops, 0.5), percentile(hops, 0.99),
+            max(hops), sum(request.messages for request in done) / len(done),
+            1000 * sum(request.latency for request in done) / len(done)))
+
+
+def convergence(sizes, interval, seed, settings):
+    """Time for rings grown by joins (one every interval seconds) to converge."""
+    print("{:>7} {:>12} {:>12} {:>12}".format("nodes", "successors", "fingers", "messages"))
+    for size in sizes:
+        sim = Simulator(seed=seed, **settings)
+        sim.add_node()
+        for _ in range(size - 1):
+            sim.run(interval)
+            sim.add_node()
+        successors = sim.run_until(sim.converged, 600)
+        fingers = sim.run_until(lambda: sim.converged(fingers=True), 600)
+        print("{:>7} {:>11}s {:>11}s {:>12}".format(
+            size, "-" if successors is None else round(successors, 1),
+            "-" if fingers is None else round(successors + fingers, 1), sum(sim.delivered.values())))
+
+
+def churn(size, rates, duration, number, seed, settings):
+    """Share of lookups answered right while rate hosts join and rate others leave every second."""
+    print("{:>7} {:>10} {:>10} {:>8} {:>10}".format("rate/s", "answered", "correct", "hops", "dropped"))
+    for rate in rates:
+        sim = Simulator(seed=seed, **settings)
+        sim.build(size)
+        keys = ["key{}".format(i) for i in range(number)]
+        for key in keys:
+            sim.put(key, key)
+        sim.run(5)
+        dropped = sim.dropped
+        requests = []
+        for second in range(duration):
+            for _ in range(rate):
+                sim.add_node()
+                sim.leave(sim.rng.choice(sim.alive))
+            requests += [sim.get(sim.rng.choice(keys)) for _ in range(number // duration)]
+            sim.run(1)
+        sim.run(10)
+        done = [request for request in requests if request.reply is not None]
+        correct = [request for request in done
+                   if request.reply["method"] == "ACK" and request.reply["args"] == request.key]
+        print("{:>7} {:>9.1f}% {:>9.1f}% {:>8.2f} {:>10}".format(
+            rate, 100 * len(done) / len(requests), 100 * len(correct) / len(requests),
+            sum(request.hops for request in done) / max(len(done), 1), sim.dropped - dropped))
+
+
+def crashes(size, rates, duration, number, seed, settings):
+    """Lookups while rate hosts crash and rate others join every second.
+
+    Crashed nodes are only noticed through missed heartbeats; until then
+    lookups sent their way are lost (the simulated clients do not retry).
+    repaired is the time the ring takes to point every node at its true
+    successor and predecessor once the crashes stop.
+    """
+    print("{:>7} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "rate/s", "answered", "correct", "p50", "p99", "max", "repaired"))
+    for rate in rates:
+        sim = Simulator(seed=seed, **settings)
+        sim.build(size)
+        keys = ["key{}".format(i) for i in range(number)]
+        for key in keys:
+            sim.put(key, key)
+        sim.run(5)
+        requests = []
+        for second in range(duration):
+            for _ in range(rate):
+                sim.add_node()
+                sim.crash(sim.rng.choice(sim.alive))
+            requests += [sim.get(sim.rng.choice(keys)) for _ in range(number // duration)]
+            sim.run(1)
+        # a join through a host that crashed meanwhile never completes
+        for host in list(sim.alive):
+            if not host.inside_dht and sim.hosts[host.dht_address].done:
+                sim.crash(host)
+        repaired = sim.run_until(sim.converged, 120)
+        done = [request for request in requests if request.reply is not None]
+        correct = [request for request in done
+                   if request.reply["method"] == "ACK" and request.reply["args"] == request.key]
+        latencies = [request.latency for request in done] or [0]
+        print("{:>7} {:>9.1f}% {:>9.1f}% {:>8.1f}ms {:>8.1f}ms {:>8.1f}ms {:>9}s".format(
+            rate, 100 * len(done) / len(requests), 100 * len(correct) / len(requests),
+            1000 * percentile(latencies, 0.5), 1000 * percentile(latencies, 0.99), 1000 * max(latencies),
+            "-" if repaired is None else round(repaired, 1)))
+
+
+def hot_keys(size, caches, keys, duration, number, seed, settings):
+    """Zipf-skewed GETs (the i-th most popular of keys drawn with weight 1/i) with each read cache size.
+
+    Requests enter at random nodes, number of them spread over duration
+    seconds. load is the most GETs a single node received; msgs/op leaves
+    out the CACHE messages handing values back along the paths, counted apart.
+    """
+    print("{:>7} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+        "cache", "hops", "msgs/op", "load", "hit rate", "CACHE", "latency"))
+    names = ["key{}".format(i) for i in range(keys)]
+    weights = [1 / (i + 1) for i in range(keys)]
+    for cache in caches:
+        sim = Simulator(seed=seed, cache=cache, **settings)
+        sim.build(size)
+        for key in names:
+            sim.put(key, key)
+        sim.run(5)
+        requests = []
+        for _ in range(duration * 10):
+            requests += [sim.get(key) for key in sim.rng.choices(names, weights, k=number // (duration * 10))]
+            sim.run(0.1)
+        sim.run(5)
+        done = [request for request in requests if request.reply is not None]
+        hits = sum(host.cache.hits for host in sim.alive) if cache else 0
+        misses = sum(host.cache.misses for host in sim.alive) if cache else 0
+        print("{:>7} {:>8.2f} {:>8.2f} {:>10} {:>9.1f}% {:>10} {:>8.1f}ms".format(
+            cache, sum(request.hops for request in done) / len(done),
+            sum(request.messages for request in done) / len(done),
+            max(host.metrics.received["GET"] for host in sim.alive), 100 * hits / max(hits + misses, 1),
+            sim.delivered["CACHE"],
+            1000 * sum(request.latency for request in done) / len(done)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--lookups", type=int, default=1000)
+    parser.add_argument("--grow", type=int, nargs="+", default=[10, 50, 200], help="ring sizes built by joins")
+    parser.add_argument("--join-interval", type=float, default=0.05)
+    parser.add_argument("--churn-nodes", type=int, default=500)
+    parser.add_argument("--churn-rates", type=int, nargs="+", default=[0, 1, 2, 5])
+    parser.add_argument("--duration", type=int, default=30, help="seconds of churn")
+    parser.add_argument("--crash-rates", type=int, nargs="+", default=[0, 1, 2, 5])
+    parser.add_argument("--crash-replicas", type=int, default=2, help="copies keeping keys of crashed nodes")
+    parser.add_argument("--caches", type=int, nargs="+", default=[0, 10, 100], help="read cache sizes")
+    parser.add_argument("--hot-keys", type=int, default=1000, help="keys read with a Zipf skew")
+    parser.add_argument("--bits", type=int, default=32)
+    parser.add_argument("--vnodes", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # leaving nodes do not wait for their transfers to be acknowledged
+    logging.basicConfig(level=logging.ERROR)
+    settings = {"m_bits": args.bits, "vnodes": args.vnodes}
+    print("Lookups on converged rings")
+    lookups(args.sizes, args.lookups, args.seed, settings)
+    print("\nStabilization of rings grown by joins")
+    convergence(args.grow, args.join_interval, args.seed, settings)
+    print("\nLookups under churn ({} nodes, graceful leaves)".format(args.churn_nodes))
+    churn(args.churn_nodes, args.churn_rates, args.duration, args.lookups, args.seed, settings)
+    print("\nLookups under churn ({} nodes, crashes, {} replicas)".format(args.churn_nodes, args.crash_replicas))
+    crashes(args.churn_nodes, args.crash_rates, args.duration, args.lookups, args.seed,
+            dict(settings, replicas=args.crash_replicas))
+    print("\nSkewed reads ({} nodes, {} keys, read cache size)".format(args.churn_nodes, args.hot_keys))
+    hot_keys(args.churn_nodes, args.caches, args.hot_keys, args.duration, 10 * args.lookups, args.seed, settings)
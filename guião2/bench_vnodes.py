@@ -0,0 +1,47 @@
+""" Load imbalance (max / mean keys per node) of rings with k virtual nodes per node.
+
+No network: the ids are the ones DHTNode would take, each key goes to the
+node owning the first id at or after its hash. Every ring is the same
+number of nodes on different ports, so the figures are averaged over as
+many rings.
+"""
+import argparse
+from bisect import bisect_left
+from DHTNode import virtual_addresses
+from utils import dht_hash, dht_hash_many, load_imbalance, ring_size
+
+
+def imbalance(ports, vnodes, key_hashes, maximum):
+    """load_imbalance() of the keys stored per node with vnodes ids each."""
+    owner = {}  # id -> port of the node taking it
+    for port in ports:
+        for address in virtual_addresses(("localhost", port), vnodes, maximum):
+            # the DHT refuses an id that is taken, the first node keeps it
+            owner.setdefault(dht_hash(str(address), maximum=maximum), port)
+    ids = sorted(owner)
+    load = dict.fromkeys(ports, 0)
+    for key_hash in key_hashes:
+        load[owner[ids[bisect_left(ids, key_hash) % len(ids)]]] += 1
+    return load_imbalance(load.values())
+
+
+def main(nodes, vnodes, rings, keys, m_bits):
+    maximum = ring_size(m_bits)
+    key_hashes = dht_hash_many([str(i) for i in range(keys)], maximum=maximum)
+    print("{:>7} {:>10} {:>10}".format("vnodes", "mean", "worst"))
+    for count in vnodes:
+        figures = [imbalance(range(5000 + 100 * ring, 5000 + 100 * ring + nodes), count, key_hashes, maximum)
+                   for ring in range(rings)]
+        print("{:>7} {:>10.2f} {:>10.2f}".format(count, sum(figures) / rings, max(figures)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=5)
+    parser.add_argument("--vnodes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--rings", type=int, default=50)
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--bits", type=int, default=10)
+    args = parser.parse_args()
+
+    main(args.nodes, args.vnodes, args.rings, args.keys, args.bits)
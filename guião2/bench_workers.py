@@ -0,0 +1,67 @@
+""" Requests per second of a single node for different worker pool sizes.
+
+Starts its own one-node DHT for each pool size and loads it with
+AsyncDHTClient. --delay simulates a slow keystore (e.g. on disk); with 0
+all the work is Python code and the GIL keeps the workers from running at
+the same time.
+"""
+import argparse
+import asyncio
+import time
+from AsyncDHTClient import AsyncDHTClient
+from DHTNode import DHTNode
+from storage import DictStore
+
+
+class SlowStore(DictStore):
+    """In-memory keystore whose writes take delay seconds."""
+
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    def __setitem__(self, key, value):
+        time.sleep(self.delay)
+        super().__setitem__(key, value)
+
+
+async def load(address, number, in_flight):
+    async with AsyncDHTClient(address, timeout=5, max_in_flight=in_flight) as client:
+        keys = [str(i) for i in range(number)]
+        start = time.perf_counter()
+        stored = await asyncio.gather(*(client.put(key, key) for key in keys))
+        put_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        values = await asyncio.gather(*(client.get(key) for key in keys))
+        get_time = time.perf_counter() - start
+    assert all(stored) and values == keys, "lost or mismatched replies"
+    return put_time, get_time
+
+
+def main(port, number, workers, in_flight, delay):
+    print("{:>8} {:>12} {:>12}".format("workers", "PUT req/s", "GET req/s"))
+    for count in workers:
+        address = ("localhost", port + count)
+        node = DHTNode(address, timeout=0.5, keystore=SlowStore(delay), workers=count,
+                       queue_size=max(in_flight, 1024))
+        node.start()
+        time.sleep(0.2)
+        try:
+            put_time, get_time = asyncio.run(load(address, number, in_flight))
+        finally:
+            node.done = True
+            node.join()
+        print("{:>8} {:>12.0f} {:>12.0f}".format(count, number / put_time, number / get_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=5700)
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4, 8, 16])
+    parser.add_argument("--in-flight", type=int, default=64, help="more may overflow the socket buffer")
+    parser.add_argument("--delay", type=float, default=0.001, help="seconds per keystore write")
+    args = parser.parse_args()
+
+    main(args.port, args.number, args.workers, args.in_flight, args.delay)
@@ -0,0 +1,61 @@
+""" Bounded cache of values a node forwards GETs for, so hot keys are answered before reaching their owner. """
+import threading
+import time
+from collections import OrderedDict
+
+
+class ReadCache:
+    """Least recently used key -> value entries, each dropped ttl seconds after it was stored.
+
+    Only values a GET was answered with (ACK) are cached: keys are never
+    overwritten, so such a value stays right while the key is in the DHT.
+    A miss is not, a later PUT may store the key. A key lost with a crashed
+    owner may be stored again with another value: PUTs passing by discard
+    it, the ttl bounds how long the others serve the old one. Used by the
+    node thread and the workers, hence the lock.
+    """
+
+    def __init__(self, size, ttl, clock=time.monotonic):
+        """
+        Parameters:
+            size: most entries kept, the least recently used go first
+            ttl: seconds an entry is served for
+            clock: time source in seconds
+        """
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (value, expiry), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """(found, value) of key, counted as a hit or a miss."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= self.clock():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, value):
+        """Cache value of key for ttl seconds, evicting the least recently used entry if full."""
+        with self.lock:
+            self.entries[key] = (value, self.clock() + self.ttl)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        """Drop the entry of key, if any."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,342 @@
+""" Binary wire format of DHT messages (replaces pickle).
+
+Every datagram starts with a version byte and a kind byte:
+
+    MESSAGE   B version | B kind | B method | body
+    FRAGMENT  B version | B kind | I msg_id | H index | H count | chunk
+
+The body is the message without its "method", written as a typed value:
+one tag byte followed by a fixed layout (ints, floats, addresses) or a
+length prefix (strings, bytes, containers). Messages that do not fit in one
+datagram are cut into FRAGMENTs of the encoded MESSAGE and put back together
+by a Reassembler on the receiving side.
+"""
+import struct
+import time
+from utils import DATAGRAM_SIZE
+
+VERSION = 1
+
+MESSAGE = 0
+FRAGMENT = 1
+
+# method name <-> code, only ever append (codes are on the wire)
+METHODS = [
+    "JOIN_REQ", "JOIN_REP", "NOTIFY", "PUT", "GET", "PREDECESSOR", "SUCCESSOR",
+    "STABILIZE", "SUCCESSOR_REP", "ACK", "NACK",
+    "PUT_MANY", "GET_MANY", "PUT_MANY_REP", "GET_MANY_REP",
+    "REPLICATE", "REPLICATE_ACK", "GET_REPLICA", "GET_REPLICA_REP",
+    "TRANSFER", "TRANSFER_ACK", "LEAVE",
+    "FINGER_HINT", "STATS", "STATS_REP", "SCAN", "SCAN_REP",
+    "FINGER_FAILED", "PING", "PONG", "CACHE",
+]
+METHOD_CODES = {name: code for code, name in enumerate(METHODS)}
+
+HEADER = struct.Struct(">BBB")
+FRAGMENT_HEADER = struct.Struct(">BBIHH")
+INT = struct.Struct(">i")
+UINT = struct.Struct(">I")
+FLOAT = struct.Struct(">d")
+PORT = struct.Struct(">H")
+
+# containers nested deeper than this are refused, so a hostile datagram cannot exhaust the stack
+MAX_DEPTH = 64
+
+# value tags
+NONE, TRUE, FALSE = b"N", b"T", b"F"
+SMALL_INT, BIG_INT, FLOAT_TAG = b"i", b"I", b"d"
+STR, BYTES = b"s", b"b"
+LIST, TUPLE, DICT = b"l", b"t", b"m"
+ADDR = b"a"  # (host, port) tuple: B host length | host | H port
+# the same tags as ints, which is what indexing the received bytes yields
+(_NONE, _TRUE, _FALSE, _SMALL_INT, _BIG_INT, _FLOAT, _STR, _BYTES,
+ _LIST, _TUPLE, _DICT, _ADDR) = (ord(tag) for tag in (
+    NONE, TRUE, FALSE, SMALL_INT, BIG_INT, FLOAT_TAG, STR, BYTES, LIST, TUPLE, DICT, ADDR))
+
+
+class CodecError(ValueError):
+    """Datagram that is not a valid message of this version."""
+
+
+def _is_addr(value):
+    return (len(value) == 2 and type(value[0]) is str and type(value[1]) is int
+            and 0 <= value[1] <= 0xFFFF and len(value[0]) < 256)
+
+
+def _write(out, value, depth=0):
+    """Append the typed encoding of value to the bytearray out."""
+    kind = type(value)
+    if kind is str:
+        data = value.encode("utf-8")
+        out += STR
+        out += UINT.pack(len(data))
+        out += data
+    elif kind is int:
+        if -0x80000000 <= value <= 0x7FFFFFFF:
+            out += SMALL_INT
+            out += INT.pack(value)
+        else:
+            # ring ids go up to 160 bits
+            data = value.to_bytes((value.bit_length() + 8) // 8, "big", signed=True)
+            if len(data) > 0xFF:
+                raise CodecError("integer of {} bytes is too large".format(len(data)))
+            out += BIG_INT
+            out.append(len(data))
+            out += data
+    elif value is None:
+        out += NONE
+    elif kind is bool:
+        out += TRUE if value else FALSE
+    elif kind is tuple:
+        if _is_addr(value):
+            host = value[0].encode("utf-8")
+            out += ADDR
+            out.append(len(host))
+            out += host
+            out += PORT.pack(value[1])
+        else:
+            _check_depth(depth)
+            out += TUPLE
+            out += UINT.pack(len(value))
+            for item in value:
+                _write(out, item, depth + 1)
+    elif kind is dict:
+        _check_depth(depth)
+        out += DICT
+        out += UINT.pack(len(value))
+        for key, item in value.items():
+            _write(out, key, depth + 1)
+            _write(out, item, depth + 1)
+    elif kind is list:
+        _check_depth(depth)
+        out += LIST
+        out += UINT.pack(len(value))
+        for item in value:
+            _write(out, item, depth + 1)
+    elif kind is float:
+        out += FLOAT_TAG
+        out += FLOAT.pack(value)
+    elif kind is bytes or kind is bytearray:
+        out += BYTES
+        out += UINT.pack(len(value))
+        out += value
+    else:
+        raise CodecError("cannot encode {}".format(kind.__name__))
+
+
+def _check_depth(depth):
+    if depth >= MAX_DEPTH:
+        raise CodecError("containers nested deeper than {}".format(MAX_DEPTH))
+
+
+def _read(data, pos, depth=0):
+    """Decode the value at data[pos:], return it and the position after it."""
+    tag = data[pos]
+    pos += 1
+    if tag == _STR:
+        size = UINT.unpack_from(data, pos)[0]
+        pos += 4
+        return str(data[pos:pos + size], "utf-8"), pos + size
+    if tag == _SMALL_INT:
+        return INT.unpack_from(data, pos)[0], pos + 4
+    if tag == _ADDR:
+        size = data[pos]
+        pos += 1 + size
+        return (str(data[pos - size:pos], "utf-8"), PORT.unpack_from(data, pos)[0]), pos + 2
+    if tag == _NONE:
+        return None, pos
+    if tag == _DICT:
+        _check_depth(depth)
+        count = UINT.unpack_from(data, pos)[0]
+        pos += 4
+        value = {}
+        for _ in range(count):
+            key, pos = _read(data, pos, depth + 1)
+            value[key], pos = _read(data, pos, depth + 1)
+        return value, pos
+    if tag == _LIST or tag == _TUPLE:
+        _check_depth(depth)
+        count = UINT.unpack_from(data, pos)[0]
+        pos += 4
+        items = []
+        for _ in range(count):
+            item, pos = _read(data, pos, depth + 1)
+            items.append(item)
+        return (items if tag == _LIST else tuple(items)), pos
+    if tag == _TRUE:
+        return True, pos
+    if tag == _FALSE:
+        return False, pos
+    if tag == _BIG_INT:
+        size = data[pos]
+        return int.from_bytes(data[pos + 1:pos + 1 + size], "big", signed=True), pos + 1 + size
+    if tag == _FLOAT:
+        return FLOAT.unpack_from(data, pos)[0], pos + 8
+    if tag == _BYTES:
+        size = UINT.unpack_from(data, pos)[0]
+        pos += 4
+        return bytes(data[pos:pos + size]), pos + size
+    raise CodecError("unknown tag {!r}".format(chr(tag)))
+
+
+def dump(value):
+    """Typed encoding of a single value (e.g. a stored DHT value)."""
+    out = bytearray()
+    _write(out, value)
+    return bytes(out)
+
+
+def load(data):
+    """Value encoded by dump()."""
+    try:
+        value, pos = _read(data, 0)
+    except (struct.error, IndexError, TypeError, UnicodeDecodeError) as err:
+        raise CodecError("malformed value: {}".format(err))
+    if pos != len(data):
+        raise CodecError("{} trailing bytes".format(len(data) - pos))
+    return value
+
+
+def encode(msg):
+    """Encode msg (a dict with a "method") as a MESSAGE frame."""
+    try:
+        method = METHOD_CODES[msg["method"]]
+    except KeyError:
+        raise CodecError("unknown method {!r}".format(msg.get("method")))
+    out = bytearray(HEADER.pack(VERSION, MESSAGE, method))
+    _write(out, {key: value for key, value in msg.items() if key != "method"})
+    return bytes(out)
+
+
+def decode(payload):
+    """Decode a MESSAGE frame back into a message dict."""
+    data = memoryview(payload)
+    try:
+        version, kind, method = HEADER.unpack_from(data, 0)
+        if version != VERSION or kind != MESSAGE:
+            raise CodecError("unsupported frame {}/{}".format(version, kind))
+        msg, pos = _read(data, HEADER.size)
+        msg["method"] = METHODS[method]
+    except (struct.error, IndexError, TypeError, UnicodeDecodeError) as err:
+        raise CodecError("malformed message: {}".format(err))
+    if pos != len(data):
+        raise CodecError("{} trailing bytes".format(len(data) - pos))
+    return msg
+
+
+def fragment(payload, msg_id, size=DATAGRAM_SIZE):
+    """Cut an encoded message into datagrams of at most size bytes."""
+    if len(payload) <= size:
+        return [payload]
+    chunk = size - FRAGMENT_HEADER.size
+    count = (len(payload) + chunk - 1) // chunk
+    if count > 0xFFFF:
+        raise CodecError("message of {} bytes is too large".format(len(payload)))
+    return [
+        FRAGMENT_HEADER.pack(VERSION, FRAGMENT, msg_id & 0xFFFFFFFF, index, count)
+        + payload[index * chunk:(index + 1) * chunk]
+        for index in range(count)
+    ]
+
+
+def pack_batch(msg, field, size=DATAGRAM_SIZE):
+    """ Encode msg into payloads of at most size bytes each.
+
+    msg["args"][field] (a dict or a list) is halved until every part fits;
+    the other fields are copied into every part. A single item that is
+    still too large is left to fragment().
+    """
+    payload = encode(msg)
+    batch = msg["args"][field]
+    if len(payload) <= size or len(batch) <= 1:
+        return [payload]
+    items = list(batch.items()) if isinstance(batch, dict) else batch
+    half = len(items) // 2
+    payloads = []
+    for part in (items[:half], items[half:]):
+        part = dict(part) if isinstance(batch, dict) else part
+        payloads += pack_batch(dict(msg, args=dict(msg["args"], **{field: part})), field, size)
+    return payloads
+
+
+class Reassembler:
+    """Turns received datagrams back into messages, joining fragments.
+
+    What a sender may have waiting is bounded, so fragment headers sprayed
+    at a node cannot take all its memory: a message of more than max_count
+    fragments is refused, and past max_pending incomplete messages or
+    max_bytes buffered for one sender (max_total for all of them) the
+    oldest incomplete ones are dropped.
+    """
+
+    def __init__(self, timeout=5, max_count=256, max_pending=16, max_bytes=16 * 2**20, max_total=64 * 2**20):
+        """timeout: seconds after which an incomplete message is dropped."""
+        self.timeout = timeout
+        self.max_count = max_count
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.max_total = max_total
+        self.partial = {}  # (addr, msg_id) -> [last seen, chunks, bytes], the one fed longest ago first
+        self.senders = {}  # addr -> [incomplete messages, bytes buffered]
+        self.total = 0     # bytes buffered for every sender
+
+    def feed(self, datagram, addr):
+        """Return the message datagram completes, None while fragments are missing."""
+        if len(datagram) >= 2 and datagram[1] == FRAGMENT:
+            try:
+                version, _, msg_id, index, count = FRAGMENT_HEADER.unpack_from(datagram, 0)
+            except struct.error as err:
+                raise CodecError("malformed fragment: {}".format(err))
+            if version != VERSION or index >= count:
+                raise CodecError("invalid fragment {}/{}".format(index, count))
+            if count > self.max_count:
+                raise CodecError("message of {} fragments is too large".format(count))
+            now = time.monotonic()
+            self.expire(now)
+            key = (addr, msg_id)
+            entry = self.partial.pop(key, None)
+            if entry is None:
+                entry = [now, [None] * count, 0]
+                self.senders.setdefault(addr, [0, 0])[0] += 1
+            self.partial[key] = entry  # fed last now
+            if len(entry[1]) != count:
+                raise CodecError("fragment count changed for message {}".format(msg_id))
+            entry[0] = now
+            chunk = datagram[FRAGMENT_HEADER.size:]
+            grown = len(chunk) - len(entry[1][index] or b"")
+            entry[1][index] = chunk
+            entry[2] += grown
+            self.senders[addr][1] += grown
+            self.total += grown
+            if any(chunk is None for chunk in entry[1]):
+                self.limit(addr)
+                return None
+            self.drop(key)
+            datagram = b"".join(entry[1])
+        return decode(datagram)
+
+    def limit(self, addr):
+        """Drop the oldest incomplete messages while addr, or every sender, has too much waiting."""
+        sender = self.senders[addr]
+        while sender[0] > self.max_pending or sender[1] > self.max_bytes:
+            self.drop(next(key for key in self.partial if key[0] == addr))
+        while self.total > self.max_total:
+            self.drop(next(iter(self.partial)))
+
+    def drop(self, key):
+        """Forget incomplete message key."""
+        entry = self.partial.pop(key)
+        sender = self.senders[key[0]]
+        sender[0] -= 1
+        sender[1] -= entry[2]
+        self.total -= entry[2]
+        if sender[0] == 0:
+            del self.senders[key[0]]
+
+    def expire(self, now):
+        """Drop messages whose fragments stopped arriving."""
+        while self.partial:
+            key = next(iter(self.partial))
+            if now - self.partial[key][0] <= self.timeout:
+                break
+            self.drop(key)
@@ -0,0 +1,114 @@
+""" Counters and latency histograms of a DHT node, with a Prometheus text dump. """
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+# upper bounds (seconds) of the handling time histogram buckets, +Inf implied
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+
+class Metrics:
+    """Per-method message counts, handling times and where client requests were answered.
+
+    Updated by the node thread and the workers, hence the lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = Counter()  # method -> messages
+        self.latency = {}  # method -> [count per bucket (last one +Inf), sum of seconds]
+        self.routed = Counter()  # (method, "local" or "forwarded") -> keys
+        self.dropped = Counter()  # method -> messages dropped with the worker queue full
+
+    def observe(self, method, seconds):
+        """Count a message of method that took seconds to handle."""
+        with self.lock:
+            self.received[method] += 1
+            histogram = self.latency.get(method)
+            if histogram is None:
+                histogram = self.latency[method] = [[0] * (len(BUCKETS) + 1), 0.0]
+            histogram[0][bisect_left(BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+
+    def drop(self, method):
+        """Count a message of method dropped before being handled."""
+        with self.lock:
+            self.dropped[method] += 1
+
+    def route(self, method, local, keys=1):
+        """Count keys of a client request answered here (local) or sent on."""
+        with self.lock:
+            self.routed[method, "local" if local else "forwarded"] += keys
+
+    def snapshot(self):
+        """Plain dict of everything counted so far (what STATS sends)."""
+        with self.lock:
+            return {
+                "received": dict(self.received),
+                "dropped": dict(self.dropped),
+                "latency": {
+                    method: {"buckets": list(buckets), "sum": total}
+                    for method, (buckets, total) in self.latency.items()
+                },
+                "routed": {method: {"local": self.routed[method, "local"],
+                                    "forwarded": self.routed[method, "forwarded"]}
+                           for method in sorted({method for method, _ in self.routed})},
+            }
+
+
+def _labels(**labels):
+    return "{" + ",".join('{}="{}"'.format(name, value) for name, value in labels.items()) + "}"
+
+
+def prometheus(stats):
+    """Prometheus text exposition of the dict DHTNode.stats() returns."""
+    node = stats["node"]
+    lines = [
+        "# HELP dht_messages_received_total Messages received, by method.",
+        "# TYPE dht_messages_received_total counter",
+    ]
+    for method, count in sorted(stats["received"].items()):
+        lines.append("dht_messages_received_total{} {}".format(_labels(node=node, method=method), count))
+
+    lines += [
+        "# HELP dht_messages_dropped_total Client requests dropped with the worker queue full.",
+        "# TYPE dht_messages_dropped_total counter",
+    ]
+    for method, count in sorted(stats["dropped"].items()):
+        lines.append("dht_messages_dropped_total{} {}".format(_labels(node=node, method=method), count))
+
+    lines += [
+        "# HELP dht_handle_seconds Time spent handling a message, by method.",
+        "# TYPE dht_handle_seconds histogram",
+    ]
+    for method, histogram in sorted(stats["latency"].items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), histogram["buckets"]):
+            cumulative += count
+            lines.append("dht_handle_seconds_bucket{} {}".format(
+                _labels(node=node, method=method, le=bound), cumulative))
+        lines.append("dht_handle_seconds_sum{} {}".format(_labels(node=node, method=method), histogram["sum"]))
+        lines.append("dht_handle_seconds_count{} {}".format(_labels(node=node, method=method), cumulative))
+
+    lines += [
+        "# HELP dht_requests_total Keys of client requests answered here (local) or sent on (forwarded).",
+        "# TYPE dht_requests_total counter",
+    ]
+    for method, routes in sorted(stats["routed"].items()):
+        for route, count in sorted(routes.items()):
+            lines.append("dht_requests_total{} {}".format(_labels(node=node, method=method, route=route), count))
+
+    if "cache" in stats:
+        lines += [
+            "# HELP dht_cache_hits_total GETs answered from the read cache instead of being forwarded.",
+            "# TYPE dht_cache_hits_total counter",
+            "dht_cache_hits_total{} {}".format(_labels(node=node), stats["cache"]["hits"]),
+            "# HELP dht_cache_misses_total GETs forwarded for want of a cached value.",
+            "# TYPE dht_cache_misses_total counter",
+            "dht_cache_misses_total{} {}".format(_labels(node=node), stats["cache"]["misses"]),
+        ]
+
+    for name, value in sorted(stats["gauges"].items()):
+        lines.append("# TYPE dht_{} gauge".format(name))
+        lines.append("dht_{}{} {}".format(name, _labels(node=node), value))
+    return "\n".join(lines) + "\n"
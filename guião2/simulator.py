@@ -0,0 +1,312 @@
+""" Discrete-event simulation of a Chord DHT in a single process.
+
+Every host is a plain DHTNode on a virtual clock whose transport hands its
+datagrams to the Simulator instead of a socket. The simulator delivers each
+one after a random latency with the same decode() / deliver() / maintain()
+calls DHTNode.run() makes, so the real handlers run, one event at a time,
+in an order that only depends on the seed.
+"""
+import heapq
+import itertools
+import random
+from bisect import bisect_left
+from collections import Counter
+from codec import encode, Reassembler, CodecError
+from DHTNode import DHTNode
+
+# where the simulated clients send from and get their replies
+CLIENT = ("10.255.255.255", 1)
+
+
+class SimTransport:
+    """Socket stand-in of a simulated host: sendto() posts to the simulator."""
+
+    def __init__(self, sim, address):
+        self.sim = sim
+        self.address = address
+
+    def sendto(self, payload, address):
+        self.sim.post(self.address, address, payload)
+
+    def recvfrom(self, size):
+        raise RuntimeError("simulated hosts are fed by Simulator.step()")
+
+    def bind(self, address):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+class Lookup:
+    """A client request followed through the simulated DHT."""
+
+    def __init__(self, key, start):
+        self.key = key
+        self.start = start
+        self.end = None  # when the reply arrived
+        self.reply = None
+        self.visits = 0  # nodes the request was delivered to
+        self.messages = 0  # request, forwards and reply
+
+    @property
+    def hops(self):
+        """Forwards between nodes (0 when the first node answered)."""
+        return self.visits - 1
+
+    @property
+    def latency(self):
+        return None if self.end is None else self.end - self.start
+
+
+class Simulator:
+    """Chord DHT of DHTNodes exchanging datagrams through an event queue."""
+
+    def __init__(self, m_bits=32, latency=0.005, jitter=0.005, loss=0.0, timeout=3, seed=0, **settings):
+        """Constructor
+
+        Parameters:
+            m_bits: identifier size of the ring
+            latency: seconds every datagram takes at least
+            jitter: random extra seconds per datagram, up to jitter
+            loss: probability of a datagram being dropped
+            timeout: DHTNode timeout (stabilize runs timeout / 8 to timeout * 4 apart)
+            seed: makes runs reproducible; also seeds random, which DHTNode
+                uses to pick replicas
+            settings: other DHTNode arguments (replicas, quorums, vnodes)
+        """
+        self.m_bits = m_bits
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.timeout = timeout
+        self.settings = settings
+        self.rng = random.Random(seed)
+        random.seed(seed)
+        self.now = 0.0
+        self.events = []  # heap of (time, seq, destination, source, payload); no payload: wake up
+        self.seq = itertools.count()
+        self.wakes = {}  # host address -> time of its pending wake up
+        self.hosts = {}  # address -> DHTNode, gone ones included
+        self.alive = []  # hosts that did not leave or crash, oldest first
+        self.lookups = {}  # request_id -> Lookup
+        self.request_ids = itertools.count(1)
+        self.reassembler = Reassembler()  # the clients'
+        self.delivered = Counter()  # method -> messages delivered
+        self.dropped = 0
+        self.numbers = itertools.count(1)
+
+    def clock(self):
+        return self.now
+
+    def new_host(self, dht_address=None):
+        """DHTNode on the next free 10.x.y.z address (not started)."""
+        number = next(self.numbers)
+        address = ("10.{}.{}.{}".format(number >> 16 & 255, number >> 8 & 255, number & 255), 5000)
+        return DHTNode(address, dht_address, self.timeout, self.m_bits, clock=self.clock,
+                       transport=SimTransport(self, address), **self.settings)
+
+    def entry(self):
+        """A random live host that is in the DHT, None if there is none."""
+        hosts = [host for host in self.alive if host.inside_dht]
+        return self.rng.choice(hosts) if hosts else None
+
+    def add_node(self, through=None):
+        """Start a host joining the DHT through another one (a random host in the DHT by default).
+
+        The first host starts the DHT on its own.
+        """
+        if through is None:
+            through = self.entry()
+        host = self.new_host(None if through is None else through.addr)
+        self.hosts[host.addr] = host
+        self.alive.append(host)
+        self.wake(host, 0)
+        return host
+
+    def build(self, count):
+        """Add count hosts forming a ring that already converged, without any join traffic.
+
+        Hosts or virtual nodes whose id is taken are left out, as the DHT
+        would refuse them.
+        """
+        taken = {node.identification for node in self.nodes()}
+        while count > 0:
+            host = self.new_host()
+            if host.identification in taken:
+                continue
+            for index, node in list(host.vnodes.items()):
+                if node is not host and node.identification in taken:
+                    del host.vnodes[index]
+                taken.add(node.identification)
+            self.hosts[host.addr] = host
+            self.alive.append(host)
+            count -= 1
+        self.settle()
+        for host in self.alive:
+            self.wake(host, host.maintain())
+
+    def settle(self):
+        """Point every node at its true successor, predecessor, successors and fingers.
+
+        Stabilize rounds are spread over the longest interval, as in a ring
+        that has been quiet for a while.
+        """
+        nodes = sorted((node for host in self.alive for node in host.vnodes.values()),
+                       key=lambda node: node.identification)
+        ids = [node.identification for node in nodes]
+        for i, node in enumerate(nodes):
+            node.inside_dht = True
+            successor = nodes[(i + 1) % len(nodes)]
+            predecessor = nodes[i - 1]
+            node.successor_id, node.successor_addr = successor.identification, successor.addr
+            node.predecessor_id, node.predecessor_addr = predecessor.identification, predecessor.addr
+            node.successor_list = [(node.successor_id, node.successor_addr)]
+            for j in range(i + 2, i + node.replicas + 2):
+                if nodes[j % len(nodes)] is node:
+                    break
+                node.successor_list.append((ids[j % len(nodes)], nodes[j % len(nodes)].addr))
+            for index, start in enumerate(node.finger_table.starts):
+                finger = nodes[bisect_left(ids, start) % len(nodes)]
+                node.finger_table.update(index + 1, finger.identification, finger.addr)
+            scheduler = node.scheduler
+            scheduler.interval = scheduler.max_interval
+            scheduler.dirty = False
+            scheduler.deadline = self.now + self.rng.uniform(0, scheduler.interval)
+
+    def leave(self, host):
+        """Make host leave the DHT gracefully.
+
+        Its keys and LEAVE messages are sent, but there is no waiting for
+        acknowledgements (that would block the simulation).
+        """
+        host.leave(timeout=0)
+        self.alive.remove(host)
+
+    def crash(self, host):
+        """Stop host without telling anyone: messages to it are dropped from now on."""
+        host.done = True
+        self.alive.remove(host)
+
+    def nodes(self):
+        """Virtual nodes of the live hosts."""
+        return [node for host in self.alive for node in host.vnodes.values()]
+
+    def converged(self, fingers=False):
+        """Whether every live node joined and points at its true successor and
+        predecessor (and, with fingers, its true fingers)."""
+        nodes = sorted(self.nodes(), key=lambda node: node.identification)
+        ids = [node.identification for node in nodes]
+        for i, node in enumerate(nodes):
+            if not node.inside_dht or node.successor_id != ids[(i + 1) % len(ids)] \
+                    or node.predecessor_id != ids[i - 1]:
+                return False
+            if fingers:
+                for (finger_id, _), start in zip(node.finger_table.as_list, node.finger_table.starts):
+                    if finger_id != ids[bisect_left(ids, start) % len(ids)]:
+                        return False
+        return True
+
+    def post(self, source, destination, payload):
+        """Queue a datagram from source to destination."""
+        if self.loss and self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+        at = self.now + self.latency + self.rng.uniform(0, self.jitter)
+        heapq.heappush(self.events, (at, next(self.seq), destination, source, payload))
+
+    def wake(self, host, delay):
+        """Have host run maintain() in delay seconds, unless it is due earlier already."""
+        at = self.now + delay
+        if at < self.wakes.get(host.addr, float("inf")):
+            self.wakes[host.addr] = at
+            heapq.heappush(self.events, (at, next(self.seq), host.addr, None, None))
+
+    def request(self, msg, entry=None):
+        """Send msg from a client to entry (a random host in the DHT by default), return its Lookup."""
+        request_id = next(self.request_ids)
+        msg["args"]["request_id"] = request_id
+        entry = self.entry() if entry is None else entry
+        lookup = self.lookups[request_id] = Lookup(msg["args"].get("key"), self.now)
+        self.post(CLIENT, entry.addr, encode(msg))
+        return lookup
+
+    def get(self, key, entry=None):
+        return self.request({"method": "GET", "args": {"key": key}}, entry)
+
+    def put(self, key, value, entry=None):
+        return self.request({"method": "PUT", "args": {"key": key, "value": value}}, entry)
+
+    def scan(self, token=None, limit=100, entry=None):
+        """SCAN for the page after token; its reply args hold the items and the next token."""
+        return self.request({"method": "SCAN", "args": {"token": token, "limit": limit}}, entry)
+
+    def observe(self, msg):
+        """Count a delivered message, and against its lookup if it has one."""
+        self.delivered[msg["method"]] += 1
+        args = msg.get("args")
+        request_id = msg.get("request_id", args.get("request_id") if isinstance(args, dict) else None)
+        lookup = self.lookups.get(request_id)
+        if lookup is None:
+            return
+        lookup.messages += 1
+        if msg["method"] in ("GET", "PUT", "SCAN"):
+            lookup.visits += 1
+        elif lookup.end is None and msg["method"] in ("ACK", "NACK", "SCAN_REP"):
+            lookup.end = self.now
+            lookup.reply = msg
+
+    def step(self):
+        """Process the next event, return False if there is none."""
+        if not self.events:
+            return False
+        at, _, destination, source, payload = heapq.heappop(self.events)
+        self.now = at
+        if destination == CLIENT:
+            try:
+                msg = self.reassembler.feed(payload, source)
+            except CodecError:
+                msg = None
+            if msg is not None:
+                self.observe(msg)
+            return True
+
+        host = self.hosts.get(destination)
+        if host is None or host.done:
+            if payload is not None:
+                self.dropped += 1
+            return True
+        if payload is None:
+            if self.wakes.get(destination) != at:
+                return True  # superseded by an earlier wake up
+            del self.wakes[destination]
+        else:
+            msg = host.decode(payload, source)
+            if msg is not None:
+                self.observe(msg)
+                host.deliver(msg, source)
+        if not host.done:
+            self.wake(host, host.maintain())
+        return True
+
+    def run(self, duration):
+        """Process the events of the next duration seconds."""
+        end = self.now + duration
+        while self.events and self.events[0][0] <= end:
+            self.step()
+        self.now = end
+
+    def run_until(self, predicate, timeout, check_every=0.1):
+        """Run until predicate() holds, checking every check_every seconds.
+
+        Returns the seconds it took, None if it did not hold within timeout.
+        """
+        start = self.now
+        while not predicate():
+            if self.now - start >= timeout:
+                return None
+            self.run(check_every)
+        return self.now - start
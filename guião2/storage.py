@@ -0,0 +1,236 @@
+""" Keystore backends for DHTNode.
+
+A keystore is a MutableMapping of key -> value with a close() method:
+
+DictStore   the plain in-memory dict the node always used
+LogStore    append-only log on disk with an in-memory index of where each
+            value lives, so only the keys have to fit in RAM and a restarted
+            node finds its data again
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections.abc import MutableMapping
+from codec import dump, load
+
+
+class DictStore(dict):
+    """In-memory keystore, lost when the node stops."""
+
+    def close(self):
+        pass
+
+
+class LogStore(MutableMapping):
+    """Keystore kept in append-only segment files under directory.
+
+    Every write appends a record to the active segment:
+
+        I crc32 | B kind (PUT/DELETE) | I key length | I value length | key | value
+
+    with the value in the codec's typed encoding. Once the active segment
+    reaches segment_size it is sealed and memory-mapped read-only. When more
+    than compact_ratio of the sealed bytes belong to overwritten or deleted
+    keys, the live values are copied forward and the sealed segments removed.
+    Reads and writes may come from several threads.
+    """
+
+    RECORD = struct.Struct(">IBII")
+    PUT = 0
+    DELETE = 1
+
+    def __init__(self, directory, segment_size=64 * 2**20, compact_ratio=0.5, sync=False):
+        """
+        Parameters:
+            directory: where the segment files live (created if needed)
+            segment_size: bytes after which the active segment is sealed
+            compact_ratio: dead fraction of sealed bytes that triggers compaction
+            sync: fsync every write (otherwise a record survives a crash of the
+                  process, but not of the machine, until flush())
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.sync = sync
+        self.logger = logging.getLogger("LogStore")
+        self.lock = threading.RLock()
+
+        self.index = {}  # key -> (segment, value offset, value length, record size)
+        self.sealed = {}  # segment -> read-only mmap
+        self.sizes = {}  # segment -> bytes written
+        self.dead = {}  # segment -> bytes of records no longer in the index
+        os.makedirs(directory, exist_ok=True)
+        segments = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".seg"))
+        for segment in segments:
+            self._load(segment)
+        if segments and self.sizes[segments[-1]] < segment_size:
+            self.active = segments[-1]
+            data = self.sealed.pop(self.active)
+            if data:
+                data.close()
+        else:
+            self.active = segments[-1] + 1 if segments else 0
+            self.sizes[self.active] = 0
+            self.dead[self.active] = 0
+        self.file = open(self._path(self.active), "a+b", buffering=0)
+
+    def _path(self, segment):
+        return os.path.join(self.directory, "{:08d}.seg".format(segment))
+
+    def _load(self, segment):
+        """Add the records of a segment to the index, cutting off a torn tail."""
+        path = self._path(segment)
+        size = os.path.getsize(path)
+        data = b""
+        if size:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.sealed[segment] = data
+        self.dead[segment] = 0
+
+        pos = 0
+        while pos + self.RECORD.size <= size:
+            crc, kind, key_size, value_size = self.RECORD.unpack_from(data, pos)
+            body = pos + self.RECORD.size
+            end = body + key_size + value_size
+            if end > size or zlib.crc32(data[pos + 4:end]) != crc:
+                break
+            key = str(data[body:body + key_size], "utf-8")
+            self._forget(key)
+            if kind == self.PUT:
+                self.index[key] = (segment, body + key_size, value_size, end - pos)
+            else:
+                self.dead[segment] += end - pos
+            pos = end
+
+        if pos < size:
+            self.logger.warning("Truncating %s at %d of %d bytes", path, pos, size)
+            if data:
+                data.close()
+            with open(path, "r+b") as f:
+                f.truncate(pos)
+            with open(path, "rb") as f:
+                self.sealed[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if pos else b""
+        self.sizes[segment] = pos
+
+    def _forget(self, key):
+        """Count the record currently holding key as dead."""
+        entry = self.index.pop(key, None)
+        if entry is not None:
+            self.dead[entry[0]] += entry[3]
+
+    def _append(self, kind, key, value=b""):
+        """Write one record to the active segment, return its index entry."""
+        key_data = key.encode("utf-8")
+        header = struct.pack(">BII", kind, len(key_data), len(value))
+        crc = zlib.crc32(value, zlib.crc32(key_data, zlib.crc32(header)))
+        record_size = self.RECORD.size + len(key_data) + len(value)
+
+        offset = self.sizes[self.active]
+        # one unbuffered write per record: the OS has it as soon as we return
+        self.file.write(struct.pack(">I", crc) + header + key_data + value)
+        if self.sync:
+            self.flush()
+        self.sizes[self.active] = offset + record_size
+        return (self.active, offset + self.RECORD.size + len(key_data), len(value), record_size)
+
+    def _raw(self, entry):
+        """Encoded value an index entry points to."""
+        segment, offset, size, _ = entry
+        if segment == self.active:
+            return os.pread(self.file.fileno(), size, offset)
+        return self.sealed[segment][offset:offset + size]
+
+    def _rotate(self):
+        """Seal the active segment and start a new one, compacting if enough sealed bytes are dead."""
+        self._seal()
+        sealed = sum(self.sizes[segment] for segment in self.sealed)
+        if sealed and sum(self.dead[segment] for segment in self.sealed) > self.compact_ratio * sealed:
+            self.compact()
+
+    def _seal(self):
+        """Seal the active segment and start a new one."""
+        self.file.close()
+        with open(self._path(self.active), "rb") as f:
+            self.sealed[self.active] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.active += 1
+        self.sizes[self.active] = 0
+        self.dead[self.active] = 0
+        self.file = open(self._path(self.active), "a+b", buffering=0)
+
+    def compact(self):
+        """Copy the live values of sealed segments forward and delete those segments.
+
+        The copies fill segments of segment_size as writes do; the ones sealed
+        meanwhile stay.
+        """
+        with self.lock:
+            old = set(self.sealed)
+            for key, entry in list(self.index.items()):
+                if entry[0] in old:
+                    self.index[key] = self._append(self.PUT, key, bytes(self._raw(entry)))
+                    if self.sizes[self.active] >= self.segment_size:
+                        self._seal()
+            self.flush()
+            for segment in old:
+                data = self.sealed.pop(segment)
+                if data:
+                    data.close()
+                os.remove(self._path(segment))
+                del self.sizes[segment], self.dead[segment]
+        self.logger.debug("Compacted into segments up to %d (%d keys)", self.active, len(self.index))
+
+    def flush(self):
+        """Force the records written so far to disk."""
+        with self.lock:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.file.close()
+            for data in self.sealed.values():
+                if data:
+                    data.close()
+            self.sealed.clear()
+
+    def __getitem__(self, key):
+        with self.lock:
+            data = bytes(self._raw(self.index[key]))
+        return load(data)
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, str):
+            raise TypeError("keys must be str, not {}".format(type(key).__name__))
+        data = dump(value)
+        with self.lock:
+            entry = self._append(self.PUT, key, data)
+            self._forget(key)
+            self.index[key] = entry
+            if self.sizes[self.active] >= self.segment_size:
+                self._rotate()
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self.index:
+                raise KeyError(key)
+            entry = self._append(self.DELETE, key)
+            self._forget(key)
+            self.dead[entry[0]] += entry[3]
+            if self.sizes[self.active] >= self.segment_size:
+                self._rotate()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return "LogStore({!r}, {} keys)".format(self.directory, len(self.index))
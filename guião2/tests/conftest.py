@@ -0,0 +1,88 @@
+import socket
+import time
+
+import pytest
+
+from DHTNode import DHTNode
+from utils import dht_hash
+
+
+class Clock:
+    """Clock for nodes, moved by hand."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture()
+def clock():
+    return Clock()
+
+
+@pytest.fixture()
+def make_node():
+    """Factory of nodes wired to their neighbours by hand, keeping what they send in node.sent.
+
+    Node 770 between 654 and 959 by default, as in the DHT DHT.py starts;
+    successor_list [(id, addr)] starts with the successor.
+    """
+    def make(address=("localhost", 5000), predecessor=(654, ("localhost", 5004)),
+             successor_list=((959, ("localhost", 5001)),), **kwargs):
+        node = DHTNode(address, **kwargs)
+        node.predecessor_id, node.predecessor_addr = predecessor
+        node.successor_id, node.successor_addr = successor_list[0]
+        node.update_successor_list(successor_list[1:])
+        node.finger_table.fill(*successor_list[0])
+        node.sent = []
+        node.send = lambda address, msg: node.sent.append((address, msg))
+        node.send_batch = lambda address, msg, field: node.sent.append((address, msg))
+        return node
+    return make
+
+
+def free_port():
+    """A UDP port on localhost nothing is bound to right now."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture()
+def address():
+    """Address on localhost, with a free port, for a node under test."""
+    return ("localhost", free_port())
+
+
+def stable(nodes):
+    """Whether successor and predecessor pointers follow the sorted ids."""
+    ids = sorted(node.identification for node in nodes)
+    for node in nodes:
+        i = ids.index(node.identification)
+        if node.successor_id != ids[(i + 1) % len(ids)] or node.predecessor_id != ids[i - 1]:
+            return False
+    return True
+
+
+@pytest.fixture(scope="module")
+def ring():
+    """Three nodes on free ports, joined and stabilized, the entry node first."""
+    addresses = {}
+    while len(addresses) < 3:
+        address = ("localhost", free_port())
+        addresses.setdefault(dht_hash(str(address)), address)  # ids must differ
+    entry, *others = addresses.values()
+    nodes = [DHTNode(entry, timeout=0.5)] + [DHTNode(address, entry, timeout=0.5) for address in others]
+    for node in nodes:
+        node.start()
+    deadline = time.time() + 20
+    while not stable(nodes) and time.time() < deadline:
+        time.sleep(0.1)
+    assert stable(nodes)
+    yield nodes
+    for node in nodes:
+        node.done = True
+    for node in nodes:
+        node.join()
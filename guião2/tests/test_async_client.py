@@ -0,0 +1,57 @@
+"""Tests the pipelined client against a fake node (no running DHT needed)."""
+import asyncio
+import pytest
+from AsyncDHTClient import AsyncDHTClient
+from codec import encode, decode
+
+
+class FakeNode(asyncio.DatagramProtocol):
+    """Stores PUTs, answers GETs in reverse order and drops the first datagram."""
+
+    def __init__(self):
+        self.keystore = {}
+        self.received = 0
+        self.gets = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        if self.received == 1:
+            return  # lost, the client has to retry
+        msg = decode(data)
+        args = msg["args"]
+        if msg["method"] == "PUT":
+            self.keystore[args["key"]] = args["value"]
+            self.transport.sendto(encode({"method": "ACK", "request_id": args["request_id"]}), addr)
+        else:
+            self.gets.append((args, addr))
+            if len(self.gets) == 3:
+                for args, addr in reversed(self.gets):
+                    reply = {"method": "ACK", "args": self.keystore[args["key"]], "request_id": args["request_id"]}
+                    self.transport.sendto(encode(reply), addr)
+
+
+async def run_client():
+    loop = asyncio.get_running_loop()
+    transport, node = await loop.create_datagram_endpoint(FakeNode, local_addr=("127.0.0.1", 0))
+    address = transport.get_extra_info("sockname")
+    try:
+        async with AsyncDHTClient(address, timeout=0.2, retries=1) as client:
+            puts = await asyncio.gather(*(client.put(key, key * 2) for key in "abc"))
+            gets = await asyncio.gather(*(client.get(key) for key in "abc"))
+            assert client.pending == {}
+
+            with pytest.raises(asyncio.TimeoutError):
+                await client.get("never answered")
+    finally:
+        transport.close()
+    return puts, gets
+
+
+def test_async_client_matches_replies():
+    puts, gets = asyncio.run(run_client())
+
+    assert puts == [True, True, True]
+    assert gets == ["aa", "bb", "cc"]
@@ -26,3 +26,38 @@ def test_put_remote(client):
 def test_get_remote(client):
     """ retrieve from DHT (this key is not on the first node -> remote search) """
     assert client.get("2") == "xpto"
+
+
+MANY = {k: k.upper() for k in ("many-%d" % i for i in range(200))}
+
+
+def test_put_many(ring):
+    """ add several objects with one PUT_MANY (answered by each owner) """
+    client = DHTClient(ring[0].addr)
+    assert client.put_many(MANY) == {k: True for k in MANY}
+    assert client.put_many({"many-0": 0}) == {"many-0": False}
+    assert all(sum(k in node.keystore for node in ring) == 1 for k in MANY)  # each on its owner only
+
+
+def test_get_many(ring):
+    """ retrieve several objects with one GET_MANY """
+    client = DHTClient(ring[0].addr)
+    keys = {"get-%d" % i: i for i in range(100)}
+    assert all(client.put_many(keys).values())
+    assert client.get_many(list(keys) + ["missing"]) == dict(keys, missing=None)
+    assert client.get("get-1") == 1
+
+
+def test_routing_cache(ring):
+    """ replies teach the client the ring, later requests go straight to the owner """
+    client = DHTClient(ring[0].addr)
+    keys = {"route-%d" % i: i for i in range(100)}
+    assert all(client.put_many(keys).values())
+    assert client.get_many(keys) == keys
+    assert all(client.ring.lookup(client.key_id(k)) is not None for k in keys)
+
+    key = next(k for k in keys if k not in ring[0].keystore)  # owned by another node
+    owner_id, owner_addr = client.ring.lookup(client.key_id(key))
+    assert owner_addr != client.dht_addr
+    assert client.get(key) == keys[key]
+    assert client.ring.lookup(client.key_id(key)) == (owner_id, owner_addr)
@@ -0,0 +1,97 @@
+"""Tests the read cache of values forwarded GETs found, and the nodes using it."""
+import pytest
+from cache import ReadCache
+from metrics import prometheus
+from simulator import Simulator
+from utils import dht_hash
+
+
+def test_least_recently_used_evicted():
+    cache = ReadCache(2, ttl=10)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == (True, 1)  # b is now the least recently used
+    cache.put("c", 3)
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1) and cache.get("c") == (True, 3)
+    assert (cache.hits, cache.misses) == (3, 1)
+    cache.discard("a")
+    assert len(cache) == 1
+
+
+def test_entries_expire(clock):
+    cache = ReadCache(10, ttl=5, clock=clock)
+    cache.put("a", 1)
+    clock.now = 4.9
+    assert cache.get("a") == (True, 1)  # reading does not extend it
+    clock.now = 5
+    assert cache.get("a") == (False, None)
+    assert len(cache) == 0
+
+
+@pytest.fixture()
+def node(make_node):
+    # node 770, between 654 and 959, caching
+    return make_node(cache=10)
+
+
+def keys_between(start, end):
+    return [key for key in map(str, range(10000)) if start < dht_hash(key) <= end]
+
+
+def test_forwarding_node_caches(node):
+    key = keys_between(770, 959)[0]
+    client = ("localhost", 6000)
+    node.get(key, client, 1)
+    (address, msg), = node.sent
+    assert address == ("localhost", 5001) and msg["args"]["via"] == node.addr
+
+    # the owner answers the client, and sends me the value
+    node.handle({"method": "CACHE", "args": {"key": key, "value": "v"}}, ("localhost", 5001))
+    node.sent.clear()
+    node.get(key, client, 2)
+    (address, msg), = node.sent
+    assert address == client and msg == {"method": "ACK", "args": "v", "request_id": 2}
+    assert node.stats()["cache"] == {"hits": 1, "misses": 1}
+
+    # a PUT going by (the key was lost and is stored again) drops the copy
+    node.put(key, "w", client)
+    node.sent.clear()
+    node.get(key, client, 3)
+    assert node.sent[0][0] == ("localhost", 5001)
+
+
+def test_owner_offers_value(node):
+    key, missing = keys_between(654, 770)[:2]
+    node.keystore[key] = "v"
+    node.get(key, ("localhost", 6000), 1, via=("localhost", 5004))
+    assert node.sent[1] == (("localhost", 5004), {"method": "CACHE", "args": {"key": key, "value": "v"}})
+    # misses are not cached: the key may be stored later
+    node.sent.clear()
+    node.get(missing, ("localhost", 6000), 2, via=("localhost", 5004))
+    assert all(msg["method"] != "CACHE" for _, msg in node.sent)
+
+
+def test_prometheus_counters(node):
+    node.cache.get("a")
+    lines = prometheus(node.stats()).splitlines()
+    assert 'dht_cache_misses_total{{node="{}"}} 1'.format(node.identification) in lines
+    assert 'dht_cache_entries{{node="{}"}} 0'.format(node.identification) in lines
+
+
+def test_hot_key_spread():
+    loads = []
+    for cache in (0, 100):
+        sim = Simulator(seed=8, cache=cache)
+        sim.build(50)
+        sim.put("hot", "value")
+        sim.run(1)
+        gets = []
+        for _ in range(20):
+            gets += [sim.get("hot") for _ in range(10)]
+            sim.run(0.1)
+        sim.run(2)
+        assert [get.reply["args"] for get in gets] == ["value"] * 200
+        loads.append(max(host.metrics.received["GET"] for host in sim.alive))
+    # without a cache the owner gets every GET, with one the copies along the paths take most
+    assert loads[0] == 200 and loads[1] < 50
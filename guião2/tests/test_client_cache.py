@@ -0,0 +1,63 @@
+"""Tests the client ring cache."""
+from DHTClient import DHTClient, RingCache
+
+
+def test_lookup():
+    ring = RingCache()
+    assert ring.lookup(100) is None
+    ring.learn(260, ("localhost", 5002), 257)
+    ring.learn(654, ("localhost", 5004), 260)
+    assert ring.lookup(500) == (654, ("localhost", 5004))
+    assert ring.lookup(260) == (260, ("localhost", 5002))
+    assert ring.lookup(258) == (260, ("localhost", 5002))
+    assert ring.lookup(700) is None  # owner not cached: ask the entry node
+    assert ring.lookup(100) is None
+
+
+def test_wrap_around():
+    ring = RingCache()
+    ring.learn(257, ("localhost", 5003), 959)
+    assert ring.lookup(1000) == (257, ("localhost", 5003))
+    assert ring.lookup(3) == (257, ("localhost", 5003))
+    assert ring.lookup(500) is None
+
+
+def test_lone_node():
+    ring = RingCache()
+    ring.learn(770, ("localhost", 5000), 770)
+    assert ring.lookup(3) == (770, ("localhost", 5000))
+    ring.learn(959, ("localhost", 5001), 770)
+    assert ring.ids == [959]
+
+
+def test_stale_entries_dropped():
+    ring = RingCache()
+    ring.learn(654, ("localhost", 5004), 260)
+    ring.learn(770, ("localhost", 5000), 654)
+    # 581 joined inside 654's range
+    ring.learn(581, ("localhost", 4000), 260)
+    assert ring.ids == [581, 770]
+    # 654 reports its new range
+    ring.learn(654, ("localhost", 5004), 581)
+    assert ring.ids == [581, 654, 770]
+    # 654 left, 770 took its keys
+    ring.learn(770, ("localhost", 5000), 581)
+    assert ring.ids == [581, 770]
+
+
+def test_unknown_range_ignored():
+    ring = RingCache()
+    ring.learn(654, ("localhost", 5004), None)
+    assert len(ring) == 0
+
+
+def test_redirect_forgets_target():
+    client = DHTClient(("localhost", 5000))
+    client.ring.learn(654, ("localhost", 5004), 260)
+    owner = {"id": 581, "addr": ("localhost", 4000), "predecessor_id": 260}
+    client.learn({"method": "ACK", "owner": owner}, (654, ("localhost", 5004)))
+    assert client.ring.ids == [581]
+
+    # a reply without owner (older node) still clears the entry it contradicts
+    client.learn({"method": "NACK"}, (581, ("localhost", 4000)))
+    assert len(client.ring) == 0
@@ -0,0 +1,103 @@
+"""Tests the binary wire format."""
+import pytest
+from codec import encode, decode, fragment, pack_batch, Reassembler, CodecError, MAX_DEPTH, VERSION
+
+MESSAGES = [
+    {"method": "JOIN_REQ", "args": {"addr": ("localhost", 5001), "id": 959, "m_bits": 10}},
+    {"method": "PUT", "args": {"key": "A", "value": [0, 1, 2], "from": ("localhost", 40000), "request_id": 1}},
+    {"method": "ACK", "args": ("xpto", None, True, False, 1.5, b"\x00\xff"), "request_id": 2**40},
+    {"method": "STABILIZE", "args": None, "predecessor_addr": None, "successors": [(959, ("localhost", 5001))]},
+    {"method": "SUCCESSOR", "args": {"id": 2**160 - 1, "from": ("localhost", 5000)}},
+    {"method": "GET_MANY_REP", "args": {"results": {"ção": (True, {"x": -7}), "b": (False, None)}}},
+]
+
+
+@pytest.mark.parametrize("msg", MESSAGES)
+def test_roundtrip(msg):
+    assert decode(encode(msg)) == msg
+
+
+def test_invalid():
+    with pytest.raises(CodecError):
+        encode({"method": "PUT", "args": {"value": object()}})
+    with pytest.raises(CodecError):
+        encode({"method": "NOPE"})
+    with pytest.raises(CodecError):
+        decode(encode(MESSAGES[1])[:-1])
+    with pytest.raises(CodecError):
+        decode(b"\x02\x00\x00N")
+    with pytest.raises(CodecError):
+        encode({"method": "ACK", "args": 2**3000})
+
+
+def test_nesting_limit():
+    nested = [[[0]]]
+    for _ in range(MAX_DEPTH - 4):
+        nested = [nested]
+    msg = {"method": "ACK", "args": nested}  # the message dict is the first container
+    assert decode(encode(msg)) == msg
+    with pytest.raises(CodecError):
+        encode({"method": "ACK", "args": [nested]})
+    with pytest.raises(CodecError):
+        decode(bytes([VERSION, 0, 3]) + b"l\x00\x00\x00\x01" * 13000 + b"N")
+
+
+def test_fragments():
+    msg = {"method": "PUT", "args": {"key": "big", "value": "x" * 5000}}
+    payload = encode(msg)
+    datagrams = fragment(payload, 7, size=1024)
+
+    assert len(datagrams) == 5
+    assert all(len(d) <= 1024 for d in datagrams)
+    assert fragment(payload, 7) == [payload]
+
+    reassembler = Reassembler()
+    # out of order, and interleaved with a whole message from another sender
+    assert reassembler.feed(datagrams[3], "a") is None
+    assert reassembler.feed(encode(MESSAGES[0]), "b") == MESSAGES[0]
+    for datagram in datagrams[:3]:
+        assert reassembler.feed(datagram, "a") is None
+    assert reassembler.feed(datagrams[4], "a") == msg
+    assert reassembler.partial == {} and reassembler.senders == {} and reassembler.total == 0
+
+
+def test_fragment_limits():
+    def pieces(msg_id):  # 5 fragments, of 1014 bytes but the last
+        return fragment(encode({"method": "PUT", "args": {"key": "big", "value": "x" * 5000}}), msg_id, size=1024)
+
+    with pytest.raises(CodecError):
+        Reassembler(max_count=4).feed(pieces(7)[0], "a")
+
+    reassembler = Reassembler(max_pending=2, max_bytes=3000, max_total=4000)
+    for msg_id in range(3):  # a third message from "a" drops its first
+        reassembler.feed(pieces(msg_id)[0], "a")
+    assert list(reassembler.partial) == [("a", 1), ("a", 2)]
+    reassembler.feed(pieces(2)[1], "a")  # 3042 bytes from "a": drops the oldest again
+    assert list(reassembler.partial) == [("a", 2)]
+    reassembler.feed(pieces(7)[0], "b")
+    reassembler.feed(pieces(7)[1], "b")  # 4056 bytes in all, "a" has waited longest
+    assert list(reassembler.partial) == [("b", 7)] and list(reassembler.senders) == ["b"]
+    assert reassembler.total == reassembler.senders["b"][1] == 2028
+
+
+def test_fragments_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("codec.time.monotonic", lambda: now[0])
+    datagrams = fragment(encode({"method": "PUT", "args": {"key": "big", "value": "x" * 5000}}), 7, size=1024)
+    reassembler = Reassembler(timeout=5)
+    reassembler.feed(datagrams[0], "a")
+    now[0] += 6
+    reassembler.feed(datagrams[0], "b")  # any feed drops what stopped arriving
+    assert list(reassembler.partial) == [("b", 7)] and list(reassembler.senders) == ["b"]
+
+
+def test_pack_batch():
+    msg = {"method": "PUT_MANY", "args": {"items": {str(i): "%03d" % i * 30 for i in range(100)}, "from": None}}
+
+    payloads = pack_batch(msg, "items", size=1024)
+    parts = [decode(p) for p in payloads]
+
+    assert len(payloads) > 1
+    assert all(len(p) <= 1024 for p in payloads)
+    assert all(part["args"]["from"] is None for part in parts)
+    assert {k: v for part in parts for k, v in part["args"]["items"].items()} == msg["args"]["items"]
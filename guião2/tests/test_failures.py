@@ -0,0 +1,159 @@
+"""Tests failure detection: heartbeats, successor lists and repairs after crashes."""
+import socket
+import time
+import pytest
+from codec import encode
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from simulator import Simulator
+from utils import dht_hash
+
+SUCCESSORS = [(959, ("localhost", 5001)), (257, ("localhost", 5003)), (260, ("localhost", 5002))]
+
+
+@pytest.fixture()
+def node(make_node, clock):
+    # node 770, between 654 and 959, with a clock moved by hand
+    return make_node(successor_list=SUCCESSORS, timeout=2, replicas=1, clock=clock)
+
+
+def methods(node):
+    return [(address, msg["method"]) for address, msg in node.sent]
+
+
+def test_answered_heartbeats(node):
+    node.check_successor()
+    assert methods(node) == [(("localhost", 5001), "PREDECESSOR")]
+    node.clock.now = 0.5
+    node.handle({"method": "STABILIZE", "args": 770, "id": 959, "successors": SUCCESSORS[1:]}, ("localhost", 5001))
+    node.sent.clear()
+    node.clock.now = 1.5
+    node.check_successor()
+    assert node.sent == []  # next heartbeat in timeout seconds
+    node.clock.now = 2
+    node.check_successor()
+    assert methods(node) == [(("localhost", 5001), "PREDECESSOR")]
+    assert node.successor_id == 959 and node.misses == 0
+
+
+def test_silent_successor_is_skipped(node):
+    node.check_successor()
+    node.clock.now = 1
+    node.check_successor()  # first miss, asked again
+    assert node.successor_id == 959 and node.misses == 1
+    node.sent.clear()
+    node.clock.now = 2
+    node.check_successor()
+    assert node.successor_id == 257
+    assert node.successor_list == SUCCESSORS[1:]
+    assert 959 in node.failed
+    assert set(node.finger_table.as_list) == {SUCCESSORS[1]}
+    assert methods(node) == [(("localhost", 5003), "PREDECESSOR")]
+
+    # the new successor still has the dead node as predecessor: not taken back
+    node.sent.clear()
+    node.handle({"method": "STABILIZE", "args": 959, "predecessor_addr": ("localhost", 5001), "id": 257,
+                 "successors": SUCCESSORS[2:]}, ("localhost", 5003))
+    assert node.successor_id == 257
+    notify = [msg for _, msg in node.sent if msg["method"] == "NOTIFY"]
+    assert notify[0]["args"]["failed"] == [959]
+    # it answered: the others can point their fingers at it
+    hints = [msg["args"] for _, msg in node.sent if msg["method"] == "FINGER_FAILED"]
+    assert hints and all(hint["id"] == 959 and hint["successor_id"] == 257 for hint in hints)
+
+
+def crash_successor(node):
+    node.check_successor()
+    node.clock.now = 1
+    node.check_successor()
+    node.clock.now = 2
+    node.check_successor()
+
+
+def test_successors_gone(node):
+    # my predecessor is the last node known: stabilize walks back from it
+    node.failed = {257: 0, 260: 0}
+    crash_successor(node)
+    assert node.successor_id == 654
+
+
+def test_everyone_gone(node):
+    node.failed = {257: 0, 260: 0, 654: 0}
+    crash_successor(node)
+    assert node.successor_id == node.identification and node.predecessor_id is None
+    assert node.successor_list == [(node.identification, node.addr)]
+
+
+def test_take_over_from_crashed_predecessor(node):
+    # keys between 260 and the crashed 654 were mine as replicas only
+    key = next(key for key in map(str, range(1000)) if 260 < dht_hash(key) <= 654)
+    node.replica_store[key] = "value"
+    node.notify({"predecessor_id": 260, "predecessor_addr": ("localhost", 5002)})
+    assert node.predecessor_id == 654  # nothing says 654 is gone
+    node.notify({"predecessor_id": 260, "predecessor_addr": ("localhost", 5002), "failed": [654]})
+    assert node.predecessor_id == 260
+    assert node.keystore[key] == "value" and key not in node.replica_store
+    # and copied to my replica
+    assert any(msg["method"] == "REPLICATE" and key in msg["args"]["items"] for _, msg in node.sent)
+
+
+def test_finger_failed_hint(node):
+    node.finger_table.update(3, 654, ("localhost", 5004))
+    args = {"id": 959, "successor_id": 257, "successor_addr": ("localhost", 5003), "target": 800}
+    node.finger_failed(args)
+    fingers = node.finger_table.as_list
+    assert fingers[2] == (654, ("localhost", 5004))
+    assert all(finger[0] == 257 for i, finger in enumerate(fingers) if i != 2)
+    # fingers changed here: the nodes before me may point at it too
+    assert node.sent == [(("localhost", 5004), {"method": "FINGER_FAILED", "args": dict(args, target=770)})]
+
+
+def test_ring_repaired_after_crashes():
+    sim = Simulator(seed=12, replicas=2)
+    sim.build(40)
+    keys = ["key{}".format(i) for i in range(200)]
+    for key in keys:
+        sim.put(key, key)
+    sim.run(2)
+    nodes = sorted(sim.alive, key=lambda node: node.identification)
+    # two neighbours at once, and another one elsewhere
+    for host in (nodes[5], nodes[6], nodes[20]):
+        sim.crash(host)
+    took = sim.run_until(sim.converged, 30)
+    assert took is not None and took < 4 * sim.timeout
+    gets = [sim.get(key) for key in keys]
+    sim.run(2)
+    assert [get.reply["args"] for get in gets] == keys
+    assert max(get.latency for get in gets) < 1
+
+
+def test_client_gives_up():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("localhost", 0))  # nobody answers there
+    client = DHTClient(sock.getsockname(), timeout=0.1, retries=1)
+    assert client.get("a") is None
+    assert not client.put("a", 1)
+    assert client.get_many(["a", "b"]) == {"a": None, "b": None}
+    assert client.stats() is None
+    sock.close()
+
+
+@pytest.fixture()
+def live_node(address):
+    node = DHTNode(address, timeout=0.5)
+    node.start()
+    time.sleep(0.2)  # bound and alone in the DHT
+    yield node
+    node.done = True
+    node.join()
+
+
+def test_malformed_message_dropped(live_node):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for msg in ({"method": "GET", "args": {}}, {"method": "PUT", "args": None}, {"method": "NOTIFY", "args": 1},
+                {"method": "GET", "args": {"key": "a"}, "vnode": [0]}):
+        sock.sendto(encode(msg), live_node.addr)
+    sock.close()
+    client = DHTClient(live_node.addr)
+    assert client.put("a", 1)
+    assert client.get("a") == 1  # the node thread went on
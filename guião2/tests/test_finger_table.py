@@ -35,3 +35,49 @@ def test_finger_table():
         (3, 14, ("localhost", 5003)),
         (4, 2, ("localhost", 5004)),
     ]
+
+
+def test_finger_table_large_ring():
+    f = FingerTable(2**159, ("localhost", 5000), 160)
+
+    assert f.getIdxFromId(2**159 + 1) == 1
+    assert f.getIdxFromId(2**159 + 3) == 3
+    assert f.getIdxFromId(0) == 160
+    assert f.getIdxFromId(2**159 - 1) is None
+    assert f.getIdxFromId(2**159) is None
+
+    f.fill(2**159 + 1, ("localhost", 5001))
+    f.update(160, 5, ("localhost", 5002))
+
+    assert f.find(2**159 + 1) == ("localhost", 5002)
+    assert f.find(4) == ("localhost", 5001)
+    assert f.find(2**159 - 1) == ("localhost", 5002)
+    assert f.refresh()[159] == (160, 0, ("localhost", 5002))
+
+
+def test_find_past_fingers_pointing_at_me():
+    # 886's last finger (start 374) is itself: 263 is the farthest node it knows
+    f = FingerTable(886, ("localhost", 5000), 10)
+    f.fill(906, ("localhost", 5001))
+    f.update(8, 263, ("localhost", 5002))
+    f.update(9, 263, ("localhost", 5002))
+    f.update(10, 886, ("localhost", 5000))
+
+    assert f.find(279) == ("localhost", 5002)
+    assert f.find(900) == ("localhost", 5000)
+
+
+def test_find_while_updated():
+    class Updated(FingerTable):
+        """Finger table updated by the node thread right after a worker rebuilt its boundaries."""
+
+        def __setattr__(self, name, value):
+            super().__setattr__(name, value)
+            if name == "_reach" and value is not None:
+                super().__setattr__("_reach", None)
+
+    f = Updated(10, ("localhost", 5000), 4)
+    f.fill(11, ("localhost", 5001))
+    f.update(4, 1, ("localhost", 5002))
+    assert f.find(15) == ("localhost", 5001)
+    assert f.find(5) == ("localhost", 5002)
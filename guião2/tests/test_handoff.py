@@ -0,0 +1,80 @@
+"""Tests key handoff on join and graceful leave, with messages delivered by hand."""
+from DHTNode import TRANSFER_RETRIES
+
+
+def test_handoff_on_join(make_node):
+    # 654 owned ]260, 654] until 581 joined in between
+    old = make_node(("localhost", 5004), (260, ("localhost", 5002)), [(770, ("localhost", 5000))])
+    new = make_node(("localhost", 4000), (None, None), [(654, ("localhost", 5004))])
+    old.keystore = {"10": "Aveiro", "4": "Lisboa"}  # dht_hash: 580, 611
+
+    old.notify({"predecessor_id": 581, "predecessor_addr": ("localhost", 4000)})
+    (address, transfer), = old.sent
+    assert address == ("localhost", 4000)
+    assert transfer == {"method": "TRANSFER", "args": {"items": {"10": "Aveiro"}}}
+    assert "10" in old.keystore  # until acknowledged
+
+    new.receive_transfer(transfer["args"], ("localhost", 5004))
+    assert new.keystore == {"10": "Aveiro"}
+    (address, ack), = new.sent
+    assert address == ("localhost", 5004)
+
+    old.transfer_done(ack["args"])
+    assert old.keystore == {"4": "Lisboa"}
+    assert old.pending_transfers == {}
+
+
+def test_lost_transfer_sent_again(make_node, clock):
+    old = make_node(("localhost", 5004), (260, ("localhost", 5002)), [(770, ("localhost", 5000))],
+                    timeout=2, clock=clock)
+    new = make_node(("localhost", 4000), (None, None), [(654, ("localhost", 5004))])
+    old.keystore = {"10": "Aveiro", "4": "Lisboa"}  # dht_hash: 580, 611
+
+    old.notify({"predecessor_id": 581, "predecessor_addr": ("localhost", 4000)})
+    old.sent.clear()  # the TRANSFER is lost
+    clock.now = 1.9
+    old.retry_transfers()
+    assert old.sent == []
+    clock.now = 2
+    old.retry_transfers()
+    (address, transfer), = old.sent
+    assert address == ("localhost", 4000)
+    assert transfer == {"method": "TRANSFER", "args": {"items": {"10": "Aveiro"}}}
+
+    new.receive_transfer(transfer["args"], ("localhost", 5004))
+    old.transfer_done(new.sent[0][1]["args"])
+    assert new.keystore == {"10": "Aveiro"}
+    assert old.keystore == {"4": "Lisboa"}
+    assert old.pending_transfers == {}
+
+
+def test_transfer_given_up(make_node, clock):
+    old = make_node(("localhost", 5004), (260, ("localhost", 5002)), [(770, ("localhost", 5000))],
+                    timeout=2, clock=clock)
+    old.keystore = {"10": "Aveiro"}
+    old.notify({"predecessor_id": 581, "predecessor_addr": ("localhost", 4000)})
+    for _ in range(TRANSFER_RETRIES + 1):
+        clock.now += 2
+        old.retry_transfers()
+    assert len(old.sent) == 1 + TRANSFER_RETRIES
+    assert old.pending_transfers == {}
+    assert old.keystore == {"10": "Aveiro"}  # kept until a later handoff
+
+
+def test_leave(make_node):
+    leaving = make_node(("localhost", 4000), (260, ("localhost", 5002)), [(654, ("localhost", 5004))])
+    predecessor = make_node(("localhost", 5002), (257, ("localhost", 5003)), [(581, ("localhost", 4000))])
+    leaving.keystore = {"10": "Aveiro"}
+
+    leaving.leave(timeout=0)
+    assert leaving.done
+    assert [(a, m["method"]) for a, m in leaving.sent] == [
+        (("localhost", 5004), "TRANSFER"),
+        (("localhost", 5004), "LEAVE"),
+        (("localhost", 5002), "LEAVE"),
+    ]
+    assert leaving.sent[0][1]["args"]["items"] == {"10": "Aveiro"}
+
+    predecessor.node_leave(leaving.sent[2][1]["args"])
+    assert (predecessor.successor_id, predecessor.successor_addr) == (654, ("localhost", 5004))
+    assert set(predecessor.finger_table.as_list) == {(654, ("localhost", 5004))}
@@ -0,0 +1,84 @@
+"""Tests the metrics a node keeps and the STATS method exposing them."""
+import time
+import pytest
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from metrics import BUCKETS, Metrics, prometheus
+from simulator import Simulator
+
+
+def test_histogram_buckets():
+    metrics = Metrics()
+    metrics.observe("GET", 0.00001)
+    metrics.observe("GET", 0.003)
+    metrics.observe("GET", 5)
+    metrics.observe("PUT", 0.0001)
+    stats = metrics.snapshot()
+    assert stats["received"] == {"GET": 3, "PUT": 1}
+    buckets = stats["latency"]["GET"]["buckets"]
+    assert len(buckets) == len(BUCKETS) + 1
+    assert buckets[0] == 1 and buckets[BUCKETS.index(0.005)] == 1 and buckets[-1] == 1
+    assert stats["latency"]["GET"]["sum"] == pytest.approx(5.00301)
+    # bounds are inclusive, as Prometheus' le
+    assert stats["latency"]["PUT"]["buckets"][BUCKETS.index(0.0001)] == 1
+
+
+def test_prometheus_text():
+    metrics = Metrics()
+    metrics.observe("GET", 0.0002)
+    metrics.observe("GET", 0.02)
+    metrics.route("GET", True)
+    metrics.route("GET_MANY", False, keys=5)
+    metrics.drop("PUT")
+    stats = dict(metrics.snapshot(), node=7, gauges={"keys": 3})
+    lines = prometheus(stats).splitlines()
+    assert 'dht_messages_received_total{node="7",method="GET"} 2' in lines
+    assert 'dht_messages_dropped_total{node="7",method="PUT"} 1' in lines
+    assert 'dht_handle_seconds_bucket{node="7",method="GET",le="0.0001"} 0' in lines
+    assert 'dht_handle_seconds_bucket{node="7",method="GET",le="0.00025"} 1' in lines
+    assert 'dht_handle_seconds_bucket{node="7",method="GET",le="+Inf"} 2' in lines
+    assert 'dht_handle_seconds_count{node="7",method="GET"} 2' in lines
+    assert 'dht_requests_total{node="7",method="GET",route="local"} 1' in lines
+    assert 'dht_requests_total{node="7",method="GET",route="forwarded"} 0' in lines
+    assert 'dht_requests_total{node="7",method="GET_MANY",route="forwarded"} 5' in lines
+    assert 'dht_keys{node="7"} 3' in lines
+
+
+def test_routes_and_finger_ages():
+    sim = Simulator(seed=7)
+    sim.build(20)
+    for i in range(50):
+        sim.put("key{}".format(i), i)
+    sim.run(5)
+    routed = [host.stats()["routed"].get("PUT", {"local": 0, "forwarded": 0}) for host in sim.alive]
+    # every put is answered by exactly one node, the rest of the visits forwarded it
+    assert sum(route["local"] for route in routed) == 50
+    assert sum(route["forwarded"] for route in routed) == sum(
+        lookup.hops for lookup in sim.lookups.values())
+    gauges = sim.alive[0].stats()["gauges"]
+    assert sum(host.stats()["gauges"]["keys"] for host in sim.alive) == 50
+    # fingers are checked one per stabilize round, the first ones just now
+    assert 0 < gauges["finger_age_mean_seconds"] <= gauges["finger_age_max_seconds"] <= sim.now
+
+
+@pytest.fixture()
+def node(address):
+    node = DHTNode(address, timeout=0.5)
+    node.start()
+    time.sleep(0.2)  # bound and alone in the DHT
+    yield node
+    node.done = True
+    node.join()
+
+
+def test_stats_request(node):
+    client = DHTClient(node.addr)
+    assert client.put("a", 1)
+    assert client.get("a") == 1
+    stats = client.stats()
+    assert stats["node"] == node.identification
+    assert stats["received"]["PUT"] == 1 and stats["received"]["GET"] == 1
+    assert stats["routed"]["GET"] == {"local": 1, "forwarded": 0}
+    assert stats["gauges"]["keys"] == 1 and stats["gauges"]["vnodes"] == 1
+    text = client.stats(prometheus=True)
+    assert 'dht_keys{{node="{}"}} 1'.format(node.identification) in text.splitlines()
@@ -0,0 +1,115 @@
+"""Tests replication and quorums on a node whose neighbours are set by hand."""
+import pytest
+from DHTNode import DHTNode
+
+CLIENT = ("localhost", 7000)
+SUCCESSORS = [(959, ("localhost", 5001)), (257, ("localhost", 5003)), (260, ("localhost", 5002))]
+
+
+@pytest.fixture()
+def node(make_node):
+    # node 770, between 654 and 959
+    return lambda **kwargs: make_node(successor_list=SUCCESSORS, **kwargs)
+
+
+def test_successor_list(node):
+    assert node(replicas=0, successors=1).successor_list == SUCCESSORS[:1]
+    assert node(replicas=0).successor_list == SUCCESSORS
+    assert node(replicas=2, successors=1).successor_list == SUCCESSORS
+
+
+def test_write_quorum(node):
+    n = node(replicas=2, write_quorum=2)
+
+    n.put("13", "Aveiro", CLIENT, 1)  # dht_hash("13") = 765
+    assert n.keystore == {"13": "Aveiro"}
+    assert [(a, m["method"]) for a, m in n.sent] == [(SUCCESSORS[0][1], "REPLICATE"), (SUCCESSORS[1][1], "REPLICATE")]
+    token = n.sent[0][1]["args"]["token"]
+
+    n.sent.clear()
+    n.replica_stored({"token": token})
+    owner = {"id": 770, "addr": ("localhost", 5000), "predecessor_id": 654}
+    assert n.sent == [(CLIENT, {"method": "ACK", "request_id": 1, "owner": owner})]
+
+    n.sent.clear()
+    n.replica_stored({"token": token})
+    assert n.sent == []
+
+
+def test_replica_answers_get(node):
+    replica = node(replicas=1)
+    replica.store_replica({"items": {"1": "Porto"}, "token": None, "from": None})
+
+    replica.get("1", CLIENT, 2, replica=True)  # dht_hash("1") = 796, not mine
+    assert replica.sent == [(CLIENT, {"method": "ACK", "args": "Porto", "request_id": 2})]
+
+
+def test_read_spread_over_replicas(node):
+    n = node(replicas=2)
+
+    for _ in range(50):
+        n.get("1", CLIENT, 3)  # owned by my successor 959
+    targets = {address for address, msg in n.sent}
+    assert targets == {address for _, address in SUCCESSORS}
+    assert all(msg["args"]["replica"] for _, msg in n.sent)
+    # the replica tells the client who owns the key, not itself
+    owner = {"id": 959, "addr": ("localhost", 5001), "predecessor_id": 770}
+    assert all(msg["args"]["owner"] == owner for _, msg in n.sent)
+
+
+def test_read_quorum(node):
+    n = node(replicas=2, read_quorum=2)
+
+    n.get("1", CLIENT, 4)
+    assert [m["method"] for _, m in n.sent] == ["GET_REPLICA", "GET_REPLICA"]
+    token = n.sent[0][1]["args"]["token"]
+
+    n.sent.clear()
+    n.replica_read({"token": token, "found": False, "value": None})
+    assert n.sent == []
+    n.replica_read({"token": token, "found": True, "value": "Porto"})
+    owner = {"id": 959, "addr": ("localhost", 5001), "predecessor_id": 770}
+    assert n.sent == [(CLIENT, {"method": "ACK", "args": "Porto", "request_id": 4, "owner": owner})]
+
+
+def test_lost_replica_ack_expires(node, clock):
+    n = node(replicas=2, write_quorum=3, timeout=2, clock=clock)
+    n.put("13", "Aveiro", CLIENT, 5)
+    token = n.sent[0][1]["args"]["token"]
+    n.replica_stored({"token": token})  # the other REPLICATE_ACK is lost
+
+    n.sent.clear()
+    clock.now = 1.9
+    n.expire_requests()
+    assert n.sent == []
+    clock.now = 2
+    n.expire_requests()
+    owner = {"id": 770, "addr": ("localhost", 5000), "predecessor_id": 654}
+    assert n.sent == [(CLIENT, {"method": "NACK", "request_id": 5, "owner": owner})]
+    assert n.pending_writes == {}
+
+    n.sent.clear()
+    n.replica_stored({"token": token})  # too late
+    assert n.sent == []
+
+
+def test_lost_replica_reply_expires(node, clock):
+    n = node(replicas=2, read_quorum=2, timeout=2, clock=clock)
+    n.get("1", CLIENT, 6)
+    n.get("1", CLIENT, 7)
+    first, second = n.sent[0][1]["args"]["token"], n.sent[2][1]["args"]["token"]
+    n.replica_read({"token": first, "found": True, "value": "Porto"})  # the other reply is lost
+    n.replica_read({"token": second, "found": False, "value": None})  # this one too
+
+    n.sent.clear()
+    clock.now = 2
+    n.expire_requests()
+    # a copy found is current, keys are never overwritten
+    assert sorted((msg["request_id"], msg["method"], msg.get("args")) for _, msg in n.sent) == \
+        [(6, "ACK", "Porto"), (7, "NACK", None)]
+    assert n.pending_reads == {}
+
+
+def test_invalid_quorum():
+    with pytest.raises(ValueError):
+        DHTNode(("localhost", 5000), replicas=1, write_quorum=3)
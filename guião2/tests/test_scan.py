@@ -0,0 +1,69 @@
+"""Tests walking the keys of the DHT in pages with SCAN."""
+import time
+import pytest
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from simulator import Simulator
+from utils import dht_hash
+
+
+def scan_all(sim, limit):
+    """Every page of a scan of the simulated DHT, each from a random entry node."""
+    pages = []
+    token = None
+    while True:
+        lookup = sim.scan(token, limit)
+        sim.run(1)
+        pages.append(lookup.reply["args"]["items"])
+        token = lookup.reply["args"]["token"]
+        if token is None:
+            return pages
+
+
+def ring_order(sim, keys):
+    return sorted(keys, key=lambda key: (dht_hash(key, maximum=2 ** sim.m_bits), key))
+
+
+@pytest.mark.parametrize("vnodes", [1, 4])
+def test_scan_walks_every_key_in_order(vnodes):
+    sim = Simulator(seed=8, vnodes=vnodes)
+    sim.build(20)
+    keys = ["key{}".format(i) for i in range(300)]
+    for key in keys:
+        sim.put(key, key.upper())
+    sim.run(2)
+    pages = scan_all(sim, 7)
+    assert all(len(page) <= 7 for page in pages)
+    items = [item for page in pages for item in page]
+    assert [key for key, _ in items] == ring_order(sim, keys)
+    assert all(value == key.upper() for key, value in items)
+    # a page ends early at most once per node, where the walk moves on to the next one
+    assert len(pages) <= 300 // 7 + 1 + len(sim.nodes())
+
+
+def test_scan_of_empty_dht():
+    sim = Simulator(seed=9)
+    sim.build(5)
+    pages = scan_all(sim, 10)
+    # one page per node, two from the one whose range wraps past the top of the ring
+    assert pages == [[]] * 6
+
+
+@pytest.fixture()
+def node(address):
+    node = DHTNode(address, timeout=0.5)
+    node.start()
+    time.sleep(0.2)  # bound and alone in the DHT
+    yield node
+    node.done = True
+    node.join()
+
+
+def test_client_scan(node):
+    client = DHTClient(node.addr)
+    keys = ["k{}".format(i) for i in range(25)]
+    assert all(client.put_many({key: i for i, key in enumerate(keys)}).values())
+    assert list(client.scan(limit=10)) == [(key, keys.index(key)) for key in sorted(
+        keys, key=lambda key: (client.key_id(key), key))]
+    items, token = client.scan_page(limit=30)
+    assert len(items) == 25 and token is None
@@ -0,0 +1,84 @@
+"""Tests the discrete-event simulator, and the DHT running in it."""
+import math
+from simulator import Simulator
+
+
+def store(sim, count):
+    keys = ["key{}".format(i) for i in range(count)]
+    puts = [sim.put(key, key) for key in keys]
+    sim.run(2)
+    assert all(put.reply["method"] == "ACK" for put in puts)
+    return keys
+
+
+def read_all(sim, keys):
+    gets = [sim.get(key) for key in keys]
+    sim.run(2)
+    return [get.reply["args"] if get.reply and get.reply["method"] == "ACK" else None for get in gets], gets
+
+
+def test_lookups_on_built_ring():
+    sim = Simulator(seed=1)
+    sim.build(300)
+    assert sim.converged(fingers=True)
+    keys = store(sim, 200)
+    values, gets = read_all(sim, keys)
+    assert values == keys
+    assert max(get.hops for get in gets) <= 2 * math.log2(300)
+    assert all(get.messages == get.hops + 2 for get in gets)  # request, forwards, reply
+
+
+def test_ring_grown_by_joins_converges():
+    sim = Simulator(seed=2)
+    sim.add_node()
+    for _ in range(19):
+        sim.run(0.05)
+        sim.add_node()
+    assert sim.run_until(sim.converged, 30) is not None
+    assert sim.run_until(lambda: sim.converged(fingers=True), 60) is not None
+    keys = store(sim, 50)
+    assert read_all(sim, keys)[0] == keys
+
+
+def test_same_seed_same_run():
+    runs = []
+    for _ in range(2):
+        sim = Simulator(seed=3)
+        sim.build(50)
+        for _ in range(5):
+            sim.add_node()
+        store(sim, 20)
+        runs.append((sim.now, dict(sim.delivered), [node.identification for node in sim.nodes()]))
+    assert runs[0] == runs[1]
+
+
+def test_keys_survive_leaves():
+    # quiet nodes refresh a finger every timeout * 4 seconds, keep the sweep short
+    sim = Simulator(seed=4, timeout=0.5)
+    sim.build(50)
+    keys = store(sim, 100)
+    for _ in range(5):
+        sim.leave(sim.alive[0])
+        sim.run(1)
+    assert sim.run_until(lambda: sim.converged(fingers=True), 120) is not None
+    assert read_all(sim, keys)[0] == keys
+
+
+def test_crashed_host_drops_messages():
+    sim = Simulator(seed=5)
+    sim.build(20)
+    host = sim.alive[3]
+    sim.crash(host)
+    sim.get("key", entry=host)
+    sim.run(1)
+    assert sim.dropped >= 1
+    assert not sim.converged()
+
+
+def test_virtual_nodes():
+    sim = Simulator(seed=6, vnodes=4)
+    sim.build(30)
+    assert len(sim.nodes()) > 100
+    assert sim.converged(fingers=True)
+    keys = store(sim, 100)
+    assert read_all(sim, keys)[0] == keys
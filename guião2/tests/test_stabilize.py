@@ -0,0 +1,95 @@
+"""Tests the stabilize scheduler and finger maintenance, with messages delivered by hand."""
+from DHTNode import StabilizeScheduler
+
+
+def test_scheduler_backs_off_after_quiet_sweeps():
+    scheduler = StabilizeScheduler(1, 8, patience=3)
+    intervals = []
+    for _ in range(12):
+        scheduler.schedule()
+        intervals.append(scheduler.interval)
+    assert intervals == [1, 1, 2, 2, 2, 4, 4, 4, 8, 8, 8, 8]
+
+
+def test_scheduler_speeds_up_on_change():
+    scheduler = StabilizeScheduler(1, 8, patience=1)
+    for _ in range(5):
+        scheduler.schedule()
+    assert scheduler.interval == 8
+    assert not scheduler.due()
+
+    scheduler.changed()
+    assert scheduler.interval == 1
+    assert scheduler.wait() <= 1
+    scheduler.schedule()
+    assert scheduler.interval == 1  # the round after a change does not back off
+
+
+def test_tick_refreshes_one_finger(make_node):
+    node = make_node(("localhost", 4000), (260, ("localhost", 5002)), [(654, ("localhost", 5004))])
+    for _ in range(node.m_bits + 1):
+        node.tick()
+    # starts up to my successor 654 need no lookup
+    probes = [msg["args"]["id"] for _, msg in node.sent if msg["method"] == "SUCCESSOR"]
+    assert probes == [709, 837, 69]
+    assert sum(msg["method"] == "PREDECESSOR" for _, msg in node.sent) == node.m_bits + 1
+
+
+def test_tick_probes_through_closest_finger(make_node):
+    node = make_node(("localhost", 4000), (260, ("localhost", 5002)), [(654, ("localhost", 5004))])
+    node.finger_table.update(8, 770, ("localhost", 5000))
+    node.finger_table.update(9, 959, ("localhost", 5001))
+    node.next_finger = 9  # start 69, past 959
+    node.tick()
+    assert node.sent[-1] == (("localhost", 5001), {"method": "SUCCESSOR", "args": {"id": 69, "from": ("localhost", 4000)}})
+
+    node.next_finger = 0  # start 582, up to my successor: no lookup
+    node.finger_table.update(1, 600, ("localhost", 5009))
+    node.tick()
+    assert node.sent[-1][1]["method"] == "PREDECESSOR"
+    assert node.finger_table.as_list[0] == (654, ("localhost", 5004))
+
+
+def test_fix_finger_reports_changes(make_node):
+    node = make_node(("localhost", 4000), (260, ("localhost", 5002)), [(654, ("localhost", 5004))])
+    node.scheduler.dirty = False
+    node.fix_finger({"req_id": 582, "successor_id": 654, "successor_addr": ("localhost", 5004)})
+    assert not node.scheduler.dirty
+
+    node.fix_finger({"req_id": 709, "successor_id": 752, "successor_addr": ("localhost", 3000)})
+    assert node.finger_table.as_list[7] == (752, ("localhost", 3000))
+    assert node.scheduler.dirty
+
+
+def test_finger_hint(make_node):
+    # 581's 8th finger (start 709) pointed at 770 until 752 joined
+    node = make_node(("localhost", 4000), (260, ("localhost", 5002)), [(654, ("localhost", 5004))])
+    node.finger_table.update(8, 770, ("localhost", 5000))
+    hint = {"id": 752, "addr": ("localhost", 3000), "target": 624}
+
+    node.finger_hint(hint)
+    assert node.finger_table.as_list[7] == (752, ("localhost", 3000))
+    assert node.finger_table.as_list[:7] == [(654, ("localhost", 5004))] * 7
+    # passed on to my predecessor, which may need it as well
+    (address, msg), = node.sent
+    assert address == ("localhost", 5002)
+    assert msg == {"method": "FINGER_HINT", "args": dict(hint, target=581)}
+
+    node.sent.clear()
+    node.finger_hint(hint)  # nothing left to change: stop here
+    assert node.sent == []
+
+
+def test_finger_hint_routing(make_node):
+    node = make_node(("localhost", 4000), (260, ("localhost", 5002)), [(654, ("localhost", 5004))])
+    node.finger_hint({"id": 100, "addr": ("localhost", 3001), "target": 900})
+    (address, msg), = node.sent
+    assert address == ("localhost", 5004)
+    assert msg["method"] == "FINGER_HINT"
+
+
+def test_own_finger_hint_is_ignored(make_node):
+    node = make_node(("localhost", 4000), (260, ("localhost", 5002)), [(654, ("localhost", 5004))])
+    node.finger_hint({"id": 581, "addr": ("localhost", 4000), "target": 581})
+    assert node.sent == []
+    assert set(node.finger_table.as_list) == {(654, ("localhost", 5004))}
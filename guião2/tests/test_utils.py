@@ -1,6 +1,7 @@
 """Tests two clients."""
 import pytest
-from utils import contains
+import sys
+from utils import contains, dht_hash, dht_hash_many, load_imbalance, ring_size, M_BITS
 
 
 def test_contains():
@@ -17,3 +18,31 @@ def test_contains():
     assert contains(800, 300, 300)
     assert not contains(800, 300, 700)
     assert not contains(800, 300, 400)
+
+
+def test_dht_hash():
+    assert dht_hash("d") == 115
+    assert dht_hash("f") == 921
+    assert dht_hash("f", maximum=ring_size(160)) % 2**10 == 921
+    assert dht_hash("f") == dht_hash("f", maximum=ring_size(M_BITS))
+    with pytest.raises(ValueError):
+        ring_size(161)
+
+
+@pytest.mark.parametrize("numpy", [True, False])
+@pytest.mark.parametrize("m_bits", [10, 32, 64, 160])
+def test_dht_hash_many(monkeypatch, numpy, m_bits):
+    if not numpy:
+        # import numpy raises ImportError, forcing the bytes-based path
+        monkeypatch.setitem(sys.modules, "numpy", None)
+    keys = ["", "A", "2", "10", "Aveiro", "ção", "\U0001F600" * 3, "x" * 5000] + [str(i) for i in range(100)]
+
+    maximum = ring_size(m_bits)
+    assert dht_hash_many(keys, maximum=maximum) == [dht_hash(k, maximum=maximum) for k in keys]
+
+
+
+def test_load_imbalance():
+    assert load_imbalance([1, 1, 1]) == 1
+    assert load_imbalance([3, 1, 1, 3]) == 1.5
+    assert load_imbalance([0, 0]) == 1
@@ -0,0 +1,102 @@
+"""Tests nodes taking several ids (virtual nodes) in the ring."""
+import time
+import pytest
+from DHTClient import DHTClient
+from DHTNode import DHTNode, virtual_addresses
+from utils import dht_hash, ring_size
+from tests.conftest import free_port
+
+
+def test_virtual_addresses():
+    addresses = virtual_addresses(("localhost", 5000), 8, ring_size(10))
+    assert addresses[0] == ("localhost", 5000)
+    assert all(address[:2] == ("localhost", 5000) for address in addresses)
+    ids = [dht_hash(str(address)) for address in addresses]
+    assert len(set(ids)) == 8
+    # a tiny ring has room for fewer ids than asked for
+    assert len(virtual_addresses(("localhost", 5000), 8, ring_size(2))) == 4
+
+
+def test_envelope():
+    host = DHTNode(("localhost", 4000), vnodes=3)
+    virtual = host.vnodes[2]
+    assert virtual.host is host and virtual.keystore is host.keystore
+    assert host.envelope(("localhost", 5000), {"method": "ACK"}) == (("localhost", 5000), {"method": "ACK"})
+    assert host.envelope(("localhost", 5000, 1), {"method": "ACK"}) == \
+        (("localhost", 5000), {"method": "ACK", "vnode": 1})
+    assert virtual.envelope(("localhost", 5000), {"method": "ACK"}) == \
+        (("localhost", 5000), {"method": "ACK", "from_vnode": 2})
+
+
+def stable(nodes):
+    """Whether successor and predecessor pointers follow the sorted ids."""
+    ids = sorted(node.identification for node in nodes)
+    for node in nodes:
+        i = ids.index(node.identification)
+        if node.successor_id != ids[(i + 1) % len(ids)] or node.predecessor_id != ids[i - 1]:
+            return False
+    return True
+
+
+def distinct_addresses(count, vnodes):
+    """Addresses on free ports whose virtual nodes all take different ids."""
+    addresses, ids = [], set()
+    while len(addresses) < count:
+        address = ("localhost", free_port())
+        taken = {dht_hash(str(virtual)) for virtual in virtual_addresses(address, vnodes, ring_size(10))}
+        if len(taken) == vnodes and not taken & ids:
+            addresses.append(address)
+            ids |= taken
+    return addresses
+
+
+@pytest.fixture()
+def hosts():
+    first_addr, second_addr = distinct_addresses(2, 4)
+    first = DHTNode(first_addr, timeout=0.5, vnodes=4)
+    first.start()
+    time.sleep(0.2)
+    second = DHTNode(second_addr, first.addr, timeout=0.5, vnodes=4)
+    second.start()
+    nodes = lambda: list(first.vnodes.values()) + list(second.vnodes.values())
+    deadline = time.time() + 10
+    while not (all(node.inside_dht for node in nodes()) and stable(nodes())) and time.time() < deadline:
+        time.sleep(0.1)
+    yield first, second
+    for host in (first, second):
+        host.done = True
+        host.join()
+
+
+def test_ring(hosts):
+    first, second = hosts
+    nodes = list(first.vnodes.values()) + list(second.vnodes.values())
+    assert len(nodes) == 8
+    assert stable(nodes)
+    assert first.ring_share() + second.ring_share() == pytest.approx(1)
+
+
+def test_requests_and_leave(hosts):
+    first, second = hosts
+    client = DHTClient(first.addr)
+    keys = [str(i) for i in range(50)]
+    for key in keys:
+        assert client.put(key, key)
+    assert len(second.keystore) > 0
+    # the cache holds virtual nodes, requests reach them through their host
+    assert any(len(addr) > 2 for addr, _ in client.ring.nodes.values())
+    assert [client.get(key) for key in keys] == keys
+
+    second.leave()
+    second.join()
+    assert len(first.keystore) == len(keys)
+    # no failure detection: wait for stabilize to move the fingers off the nodes that left
+    ids = {node.identification for node in first.vnodes.values()}
+    settled = lambda: stable(first.vnodes.values()) and all(
+        finger_id in ids for node in first.vnodes.values() for finger_id, _ in node.finger_table.as_list)
+    deadline = time.time() + 10
+    while not settled() and time.time() < deadline:
+        time.sleep(0.1)
+    assert settled()
+    assert first.ring_share() == pytest.approx(1)
+    assert DHTClient(first.addr).get_many(keys) == {key: key for key in keys}
@@ -0,0 +1,94 @@
+"""Tests a single node handling client requests on a worker pool."""
+import socket
+import threading
+import time
+import pytest
+from codec import encode, decode
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from storage import DictStore
+
+
+class SlowStore(DictStore):
+    """Keystore taking a while to write, like a disk would, counting the writes it is doing at once."""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.writing = 0
+        self.most_writing = 0
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.writing += 1
+            self.most_writing = max(self.most_writing, self.writing)
+        time.sleep(0.05)
+        super().__setitem__(key, value)
+        with self.lock:
+            self.writing -= 1
+
+
+@pytest.fixture()
+def node(address):
+    node = DHTNode(address, timeout=0.5, keystore=SlowStore(), workers=4, queue_size=64)
+    node.start()
+    time.sleep(0.2)  # bound and alone in the DHT
+    yield node
+    node.done = True
+    node.join()
+
+
+def test_requests(node):
+    client = DHTClient(node.addr)
+    assert client.put("a", 1)
+    assert not client.put("a", 2)
+    assert client.get("a") == 1
+    assert client.get_many(["a", "b"]) == {"a": 1, "b": None}
+
+
+def test_concurrent_puts_of_one_key(node):
+    results = []
+
+    def put(value):
+        results.append(DHTClient(node.addr).put("same", value))
+
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False] * 7 + [True]
+
+
+def put_all(node, keys):
+    threads = [threading.Thread(target=DHTClient(node.addr).put, args=(key, key)) for key in keys]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def test_workers_store_in_parallel(node):
+    for thread in put_all(node, ["p%d" % i for i in range(8)]):
+        thread.join()
+    assert all(node.keystore["p%d" % i] == "p%d" % i for i in range(8))
+    assert 1 < node.keystore.most_writing <= 4
+
+
+def test_ring_messages_not_stuck_behind_writes(node):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("localhost", 0))
+    sock.settimeout(1)
+    writers = put_all(node, ["r%d" % i for i in range(16)])
+    while not node.keystore.writing:
+        time.sleep(0.001)
+
+    args = {"id": 1, "from": sock.getsockname()}
+    sock.sendto(encode({"method": "SUCCESSOR", "args": args}), node.addr)
+    reply = decode(sock.recvfrom(1024)[0])
+    # answered by the node thread while the workers still have writes queued
+    assert reply["method"] == "SUCCESSOR_REP"
+    assert sum("r%d" % i in node.keystore for i in range(16)) < 16
+
+    for writer in writers:
+        writer.join()
+    sock.close()
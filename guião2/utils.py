@@ -1,14 +1,96 @@
-def dht_hash(text, seed=0, maximum=2**10):
+import struct
+
+# Ring-wide identifier size; ids live in [0, 2^M_BITS[
+M_BITS = 10
+MAX_M_BITS = 160
+
+# Largest UDP payload, nodes and clients read whole datagrams of this size
+DATAGRAM_SIZE = 65507
+
+FNV_PRIME = 16777619
+OFFSET_BASIS = 2166136261
+
+
+def ring_size(m_bits=M_BITS):
+    """ Number of identifiers in a ring of m_bits (2^m). """
+    if not 0 < m_bits <= MAX_M_BITS:
+        raise ValueError("m_bits must be in [1, {}], got {}".format(MAX_M_BITS, m_bits))
+    return pow(2, m_bits)
+
+
+def dht_hash(text, seed=0, maximum=ring_size(M_BITS)):
     """ FNV-1a Hash Function. """
-    fnv_prime = 16777619
-    offset_basis = 2166136261
-    h = offset_basis + seed
+    # Only the low bits survive the final modulo when maximum is a power of 2,
+    # so truncate every step instead of growing a big integer per character.
+    mask = maximum - 1 if (maximum & (maximum - 1)) == 0 else -1
+    h = (OFFSET_BASIS + seed) & mask
     for char in text:
         h = h ^ ord(char)
-        h = h * fnv_prime
+        h = (h * FNV_PRIME) & mask
     return h % maximum
 
 
+def _codepoints(text):
+    """ Unicode code points of text, unpacked at once (no per-char ord()). """
+    return struct.unpack("<{}I".format(len(text)), text.encode("utf-32-le"))
+
+
+def _dht_hash_many_numpy(numpy, keys, seed, maximum):
+    """ Column-wise FNV-1a over the keys, a (keys x length) matrix of code points per key length. """
+    by_length = {}
+    for index, key in enumerate(keys):
+        by_length.setdefault(len(key), []).append(index)
+
+    hashes = numpy.empty(len(keys), dtype=numpy.uint64)
+    prime = numpy.uint64(FNV_PRIME)
+    for length, indexes in by_length.items():
+        # keys of one length fill a dense matrix, so memory stays linear in the total length
+        flat = numpy.frombuffer("".join(keys[i] for i in indexes).encode("utf-32-le"), dtype="<u4")
+        chars = flat.astype(numpy.uint64).reshape(len(indexes), length)
+        # uint64 arithmetic wraps mod 2^64, which keeps the low m <= 64 bits exact
+        h = numpy.full(len(indexes), (OFFSET_BASIS + seed) % 2**64, dtype=numpy.uint64)
+        with numpy.errstate(over="ignore"):
+            for col in range(length):
+                h = (h ^ chars[:, col]) * prime
+        hashes[indexes] = h
+    return (hashes & numpy.uint64(maximum - 1)).tolist()
+
+
+def dht_hash_many(keys, seed=0, maximum=ring_size(M_BITS)):
+    """ dht_hash() of every key in keys, in one call.
+
+    Uses NumPy when it is installed and the ring fits in 64 bits, otherwise a
+    bytes-based loop over the UTF-32 code points of each key.
+    """
+    keys = list(keys)
+    if (maximum & (maximum - 1)) != 0:
+        return [dht_hash(key, seed, maximum) for key in keys]
+    if maximum <= 2**64 and keys:
+        try:
+            import numpy    # optional, nodes never pay for importing it
+        except ImportError:
+            pass
+        else:
+            return _dht_hash_many_numpy(numpy, keys, seed, maximum)
+
+    mask = maximum - 1
+    start = (OFFSET_BASIS + seed) & mask
+    hashes = []
+    for key in keys:
+        h = start
+        for code in _codepoints(key):
+            h = ((h ^ code) * FNV_PRIME) & mask
+        hashes.append(h)
+    return hashes
+
+
+def load_imbalance(loads):
+    """ Largest load over the mean load, 1 when every node carries the same. """
+    loads = list(loads)
+    mean = sum(loads) / len(loads)
+    return max(loads) / mean if mean else 1.0
+
+
 def contains(begin, end, node):
     """Check node is contained between begin and end in a ring."""
     if end >= node and node > begin: return True
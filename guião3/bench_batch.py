@@ -0,0 +1,82 @@
+"""Batching benchmark: messages delivered per second, and broker CPU per message, vs producer batch size.
+
+The broker runs in this process (on its usual port, so no other broker may
+be running), a producer Queue and the subscribers in child processes. The
+subscribers decode what they get, batches included, and count the values.
+The first row is the broker as it was, a frame per value to each subscriber
+with no coalescing of the publishes it reads at once.
+"""
+import argparse
+import multiprocessing
+import socket
+import threading
+import time
+
+from src.broker import Broker
+from src.middleware import MiddlewareType, PickleQueue
+from src.protocol import Connection, PubSubProtocol, Serializer
+
+
+def subscribers(topic, count, expected, ready, done):
+    """Subscribe count connections to topic and wait for expected values in all."""
+    connections = []
+    for _ in range(count):
+        sock = socket.create_connection(("localhost", 5000))
+        PubSubProtocol.sendMsg(sock, Serializer.PICKLE, PubSubProtocol.acknowledge(Serializer.PICKLE.value))
+        PubSubProtocol.sendMsg(sock, Serializer.PICKLE, PubSubProtocol.subscribe(topic))
+        connections.append(Connection(sock))
+    ready.set()
+    for connection in connections:
+        values = 0
+        while values < expected:
+            received = connection.recv()
+            values += len(received.messages) if received.type == "DeliverBatch" else 1
+    done.set()
+
+
+def producer(topic, messages, batch_size, linger):
+    queue = PickleQueue(topic, MiddlewareType.PRODUCER, batch_size=batch_size, linger=linger)
+    for i in range(messages):
+        queue.push(i)
+    queue.close()
+
+
+def run(broker, topic, count, messages, batch_size, linger):
+    """(values delivered per second, broker CPU seconds per value) of one run."""
+    ready, done = multiprocessing.Event(), multiprocessing.Event()
+    child = multiprocessing.Process(target=subscribers, args=(topic, count, messages, ready, done))
+    child.start()
+    ready.wait()
+    while len(broker.list_subscriptions(topic)) < count:
+        time.sleep(0.01)
+
+    start, cpu = time.perf_counter(), time.process_time()
+    sender = multiprocessing.Process(target=producer, args=(topic, messages, batch_size, linger))
+    sender.start()
+    done.wait()
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+    sender.join()
+    child.join()
+    return count * messages / elapsed, cpu / (count * messages)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--linger", type=float, default=0.005, help="seconds a value waits for its batch")
+    parser.add_argument("--subscribers", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=20000, help="values published per run")
+    args = parser.parse_args()
+
+    broker = Broker()
+    threading.Thread(target=broker.run, daemon=True).start()
+
+    coalesce = broker.coalesce
+    print("{:>12} {:>14} {:>18} {:>8}".format("batch", "msgs/s", "broker CPU us/msg", "speedup"))
+    base = None
+    for name, batch_size in [("unbatched", 1)] + [(str(size), size) for size in args.batch_sizes]:
+        broker.coalesce = coalesce if base else (lambda messages: messages)
+        rate, cpu = run(broker, "/bench/batch/{}".format(name), args.subscribers, args.messages,
+                        batch_size, args.linger)
+        base = base or rate
+        print("{:>12} {:>14.0f} {:>18.2f} {:>7.2f}x".format(name, rate, cpu * 1e6, rate / base))
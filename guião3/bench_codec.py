@@ -0,0 +1,38 @@
+"""Codec benchmark: encode and decode time, and body size, of each message type in each serializer."""
+import argparse
+import timeit
+
+from src.protocol import PubSubProtocol, Serializer
+
+MESSAGES = {
+    "Subscribe": PubSubProtocol.subscribe("/weather/temperature"),
+    "Publish": PubSubProtocol.publish("/weather/temperature", 23, 1500),
+    "TopicListRequest": PubSubProtocol.topicListRequest(),
+    "TopicListReply": PubSubProtocol.topicListReply(["/weather/temperature", "/weather/humidity", "/msg"]),
+    "CancelSubscription": PubSubProtocol.cancelSubscription("/weather/temperature"),
+    "Acknowledge": PubSubProtocol.acknowledge(Serializer.BINARY.value),
+    "PublishBatch": PubSubProtocol.publishBatch("/weather/temperature", list(range(20, 120))),
+    "DeliverBatch": PubSubProtocol.deliverBatch(
+        [PubSubProtocol.publish("/weather/temperature", i, 1500 + i) for i in range(100)]),
+}
+
+
+def measure(serializer, msg, number):
+    """(encode us, decode us, body bytes) of msg in serializer."""
+    body = PubSubProtocol.encode(serializer.value, msg)
+    encode = timeit.timeit(lambda: PubSubProtocol.encode(serializer.value, msg), number=number)
+    decode = timeit.timeit(lambda: PubSubProtocol.decode(serializer.value, body), number=number)
+    return encode / number * 1e6, decode / number * 1e6, len(body)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=2000, help="runs per measure")
+    args = parser.parse_args()
+
+    print("{:>20} {:>8} {:>11} {:>11} {:>7}".format("message", "codec", "encode us", "decode us", "bytes"))
+    for name, msg in MESSAGES.items():
+        number = max(1, args.number // 50) if "Batch" in name else args.number
+        for serializer in Serializer:
+            encode, decode, size = measure(serializer, msg, number)
+            print("{:>20} {:>8} {:>11.2f} {:>11.2f} {:>7}".format(name, serializer.name, encode, decode, size))
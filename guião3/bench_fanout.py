@@ -0,0 +1,99 @@
+"""Fan-out benchmark: messages delivered per second by the broker vs number of subscribers.
+
+The broker runs in this process (on its usual port, so no other broker may
+be running); the subscribers share a child process, counting the frames
+they get without decoding them. Each publish is sent to every subscriber,
+encoded once per serializer ("once") or once per subscriber as the broker
+used to ("each").
+"""
+import argparse
+import multiprocessing
+import selectors
+import socket
+import threading
+import time
+
+from src.broker import Broker
+from src.protocol import HEADER, PubSubProtocol, Serializer
+
+
+def subscribers(topic, serializers, count, expected, ready, done):
+    """Subscribe count sockets to topic and wait for expected frames in all."""
+    sel = selectors.DefaultSelector()
+    buffers = {}
+    for i in range(count):
+        sock = socket.create_connection(("localhost", 5000))
+        serializer = serializers[i % len(serializers)]
+        PubSubProtocol.sendMsg(sock, 0, PubSubProtocol.acknowledge(serializer.value))
+        PubSubProtocol.sendMsg(sock, serializer, PubSubProtocol.subscribe(topic))
+        sel.register(sock, selectors.EVENT_READ)
+        buffers[sock] = bytearray()
+    ready.set()
+
+    frames = 0
+    while frames < expected:
+        for key, _ in sel.select():
+            data = buffers[key.fileobj]
+            data += key.fileobj.recv(65536)
+            start = 0
+            while len(data) - start >= HEADER.size:
+                _, length = HEADER.unpack_from(data, start)
+                if len(data) - start < HEADER.size + length:
+                    break
+                start += HEADER.size + length
+                frames += 1
+            del data[:start]
+    done.set()
+    for sock in buffers:
+        sock.close()
+
+
+def encode_each(msg, subscribers):
+    """The broker's fan-out before frames were shared: one encoding per subscriber."""
+    for conn, serializer in subscribers:
+        PubSubProtocol.sendMsg(conn, serializer, msg)
+
+
+def run(broker, topic, count, messages, serializers):
+    """Deliveries per second of messages publishes on topic to count subscribers."""
+    ready, done = multiprocessing.Event(), multiprocessing.Event()
+    child = multiprocessing.Process(target=subscribers,
+                                    args=(topic, serializers, count, count * messages, ready, done))
+    child.start()
+    ready.wait()
+    while len(broker.list_subscriptions(topic)) < count:
+        time.sleep(0.01)
+
+    producer = socket.create_connection(("localhost", 5000))
+    start = time.perf_counter()
+    for i in range(messages):
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.publish(topic, i))
+    done.wait()
+    elapsed = time.perf_counter() - start
+    producer.close()
+    child.join()
+    return count * messages / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--messages", type=int, default=200, help="publishes per run")
+    parser.add_argument("--serializers", nargs="+", default=["JSON", "XML", "PICKLE"],
+                        choices=[serializer.name for serializer in Serializer],
+                        help="serializers of the subscribers, taken in turn")
+    args = parser.parse_args()
+    serializers = [Serializer[name] for name in args.serializers]
+
+    broker = Broker()
+    threading.Thread(target=broker.run, daemon=True).start()
+    fan_out = broker.fan_out
+
+    print("{:>12} {:>14} {:>14} {:>8}".format("subscribers", "each msgs/s", "once msgs/s", "speedup"))
+    for count in args.subscribers:
+        rates = []
+        for variant in (encode_each, fan_out):
+            broker.fan_out = variant
+            rates.append(run(broker, "/bench/{}/{}".format(count, variant.__name__), count, args.messages,
+                             serializers))
+        print("{:>12} {:>14.0f} {:>14.0f} {:>7.2f}x".format(count, rates[0], rates[1], rates[1] / rates[0]))
@@ -0,0 +1,69 @@
+"""Sharding benchmark: publishes per second the broker takes in vs number of shard worker processes.
+
+The front runs in this process (on port 5000, so no other broker may be
+running), the producers in child processes, each publishing on a root
+topic of its own so they spread over the shards. A producer is done when
+the answer to a topic list asked for after its last publish comes back.
+Throughput only grows with the shards while there are free cores for them.
+"""
+import argparse
+import multiprocessing
+import socket
+import threading
+import time
+
+from src.protocol import Connection, PubSubProtocol, Serializer
+from src.shards import ShardedBroker
+
+
+def producer(topic, messages, ready, go):
+    """Publish messages on topic as fast as possible, once go is set."""
+    sock = socket.create_connection(("localhost", 5000))
+    connection = Connection(sock)
+    ready.release()
+    go.wait()
+    for i in range(messages):
+        PubSubProtocol.sendMsg(sock, Serializer.PICKLE, PubSubProtocol.publish(topic, i))
+    connection.send(Serializer.PICKLE, PubSubProtocol.topicListRequest())
+    connection.recv()               # answered after every publish before it
+    sock.close()
+
+
+def run(shards, producers, messages):
+    """Publishes per second of producers publishing messages each, with shards workers."""
+    broker = ShardedBroker(shards=shards)
+    thread = threading.Thread(target=broker.run)
+    thread.start()
+
+    ready, go = multiprocessing.Semaphore(0), multiprocessing.Event()
+    children = [multiprocessing.Process(target=producer, args=("/bench{}/value".format(i), messages, ready, go))
+                for i in range(producers)]
+    for child in children:
+        child.start()
+    for _ in children:
+        ready.acquire()
+    start = time.perf_counter()
+    go.set()
+    for child in children:
+        child.join()
+    elapsed = time.perf_counter() - start
+
+    broker.canceled = True
+    thread.join()
+    return producers * messages / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--producers", type=int, default=16, help="producer processes, one root topic each")
+    parser.add_argument("--messages", type=int, default=5000, help="publishes per producer")
+    args = parser.parse_args()
+
+    print("{} cores".format(multiprocessing.cpu_count()))
+    print("{:>8} {:>14} {:>8}".format("shards", "publishes/s", "speedup"))
+    base = None
+    for shards in args.shards:
+        rate = run(shards, args.producers, args.messages)
+        base = base or rate
+        print("{:>8} {:>14.0f} {:>7.2f}x".format(shards, rate, rate / base))
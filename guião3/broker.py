@@ -1,7 +1,38 @@
 """Call broker."""
+import argparse
 
+from src.async_broker import AsyncBroker, Overflow
 from src.broker import Broker
+from src.shards import ShardedBroker
+from src.topiclog import MessageLog
 
 if __name__ == "__main__":
-    broker = Broker()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=["selectors", "asyncio"], default="selectors",
+                        help="asyncio gives each subscriber a queue and a writer task of its own")
+    parser.add_argument("--queue-size", type=int, default=1000, help="frames queued per subscriber (asyncio)")
+    parser.add_argument("--overflow", choices=[overflow.value for overflow in Overflow],
+                        default=Overflow.DROP_OLDEST.value, help="what to do with a subscriber's queue full (asyncio)")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="split the topics by root across this many worker processes (selectors)")
+    parser.add_argument("--log-dir", help="keep every value published there, for consumers to replay")
+    parser.add_argument("--segment-bytes", type=int, default=1 << 20, help="log segment size")
+    parser.add_argument("--segment-seconds", type=float, help="age a log segment is closed at")
+    parser.add_argument("--retention-bytes", type=int, help="most log bytes kept per topic")
+    parser.add_argument("--retention-seconds", type=float, help="age log records are deleted at")
+    args = parser.parse_args()
+    if args.shards and args.log_dir:
+        parser.error("--log-dir is not supported with --shards: shard workers keep no log")
+
+    log = None
+    if args.log_dir:
+        log = MessageLog(args.log_dir, args.segment_bytes, args.segment_seconds, args.retention_bytes,
+                         args.retention_seconds)
+
+    if args.shards:
+        broker = ShardedBroker(shards=args.shards)
+    elif args.engine == "asyncio":
+        broker = AsyncBroker(queue_size=args.queue_size, overflow=args.overflow, log=log)
+    else:
+        broker = Broker(log=log)
     broker.run()
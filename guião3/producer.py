@@ -65,6 +65,7 @@ q_protocol = {
     "json": src.middleware.JSONQueue,
     "xml": src.middleware.XMLQueue,
     "pickle": src.middleware.PickleQueue,
+    "binary": src.middleware.BinaryQueue,
 }
 
 q_generator = {
@@ -103,10 +104,19 @@ if __name__ == "__main__":
         choices=list(q_protocol.keys()),
         default=list(q_protocol.keys())[0],
     )
+    parser.add_argument("--batch-size", help="values sent per PublishBatch", type=int, default=1)
+    parser.add_argument(
+        "--linger", help="seconds a value waits for its batch to fill", type=float, default=0.005
+    )
     args = parser.parse_args()
 
     p = Producer(
-        q_subtopics[args.topic], q_generator[args.topic], q_protocol[args.queue_type]
+        q_subtopics[args.topic],
+        q_generator[args.topic],
+        q_protocol[args.queue_type],
+        batch_size=args.batch_size,
+        linger=args.linger,
     )
 
     p.run(int(args.length))
+    p.close()
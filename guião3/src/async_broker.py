@@ -0,0 +1,180 @@
+"""Message Broker on asyncio, each subscriber written to by its own task."""
+import asyncio
+import collections
+import enum
+
+from src.broker import Broker
+from src.protocol import HEADER, PubSubProtocol, PubSubProtocolBadFormat
+
+
+class Overflow(enum.Enum):
+    """What to do with a publish for a subscriber whose queue is full."""
+
+    DROP_OLDEST = "drop-oldest"     # make room by dropping the oldest frame queued for it
+    DISCONNECT = "disconnect"       # close the connection of the subscriber
+    BLOCK = "block"                 # hold the frame, and who sent what led to it, until there is room
+
+
+class Client:
+    """Connection to a client, with the frames waiting to be written to it."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, queue_size):
+        self.reader = reader
+        self.writer = writer
+        self.queue = asyncio.Queue(queue_size)  # frames not written yet, oldest first
+        self.gone = asyncio.get_running_loop().create_future()    # done once disconnected
+        self.held = collections.deque()     # frames waiting for room in the queue (BLOCK), oldest first
+        self.released = asyncio.Event()     # set while no frame is held
+        self.released.set()
+        self.serializer = 0         # serializer of the last message it sent
+        self.dropped = 0            # frames dropped with the queue full
+        self.task = None            # writer task
+
+    def hold(self, frame):
+        """Keep frame until there is room for it, after the frames held already."""
+        self.held.append(frame)
+        self.released.clear()
+
+    def release(self):
+        """Move the held frames the queue has room for into it."""
+        while self.held and not self.queue.full():
+            self.queue.put_nowait(self.held.popleft())
+        if not self.held:
+            self.released.set()
+
+    async def wait_released(self) -> bool:
+        """Wait until no frame is held, False if the client goes away first."""
+        if not self.held:
+            return True
+        released = asyncio.ensure_future(self.released.wait())
+        await asyncio.wait([released, self.gone], return_when=asyncio.FIRST_COMPLETED)
+        if not released.done():
+            released.cancel()
+            return False
+        return True
+
+
+class AsyncBroker(Broker):
+    """PubSub Message Broker where a slow subscriber only holds up itself.
+
+    Every subscriber has a queue of at most queue_size frames, written to
+    its socket by a task of its own, so a publish is only put on queues.
+    With a queue full, overflow tells whether the oldest frame in it is
+    dropped, the subscriber disconnected, or the frame held until the
+    queue has room. Under BLOCK the client whose message led to a frame
+    held is not read from until it is queued: a producer gets a
+    Backpressure "pause" message, and a "resume" one once the publish is
+    queued everywhere; a subscriber waits for the room its own stored
+    values, replay or topic list need.
+    """
+
+    def __init__(self, host="localhost", port=5000, queue_size=1000, overflow=Overflow.DROP_OLDEST, log=None):
+        """Initialize broker."""
+        super().__init__(host, port, log=log)
+        self.queue_size = queue_size
+        self.overflow = Overflow(overflow)
+        self.clients = set()        # {client1, client2, ...} -> connected clients
+
+    async def client_connected(self, reader, writer):
+        """Read the messages of a client until it goes away."""
+        client = Client(reader, writer, self.queue_size)
+        client.task = asyncio.ensure_future(self.write(client))
+        self.clients.add(client)
+        try:
+            while not client.gone.done():
+                header = await reader.readexactly(HEADER.size)
+                serializerCode, length = HEADER.unpack(header)
+                if length == 0: continue
+                received = PubSubProtocol.decode(serializerCode, await reader.readexactly(length))
+                if received is None: continue
+                client.serializer = serializerCode
+                if received.type == "Publish" or received.type == "PublishBatch":
+                    await self.publish(client, received)
+                else:
+                    self.handle(client, received)
+                    await client.wait_released()    # what it asked for goes to itself
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass                    # connection closed
+        except (PubSubProtocolBadFormat, KeyError):
+            pass                    # not a message of the protocol: close the connection
+        finally:
+            self.disconnect(client)
+
+    async def write(self, client):
+        """Write the frames queued for client, all that are waiting at once."""
+        try:
+            while True:
+                frames = [await client.queue.get()]
+                while not client.queue.empty():
+                    frames.append(client.queue.get_nowait())
+                client.release()
+                client.writer.writelines(part for frame in frames for part in frame)
+                await client.writer.drain()
+        except ConnectionError:
+            self.disconnect(client)
+
+    async def publish(self, producer, msg):
+        """Store msg (a publish or a batch) and queue it for its subscribers, holding the producer if so configured."""
+        topic = msg.topic
+        held = {}                   # {client1: None, ...} -> subscribers holding frames, in order
+        for client, frame in self.frames(self.record(msg), self.list_subscriptions(topic)):
+            self.deliver(client, frame)
+            if client.held:
+                held[client] = None
+        if not held:
+            return
+
+        self.signal(producer, PubSubProtocol.backpressure(topic, "pause"))
+        for client in held:
+            await client.wait_released()
+        self.signal(producer, PubSubProtocol.backpressure(topic, "resume"))
+
+    def signal(self, producer, msg):
+        """Send msg to producer now, ahead of whatever is queued for it."""
+        if not producer.gone.done():
+            producer.writer.writelines(PubSubProtocol.frame(producer.serializer, msg))
+
+    def deliver(self, conn, frame):
+        """Queue frame for client conn; with the queue full hold frame, drop conn's oldest one or conn itself."""
+        client = conn
+        if client.gone.done():
+            return
+        if self.overflow == Overflow.BLOCK and (client.held or client.queue.full()):
+            client.hold(frame)      # whoever is handled waits for it (see wait_released)
+            return
+        if client.queue.full():
+            if self.overflow == Overflow.DISCONNECT:
+                self.disconnect(client)
+                return
+            client.queue.get_nowait()
+            client.dropped += 1
+        client.queue.put_nowait(frame)
+
+    def disconnect(self, client):
+        """Forget client and close its connection, dropping what is queued for it."""
+        if client.gone.done():
+            return
+        client.gone.set_result(None)
+        client.held.clear()
+        self.unsubscribe("", client)
+        self.serialTypes.pop(client, None)
+        self.clients.discard(client)
+        if client.task is not asyncio.current_task():
+            client.task.cancel()
+        client.writer.close()
+
+    async def serve(self):
+        """Accept clients until canceled."""
+        server = await asyncio.start_server(self.client_connected, sock=self.broker)
+        while not self.canceled:
+            await asyncio.sleep(0.1)
+            if self.log is not None:
+                self.log.flush()
+        server.close()
+        for client in list(self.clients):
+            self.disconnect(client)
+        await server.wait_closed()
+
+    def run(self):
+        """Run until canceled."""
+        asyncio.run(self.serve())
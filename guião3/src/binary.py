@@ -0,0 +1,220 @@
+"""Compact binary encoding of typed values, in the MessagePack format.
+
+Covers None, bool, int (64 bits), float, str, bytes, list (and tuple) and
+dict, which is all a message carries; anything else is a TypeError rather
+than being pickled, so decoding never runs code from the wire. Data cut
+short, lengths past its end, keys that are not hashable and arrays or maps
+nested deeper than MAX_DEPTH are a ValueError.
+"""
+import struct
+
+_U8, _U16, _U32, _U64 = struct.Struct(">B"), struct.Struct(">H"), struct.Struct(">I"), struct.Struct(">Q")
+_I8, _I16, _I32, _I64 = struct.Struct(">b"), struct.Struct(">h"), struct.Struct(">i"), struct.Struct(">q")
+_F64 = struct.Struct(">d")
+
+
+_STRINGS = {}       # short strings (topics, mostly) -> their encoding, as they come again and again
+_STRINGS_MAX = 4096
+
+MAX_DEPTH = 64      # arrays and maps nested in one another, far more than a message has
+
+
+def packb(value) -> bytes:
+    """value encoded."""
+    out = bytearray()
+    _pack(value, out)
+    return bytes(out)
+
+
+def _pack_str(value: str, out: bytearray):
+    encoded = _STRINGS.get(value)
+    if encoded is None:
+        data = value.encode("utf-8")
+        length = len(data)
+        if length < 32:
+            encoded = bytes((0xa0 | length,)) + data
+        elif length < 0x100:
+            encoded = b"\xd9" + _U8.pack(length) + data
+        elif length < 0x10000:
+            encoded = b"\xda" + _U16.pack(length) + data
+        else:
+            encoded = b"\xdb" + _U32.pack(length) + data
+        if length < 64:
+            if len(_STRINGS) >= _STRINGS_MAX:
+                _STRINGS.clear()
+            _STRINGS[value] = encoded
+    out += encoded
+
+
+def _pack(value, out: bytearray):
+    kind = type(value)
+    if kind is str:
+        _pack_str(value, out)
+    elif kind is int:
+        if 0 <= value < 0x80:
+            out.append(value)
+        elif -32 <= value < 0:
+            out.append(value & 0xff)
+        elif 0 <= value < 0x100:
+            out += b"\xcc" + _U8.pack(value)
+        elif 0 <= value < 0x10000:
+            out += b"\xcd" + _U16.pack(value)
+        elif 0 <= value < 0x100000000:
+            out += b"\xce" + _U32.pack(value)
+        elif 0 <= value < 0x10000000000000000:
+            out += b"\xcf" + _U64.pack(value)
+        elif -0x80 <= value:
+            out += b"\xd0" + _I8.pack(value)
+        elif -0x8000 <= value:
+            out += b"\xd1" + _I16.pack(value)
+        elif -0x80000000 <= value:
+            out += b"\xd2" + _I32.pack(value)
+        elif -0x8000000000000000 <= value:
+            out += b"\xd3" + _I64.pack(value)
+        else:
+            raise TypeError("integer {} does not fit in 64 bits".format(value))
+    elif kind is dict:
+        length = len(value)
+        if length < 16:
+            out.append(0x80 | length)
+        elif length < 0x10000:
+            out += b"\xde" + _U16.pack(length)
+        else:
+            out += b"\xdf" + _U32.pack(length)
+        for key, item in value.items():
+            _pack(key, out)
+            _pack(item, out)
+    elif value is None:
+        out.append(0xc0)
+    elif kind is bool:
+        out.append(0xc3 if value else 0xc2)
+    elif kind is float:
+        out += b"\xcb" + _F64.pack(value)
+    elif kind is list or kind is tuple:
+        length = len(value)
+        if length < 16:
+            out.append(0x90 | length)
+        elif length < 0x10000:
+            out += b"\xdc" + _U16.pack(length)
+        else:
+            out += b"\xdd" + _U32.pack(length)
+        for item in value:
+            kind = type(item)
+            if kind is str:
+                _pack_str(item, out)
+            elif kind is int and 0 <= item < 0x80:
+                out.append(item)
+            elif item is None:
+                out.append(0xc0)
+            else:
+                _pack(item, out)
+    elif kind is bytes or kind is bytearray:
+        length = len(value)
+        if length < 0x100:
+            out += b"\xc4" + _U8.pack(length)
+        elif length < 0x10000:
+            out += b"\xc5" + _U16.pack(length)
+        else:
+            out += b"\xc6" + _U32.pack(length)
+        out += value
+    else:
+        raise TypeError("cannot encode {} in binary".format(kind.__name__))
+
+
+def unpackb(data):
+    """Value encoded in data (bytes or memoryview), which must hold nothing else."""
+    value, position = _unpack(data, 0)
+    if position != len(data):
+        raise ValueError("{} bytes left after the value".format(len(data) - position))
+    return value
+
+
+# fixed size formats: first byte -> (struct, size)
+_FIXED = {
+    0xcc: _U8, 0xcd: _U16, 0xce: _U32, 0xcf: _U64,
+    0xd0: _I8, 0xd1: _I16, 0xd2: _I32, 0xd3: _I64,
+    0xcb: _F64,
+}
+# lengths of str, bin, array and map: first byte -> (struct of the length, kind)
+_SIZED = {
+    0xd9: (_U8, "str"), 0xda: (_U16, "str"), 0xdb: (_U32, "str"),
+    0xc4: (_U8, "bin"), 0xc5: (_U16, "bin"), 0xc6: (_U32, "bin"),
+    0xdc: (_U16, "array"), 0xdd: (_U32, "array"),
+    0xde: (_U16, "map"), 0xdf: (_U32, "map"),
+}
+
+
+def _unpack(data, position, depth=0):
+    if position >= len(data): raise ValueError("binary value cut short")
+    first = data[position]
+    position += 1
+    if first < 0x80:
+        return first, position
+    if first >= 0xe0:
+        return first - 0x100, position
+    if 0xa0 <= first < 0xc0:
+        kind, length = "str", first & 0x1f
+    elif 0x90 <= first < 0xa0:
+        kind, length = "array", first & 0x0f
+    elif 0x80 <= first < 0x90:
+        kind, length = "map", first & 0x0f
+    elif first == 0xc0:
+        return None, position
+    elif first == 0xc2:
+        return False, position
+    elif first == 0xc3:
+        return True, position
+    elif first in _FIXED:
+        fixed = _FIXED[first]
+        if position + fixed.size > len(data): raise ValueError("binary number cut short")
+        return fixed.unpack_from(data, position)[0], position + fixed.size
+    elif first in _SIZED:
+        size, kind = _SIZED[first]
+        if position + size.size > len(data): raise ValueError("binary length cut short")
+        length = size.unpack_from(data, position)[0]
+        position += size.size
+    else:
+        raise ValueError("unknown binary type 0x{:02x}".format(first))
+
+    if kind == "str":
+        end = position + length
+        if end > len(data): raise ValueError("binary string cut short")
+        return str(data[position:end], "utf-8"), end
+    if kind == "bin":
+        end = position + length
+        if end > len(data): raise ValueError("binary bytes cut short")
+        return bytes(data[position:end]), end
+    depth += 1
+    if depth > MAX_DEPTH: raise ValueError("binary arrays and maps nested over {} deep".format(MAX_DEPTH))
+    if kind == "array":
+        if length > len(data) - position: raise ValueError("binary array cut short")     # a byte an item at least
+        items = []
+        for _ in range(length):
+            if position >= len(data): raise ValueError("binary array cut short")
+            first = data[position]
+            if first < 0x80:                                # small ints and short strings without a call
+                items.append(first)
+                position += 1
+            elif 0xa0 <= first < 0xc0:
+                end = position + 1 + (first & 0x1f)
+                if end > len(data): raise ValueError("binary string cut short")
+                items.append(str(data[position + 1:end], "utf-8"))
+                position = end
+            elif first == 0xc0:
+                items.append(None)
+                position += 1
+            elif first == 0xcd:                             # offsets, mostly
+                if position + 3 > len(data): raise ValueError("binary number cut short")
+                items.append(data[position + 1] << 8 | data[position + 2])
+                position += 3
+            else:
+                item, position = _unpack(data, position, depth)
+                items.append(item)
+        return items, position
+    if 2 * length > len(data) - position: raise ValueError("binary map cut short")     # two bytes an entry at least
+    result = {}
+    for _ in range(length):
+        key, position = _unpack(data, position, depth)
+        if isinstance(key, (list, dict)): raise ValueError("binary map key is not hashable")
+        result[key], position = _unpack(data, position, depth)
+    return result, position
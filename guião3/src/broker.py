@@ -4,7 +4,9 @@ from typing import Dict, List, Any, Tuple
 import socket
 import selectors
 
-from src.protocol import PubSubProtocol
+from src.protocol import (PubSubProtocol, PubSubProtocolBadFormat, Connection, Subscribe, Publish, PublishBatch,
+                          TopicListRequest, CancelSubscription, Acknowledge)
+from src.topiclog import MessageLog
 
 
 class Serializer(enum.Enum):
@@ -13,25 +15,117 @@ class Serializer(enum.Enum):
     JSON = 0
     XML = 1
     PICKLE = 2
+    BINARY = 3
+
+
+class TopicNode:
+    """One segment of a topic path, with the consumers subscribed right there."""
+
+    def __init__(self):
+        self.children = {}          # {segment1: node1, segment2: node2, ...} -> subtopics one level down
+        self.subscribers = {}       # {consumer1: None, consumer2: None, ...} -> consumers in the order they subscribed
+
+
+class TopicTrie:
+    """Subscriptions by topic, topics split at "/" into a path of nodes.
+
+    A subscription to a topic covers its subtopics as well, so a publish
+    goes to the consumers on the nodes along its path. In a subscribed
+    topic a "+" segment stands for any one segment and "#" for whatever
+    segments are left.
+    """
+
+    def __init__(self):
+        self.root = TopicNode()
+
+    def add(self, topic: str, conn):
+        """Subscribe conn to topic."""
+        node = self.root
+        for segment in topic.split("/"):
+            node = node.children.setdefault(segment, TopicNode())
+        node.subscribers[conn] = None
+
+    def remove(self, topic: str, conn):
+        """Cancel the subscription of conn to topic, dropping the nodes left with nothing in them."""
+        path = [self.root]
+        for segment in topic.split("/"):
+            node = path[-1].children.get(segment)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].subscribers.pop(conn, None)
+        for segment, parent, node in zip(reversed(topic.split("/")), reversed(path[:-1]), reversed(path[1:])):
+            if node.subscribers or node.children:
+                break
+            del parent.children[segment]
+
+    def match(self, topic: str) -> List[Any]:
+        """Consumers a publish on topic goes to, each once, the ones subscribed higher up first."""
+        found = {}
+        nodes = [self.root]
+        for segment in topic.split("/"):
+            following = []
+            for node in nodes:
+                everything = node.children.get("#")
+                if everything is not None:
+                    found.update(everything.subscribers)
+                for key in (segment, "+"):
+                    child = node.children.get(key)
+                    if child is not None:
+                        found.update(child.subscribers)     # the topic or one of its parents
+                        following.append(child)
+            nodes = following
+        for node in nodes:
+            everything = node.children.get("#")             # "#" stands for no segment as well
+            if everything is not None:
+                found.update(everything.subscribers)
+        return list(found)
+
+    @staticmethod
+    def matches(pattern: str, topic: str) -> bool:
+        """Whether a subscription to pattern covers topic, as match() tells: topic is pattern,
+        one its wildcards stand for, or a subtopic of either."""
+        segments = topic.split("/")
+        for i, segment in enumerate(pattern.split("/")):
+            if segment == "#":
+                return True
+            if i == len(segments) or segment not in ("+", segments[i]):
+                return False
+        return True
 
 
 class Broker:
     """Implementation of a PubSub Message Broker."""
     
-    def __init__(self):
-        """Initialize broker."""
+    def __init__(self, host="localhost", port=5000, sock=None, log: MessageLog = None):
+        """Initialize broker, taking clients from sock instead of host and port if given.
+
+        With a log, every value published is kept there for subscribers to
+        replay, and the last one of each topic is back after a restart.
+        """
         self.canceled = False
-        self._host = "localhost"
-        self._port = 5000
-        self.broker = socket.socket(socket.AF_INET, socket.SOCK_STREAM)    # returns new socket and addr.
-        self.broker.bind((self._host, self._port))
+        self._host = host
+        self._port = port
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)       # returns new socket and addr.
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)     # restart while old connections linger
+            sock.bind((self._host, self._port))
+            sock.listen()
+        self.broker = sock
         self.sel = selectors.DefaultSelector()
-        self.broker.listen()
 
-        self.topics = []            # [topic1, topic2, topic3, ...] -> stores existing topics
         self.messages = {}          # {topic1: lastMessage1, topic2: lastMessage2, ...} -> stores last message in each
         self.serialTypes = {}       # {consumer1: serializationType1, consumer2: serializationType2, ...} -> stores each consumers searialization type
-        self.subscriptions = {}     # {topic1: [consumer1a, consumer1b, ...], topic2: [consumer2a, consumer 2b, ...], ...} -> stores all subscriptions
+        self.subscriptions = TopicTrie()    # consumers subscribed to each topic -> stores all subscriptions
+        self.subscribed = {}        # {consumer1: {topic1a, topic1b, ...}, ...} -> topics each consumer subscribed to
+        self.connections = {}       # {conn1: Connection1, ...} -> receive buffer of each client
+        self.log = log              # every value published on each topic, None to keep just the last ones
+
+        if self.log is not None:
+            for topic in self.log.topics():
+                last = self.log.last(topic)
+                if last is not None:
+                    self.messages[topic] = last[2]
 
         self.sel.register(self.broker, selectors.EVENT_READ, self.accept)
 
@@ -39,39 +133,97 @@ class Broker:
         """Accept a connection and store it's serialization type."""
         conn, addr = broker.accept()                                        # accept connection
 
+        self.connections[conn] = Connection(conn)
         self.sel.register(conn, selectors.EVENT_READ, self.read)
 
     def read(self, conn, mask):
-        """Handle further operations"""
-
-        received = PubSubProtocol.recvMsg(conn)
-
-        if received:  # we got a message from PubSubProtocol
-            if received.type == "Subscribe":
-                self.subscribe(received.topic, conn, self.getSerial(conn))
-
-            elif received.type == "Publish":
-                
-                self.put_topic(received.topic, received.value)
-                if received.topic in self.subscriptions:
-                    for key in self.list_subscriptions(received.topic):
-                        PubSubProtocol.sendMsg(key[0], self.getSerial(key[0]), received)
-                else:
-                    self.subscriptions[received.topic] = []
-
-            elif received.type == "TopicListRequest":
-                PubSubProtocol.sendMsg(conn, self.serialType, PubSubProtocol.topicListReply(self.list_topics()))
-
-            elif received.type == "CancelSubscription":
-                self.unsubscribe(received.topic, conn)
-
-            elif received.type == "Acknowledge" or received["type"] == "Acknowledge":
-                self.acknowledge(conn, received.language)
-
-        else:  # we got no message so connection was closed
-            self.unsubscribe("", conn)
-            self.sel.unregister(conn)
-            conn.close()
+        """Handle every message that arrived whole, or the connection closing."""
+
+        connection = self.connections[conn]
+        try:
+            filled = connection.fill()
+        except ConnectionError:     # reset: closed as well
+            filled = False
+        if filled:  # we got data, maybe several messages or part of one
+            try:
+                messages = connection.messages()
+            except (PubSubProtocolBadFormat, KeyError):
+                self.disconnect(conn)   # not a message of the protocol
+                return
+            for received in self.coalesce(messages):
+                self.handle(conn, received)
+            if self.log is not None:
+                self.log.flush()
+
+        else:  # we got no data so connection was closed
+            self.disconnect(conn)
+
+    def disconnect(self, conn):
+        """Forget a client and close its connection."""
+        self.unsubscribe("", conn)
+        self.serialTypes.pop(conn, None)
+        self.sel.unregister(conn)
+        del self.connections[conn]
+        conn.close()
+
+    def handle(self, conn, received):
+        """Handle further operations, ignoring messages only the broker sends"""
+
+        if isinstance(received, Subscribe):
+            self.subscribe(received.topic, conn, self.getSerial(conn), received.offset, received.since)
+
+        elif isinstance(received, (Publish, PublishBatch)):
+
+            self.fan_out(self.record(received), self.list_subscriptions(received.topic))
+
+        elif isinstance(received, TopicListRequest):
+            reply = PubSubProtocol.topicListReply(self.list_topics())
+            self.deliver(conn, PubSubProtocol.frame(self.getSerial(conn), reply))
+
+        elif isinstance(received, CancelSubscription):
+            self.unsubscribe(received.topic, conn)
+
+        elif isinstance(received, Acknowledge):
+            self.acknowledge(conn, received.language)
+
+    @staticmethod
+    def coalesce(messages):
+        """Messages read at once, each run of publishes on the same topic as a single batch."""
+        coalesced = []
+        for msg in messages:
+            last = coalesced[-1] if coalesced else None
+            if msg.type == "Publish" and last is not None and last.type in ("Publish", "PublishBatch") \
+                    and last.topic == msg.topic:
+                if last.type == "Publish":
+                    last = coalesced[-1] = PubSubProtocol.publishBatch(last.topic, [last.value])
+                last.values.append(msg.value)
+            else:
+                coalesced.append(msg)
+        return coalesced
+
+    def fan_out(self, msg, subscribers: List[Tuple[socket.socket, Serializer]]):
+        """Send msg to every subscriber, encoding it once per serializer in use."""
+        for conn, frame in self.frames(msg, subscribers):
+            self.deliver(conn, frame)
+
+    def frames(self, msg, subscribers: List[Tuple[socket.socket, Serializer]]):
+        """Yield (subscriber, frame of msg in its serializer), each frame built once.
+
+        A batch too big for a frame is split, in several frames for each subscriber.
+        """
+        frames = {}                 # {serializer1: frames1, ...} -> msg encoded for the subscribers using it
+        for conn, serializer in subscribers:
+            if serializer not in frames:
+                frames[serializer] = PubSubProtocol.frames(serializer, msg)
+            for frame in frames[serializer]:
+                yield conn, frame
+
+    def deliver(self, conn, frame):
+        """Write frame to conn, waiting for room in its socket buffer if need be."""
+        try:
+            PubSubProtocol.sendFrame(conn, frame)
+        except ConnectionError:
+            pass                    # gone: read sees it closed and forgets it
 
     def list_topics(self) -> List[str]:
         """Returns a list of strings containing all topics containing values."""
@@ -89,25 +241,37 @@ class Broker:
             return None
 
     def put_topic(self, topic, value):
-        """Store in topic the value."""
-
-        if topic not in self.topics:
-            self.createTopic(topic)
+        """Store in topic the value, returning its offset in the topic's log (None without a log)."""
 
-        # store the value as the topic's last message and add topic to topics if it's not there yet
+        # store the value as the topic's last message
         self.messages[topic] = value
+        if self.log is not None:
+            return self.log.append(topic, value)
+
+    def record(self, msg):
+        """Store a publish, returning it as subscribers get it: with its offset, if logged.
+
+        The values of a batch are stored in turn, and delivered in one batch.
+        """
+        if msg.type == "PublishBatch":
+            return PubSubProtocol.deliverBatch([self.record(PubSubProtocol.publish(msg.topic, value))
+                                                for value in msg.values])
+        offset = self.put_topic(msg.topic, msg.value)
+        if offset is None:
+            return msg
+        return PubSubProtocol.publish(msg.topic, msg.value, offset)
 
     def list_subscriptions(self, topic: str) -> List[Tuple[socket.socket, Serializer]]:
         """Provide list of subscribers to a given topic."""
 
         lst = []
-        for conn in self.subscriptions[topic]:
+        for conn in self.subscriptions.match(topic):
             lst.append((conn, self.serialTypes[conn]))
 
         return lst
 
-    def subscribe(self, topic: str, address: socket.socket, _format: Serializer = None):
-        """Subscribe to topic by client in address."""
+    def subscribe(self, topic: str, address: socket.socket, _format: Serializer = None, offset=None, since=None):
+        """Subscribe to topic by client in address, replaying its log from offset or timestamp since if given."""
         conn = address
         serializationCode = _format
 
@@ -116,54 +280,57 @@ class Broker:
             self.acknowledge(conn, serializationCode)
 
         # subscribe given topic
-        if topic in self.topics:
-            if topic not in self.subscriptions:
-                self.createTopic(topic)
-
-            if conn not in self.subscriptions[topic]:
-                self.subscriptions[topic].append(conn)
-            
-            if topic in self.messages and self.messages[topic] is not None:
-                PubSubProtocol.sendMsg(conn, self.getSerial(conn), PubSubProtocol.publish(topic, self.messages[topic]))
-            return
-
-        # if it got here, topic doesn't exist, so create it and re-run subscribe
-        else:
-            self.put_topic(topic, None)
-            self.subscribe(topic, conn, serializationCode)
+        self.subscriptions.add(topic, conn)
+        self.subscribed.setdefault(conn, set()).add(topic)
+
+        if offset is not None or since is not None:
+            # the subscribe sent back marks where the replay starts, after whatever was sent before
+            self.deliver(conn, PubSubProtocol.frame(self.getSerial(conn), PubSubProtocol.subscribe(topic, offset, since)))
+            if self.log is not None:
+                self.replay(topic, conn, offset, since)
+                return
+
+        # send the last message of every topic the subscription covers, as publishes on them would be
+        for t in [t for t in self.messages if TopicTrie.matches(topic, t)]:
+            if self.messages[t] is not None:
+                last = self.log.last(t) if self.log is not None else None
+                msg = PubSubProtocol.publish(t, self.messages[t], last[0] if last is not None else None)
+                self.deliver(conn, PubSubProtocol.frame(self.getSerial(conn), msg))
+
+    def replay(self, topic: str, conn, offset=None, since=None):
+        """Send conn what the log has of topic and its subtopics from timestamp since on, or of
+        topic alone from offset on: each topic numbers its own log, so an offset is of just one."""
+        for t in self.log.topics():
+            if t == topic if offset is not None else TopicTrie.matches(topic, t):
+                for record_offset, _, value in self.log.read(t, offset, since):
+                    msg = PubSubProtocol.publish(t, value, record_offset)
+                    self.deliver(conn, PubSubProtocol.frame(self.getSerial(conn), msg))
 
     def unsubscribe(self, topic, address):
         """Unsubscribe to topic by client in address."""
         conn = address
-        
-        if topic != "":     # unsub from specific topic and all subtopics
-            for t in self.topics:
-                if(t.startswith(topic)):
-                    self.subscriptions[t].remove(conn)
-        else:               # unsub from all topics
-            for t in self.topics:
-                if(conn in self.subscriptions[t]):
-                    self.subscriptions[t].remove(conn)
+
+        # unsub from specific topic and all subtopics, or from all topics
+        for t in list(self.subscribed.get(conn, ())):
+            if topic == "" or t == topic or t.startswith(topic + "/"):
+                self.subscriptions.remove(t, conn)
+                self.subscribed[conn].discard(t)
+        if not self.subscribed.get(conn, True):
+            del self.subscribed[conn]
 
     def acknowledge(self, conn, serializationCode):
         """Acknowledge new connection and its serialization type."""
+        if type(serializationCode) == str:                  # "2" when announced in JSON or XML
+            serializationCode = PubSubProtocol.serializerCode(serializationCode)
         if serializationCode == 0 or serializationCode == Serializer.JSON or serializationCode == None:
             self.serialTypes[conn] = Serializer.JSON
         elif serializationCode == 1 or serializationCode == Serializer.XML:
             self.serialTypes[conn] = Serializer.XML
         elif serializationCode == 2 or serializationCode == Serializer.PICKLE:
             self.serialTypes[conn] = Serializer.PICKLE
+        elif serializationCode == 3 or serializationCode == Serializer.BINARY:
+            self.serialTypes[conn] = Serializer.BINARY
 
-    def createTopic(self, topic):
-        self.topics.append(topic)
-        self.subscriptions[topic] = []
-
-        for t in self.topics:
-            if(topic.startswith(t)):
-                for consumer in self.subscriptions[t]:
-                    if consumer not in self.subscriptions[topic]:
-                        self.subscriptions[topic].append(consumer)
-    
     def getSerial(self, conn):
         if conn in self.serialTypes:
             return self.serialTypes[conn]
@@ -24,17 +24,17 @@ class Consumer:
 class Producer:
     """Producer implementation"""
 
-    def __init__(self, topic, value_generator, queue_type=PickleQueue):
-        """Initialize Queue."""
+    def __init__(self, topic, value_generator, queue_type=PickleQueue, batch_size=1, linger=0.005):
+        """Initialize Queue, sending values batch_size at a time or linger seconds after the first one waiting."""
         self.logger = get_logger(f"Producer {topic}")
 
         if isinstance(topic, list):
             self.queue = [
-                queue_type(subtopic, _type=MiddlewareType.PRODUCER)
+                queue_type(subtopic, _type=MiddlewareType.PRODUCER, batch_size=batch_size, linger=linger)
                 for subtopic in topic
             ]
         else:
-            self.queue = [queue_type(topic, _type=MiddlewareType.PRODUCER)]
+            self.queue = [queue_type(topic, _type=MiddlewareType.PRODUCER, batch_size=batch_size, linger=linger)]
         self.produced = []
         self.gen = value_generator
 
@@ -46,3 +46,8 @@ class Producer:
                 self.logger.info("%s: %s", queue.topic, value)
 
                 self.produced.append(value)
+
+    def close(self):
+        """Send the values still waiting in a batch, and disconnect."""
+        for queue in self.queue:
+            queue.close()
@@ -3,12 +3,13 @@ from collections.abc import Callable
 from enum import Enum
 from queue import LifoQueue, Empty
 import socket
+import threading
 from typing import Any
 import json
 import pickle
 import xml.etree.ElementTree as et
 
-from src.protocol import PubSubProtocol
+from src.protocol import PubSubProtocol, Connection
 
 
 class MiddlewareType(Enum):
@@ -21,30 +22,105 @@ class MiddlewareType(Enum):
 class Queue:
     """Representation of Queue interface for both Consumers and Producers."""
 
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        """Create Queue."""        
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, batch_size=1, linger=0.005):
+        """Create Queue.
+
+        A producer sends the values pushed batch_size at a time, or
+        linger seconds after the first one waiting if fewer were pushed;
+        close() sends what is still waiting.
+        """        
+        if batch_size > 1 and not linger > 0:
+            raise ValueError("a batch needs a positive linger to fill in, not {}".format(linger))
         self.topic = topic
         self.type = _type
         self.serial = 0
         self.address = (('localhost', 5000))
         self.mwSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.mwSock.connect(self.address)
+        self.connection = Connection(self.mwSock)   # buffers what the broker sends
+        self.paused = False                         # the broker asked us to stop publishing
+        self.offset = None                          # offset in its topic's log of the last value pulled
+        self.batch_size = batch_size
+        self.linger = linger
+        self.batch = []                             # values pushed but not sent yet
+        self.lock = threading.Lock()                # the batch is sent by push or by the linger timer
+        self.timer = None                           # sends the batch linger seconds after its first value
 
     def push(self, value):
-        """Sends data to broker."""
+        """Sends data to broker, waiting first if the broker paused us (batched, when the batch goes)."""
         if self.type.value == 2:                # if it's a producer
-            PubSubProtocol.sendMsg(self.mwSock, self.serial, PubSubProtocol.publish(self.topic, value))
-
-    def pull(self) -> (str, Any):
+            if self.batch_size <= 1:
+                self.flow()
+                PubSubProtocol.sendMsg(self.mwSock, self.serial, PubSubProtocol.publish(self.topic, value))
+                return
+            with self.lock:
+                self.batch.append(value)
+                if len(self.batch) >= self.batch_size:
+                    self.send_batch()
+                elif self.timer is None:
+                    self.timer = threading.Timer(self.linger, self.flush)
+                    self.timer.daemon = True        # close() sends the batch, it does not keep us alive
+                    self.timer.start()
+
+    def flush(self):
+        """Send the values waiting in the batch now."""
+        with self.lock:
+            self.send_batch()
+
+    def close(self):
+        """Send the values waiting in the batch, and disconnect."""
+        self.flush()
+        self.mwSock.close()
+
+    def send_batch(self):
+        """Send the batch in as few frames as it fits (lock held)."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.batch: return
+        self.flow()                             # once a batch: it polls the socket
+        for frame in PubSubProtocol.frames(self.serial, PubSubProtocol.publishBatch(self.topic, self.batch)):
+            PubSubProtocol.sendFrame(self.mwSock, frame)
+        self.batch = []
+
+    def flow(self):
+        """Take in the broker's backpressure messages, blocking while paused."""
+        while self.paused or self.connection.ready():
+            received = self.connection.recv()
+            if received is None:                # broker went away, the next send fails
+                self.paused = False
+                return
+            if received.type == "Backpressure":
+                self.paused = received.state == "pause"
+
+    def pull(self, offset=None) -> (str, Any):
         """Receives (topic, data) from broker.
-        Should BLOCK the consumer!"""
-        received = PubSubProtocol.recvMsg(self.mwSock)
+        Should BLOCK the consumer!
+
+        With an offset, the broker first sends again what its log has from
+        that offset on (the oldest kept, if gone), dropping whatever it sent before.
+        """
+        if offset is not None:
+            self.replay(offset)
+        received = self.connection.recv()
+        if received is not None and received.type == "DeliverBatch":
+            self.connection.pending.extendleft(reversed(received.messages[1:]))
+            received = received.messages[0]
         if received is None or received.value is None: return None
+        self.offset = getattr(received, "offset", None)
         if received.type == "TopicListReply":  
             return received.lst
         else:
             return (received.topic, int(received.value))
 
+    def replay(self, offset):
+        """Ask for the topic's log from offset on, skipping what arrives before it starts."""
+        PubSubProtocol.sendMsg(self.mwSock, self.serial, PubSubProtocol.subscribe(self.topic, offset))
+        while True:
+            received = self.connection.recv()
+            if received is None: return
+            if received.type == "Subscribe" and received.topic == self.topic: return
+
     def list_topics(self, callback: Callable):
         """Lists all topics available in the broker."""
         PubSubProtocol.sendMsg(self.mwSock, self.serial, PubSubProtocol.topicListRequest())
@@ -60,8 +136,8 @@ class Queue:
 
 class JSONQueue(Queue):
     """Queue implementation with JSON based serialization."""
-    def __init__(self, topic, _type = MiddlewareType.CONSUMER):
-        super().__init__(topic, _type)
+    def __init__(self, topic, _type = MiddlewareType.CONSUMER, batch_size=1, linger=0.005):
+        super().__init__(topic, _type, batch_size, linger)
         self.serial = 0
         
         if _type.value == 1: # if it's a consumer
@@ -70,8 +146,8 @@ class JSONQueue(Queue):
 
 class XMLQueue(Queue):
     """Queue implementation with XML based serialization."""
-    def __init__(self, topic, _type = MiddlewareType.CONSUMER):
-        super().__init__(topic, _type)
+    def __init__(self, topic, _type = MiddlewareType.CONSUMER, batch_size=1, linger=0.005):
+        super().__init__(topic, _type, batch_size, linger)
         self.serial = 1
         
         if _type.value == 1: # if it's a consumer
@@ -80,11 +156,21 @@ class XMLQueue(Queue):
 
 class PickleQueue(Queue):
     """Queue implementation with Pickle based serialization."""
-    def __init__(self, topic, _type = MiddlewareType.CONSUMER):
-        super().__init__(topic, _type)
+    def __init__(self, topic, _type = MiddlewareType.CONSUMER, batch_size=1, linger=0.005):
+        super().__init__(topic, _type, batch_size, linger)
         self.serial = 2
         
         if _type.value == 1: # if it's a consumer
             PubSubProtocol.sendMsg(self.mwSock, 0, PubSubProtocol.acknowledge(self.serial))
             PubSubProtocol.sendMsg(self.mwSock, self.serial, PubSubProtocol.subscribe(topic))
-        
\ No newline at end of file
+        
+
+class BinaryQueue(Queue):
+    """Queue implementation with binary (MessagePack) serialization."""
+    def __init__(self, topic, _type = MiddlewareType.CONSUMER, batch_size=1, linger=0.005):
+        super().__init__(topic, _type, batch_size, linger)
+        self.serial = 3
+        
+        if _type.value == 1: # if it's a consumer
+            PubSubProtocol.sendMsg(self.mwSock, 0, PubSubProtocol.acknowledge(self.serial))
+            PubSubProtocol.sendMsg(self.mwSock, self.serial, PubSubProtocol.subscribe(topic))
@@ -1,8 +1,14 @@
 import json
 import pickle
 import xml.etree.ElementTree as et
+from src import binary
+from xml.sax.saxutils import escape, quoteattr
 import enum
+import select
 import socket
+import struct
+from collections import deque
+from typing import List, Tuple
 
 
 class Serializer(enum.Enum):
@@ -12,6 +18,14 @@ class Serializer(enum.Enum):
     JSON = 0
     XML = 1
     PICKLE = 2
+    BINARY = 3
+
+# frame: serializer code (1 byte) | body length (2 bytes) | body
+# binary body: [index of the message type here, its fields in order...]
+BINARY_TYPES = ("Subscribe", "Publish", "TopicListRequest", "TopicListReply", "CancelSubscription", "Acknowledge",
+                "PublishBatch", "DeliverBatch", "Backpressure")
+HEADER = struct.Struct(">BH")
+MAX_BODY = 2**16 - 1
 
 class Message:
     """Base message."""
@@ -20,38 +34,58 @@ class Message:
         self.type = type
 
 class Subscribe(Message):
-    """Message to subscribe a topic."""
+    """Message to subscribe a topic, replaying what was published from an offset or a timestamp on."""
 
-    def __init__(self, topic):
+    def __init__(self, topic, offset=None, since=None):
         super().__init__("Subscribe")
         self.topic = topic
+        self.offset = offset
+        self.since = since
+
+    def replay(self):
+        """Fields asking for a replay, only the ones given."""
+        return {name: value for name, value in (("offset", self.offset), ("since", self.since)) if value is not None}
 
     def __repr__(self):
-        return f'{{"type": "{self.type}", "topic": "{self.topic}"}}'
+        extra = "".join(f', "{name}": {value}' for name, value in self.replay().items())
+        return f'{{"type": "{self.type}", "topic": "{self.topic}"{extra}}}'
 
     def toXML(self):
-        return "<?xml version=\"1.0\"?><data type=\"{}\" topic=\"{}\"></data>".format(self.type, self.topic)
+        extra = "".join(" {}=\"{}\"".format(name, value) for name, value in self.replay().items())
+        return "<?xml version=\"1.0\"?><data type=\"{}\" topic=\"{}\"{}></data>".format(self.type, self.topic, extra)
 
     def toPickle(self):
-        return {"type": self.type, "topic": self.topic}
+        return {"type": self.type, "topic": self.topic, **self.replay()}
+
+    def toBinary(self):
+        return [BINARY_TYPES.index(self.type), self.topic, self.offset, self.since]
 
 class Publish(Message):
-    """Message to publish on a topic"""
+    """Message to publish on a topic, with its offset in the topic's log once the broker logged it"""
 
-    def __init__(self, topic, value):
+    def __init__(self, topic, value, offset=None):
         super().__init__("Publish")
         self.topic = topic
         self.value = value
+        self.offset = offset
 
     def __repr__(self):
-        return f'{{"type": "{self.type}", "topic": "{self.topic}", "value": "{self.value}"}}'
+        extra = f', "offset": {self.offset}' if self.offset is not None else ""
+        return f'{{"type": "{self.type}", "topic": "{self.topic}", "value": "{self.value}"{extra}}}'
 
     def toXML(self):
-        return "<?xml version=\"1.0\"?><data type=\"{}\" topic=\"{}\" value=\"{}\"></data>".format(
-            self.type, self.topic, self.value)
+        extra = " offset=\"{}\"".format(self.offset) if self.offset is not None else ""
+        return "<?xml version=\"1.0\"?><data type=\"{}\" topic=\"{}\" value=\"{}\"{}></data>".format(
+            self.type, self.topic, self.value, extra)
 
     def toPickle(self):
-        return {"type": self.type, "topic": self.topic, "value": self.value}
+        msg = {"type": self.type, "topic": self.topic, "value": self.value}
+        if self.offset is not None:
+            msg["offset"] = self.offset
+        return msg
+
+    def toBinary(self):
+        return [BINARY_TYPES.index(self.type), self.topic, self.value, self.offset]
 
 class TopicListRequest(Message):
     """Message to request the topic list."""
@@ -68,6 +102,9 @@ class TopicListRequest(Message):
     def toPickle(self):
         return {"type": self.type}
 
+    def toBinary(self):
+        return [BINARY_TYPES.index(self.type)]
+
 class TopicListReply(Message):
     """Message to reply with the topic list."""
     
@@ -84,6 +121,9 @@ class TopicListReply(Message):
     def toPickle(self):
         return {"type": self.type, "lst": self.lst}
 
+    def toBinary(self):
+        return [BINARY_TYPES.index(self.type), self.lst]
+
 class CancelSubscription(Message):
     """Message to cancel a subscription on a topic"""
 
@@ -100,6 +140,9 @@ class CancelSubscription(Message):
     def toPickle(self):
         return {"type": self.type, "topic": self.topic}
 
+    def toBinary(self):
+        return [BINARY_TYPES.index(self.type), self.topic]
+
 class Acknowledge(Message):
     """Message to inform broker of your language"""
 
@@ -116,15 +159,87 @@ class Acknowledge(Message):
     def toPickle(self):
         return {"type": self.type, "language": self.language}
 
+    def toBinary(self):
+        return [BINARY_TYPES.index(self.type), self.language]
+
+class PublishBatch(Message):
+    """Message to publish several values on a topic at once"""
+
+    def __init__(self, topic, values):
+        super().__init__("PublishBatch")
+        self.topic = topic
+        self.values = values
+
+    def __repr__(self):
+        return f'{{"type": "{self.type}", "topic": "{self.topic}", "values": {json.dumps([str(v) for v in self.values])}}}'
+
+    def toXML(self):
+        values = "".join("<values>{}</values>".format(escape(str(value))) for value in self.values)
+        return "<?xml version=\"1.0\"?><data type=\"{}\" topic=\"{}\">{}</data>".format(self.type, self.topic, values)
+
+    def toPickle(self):
+        return {"type": self.type, "topic": self.topic, "values": self.values}
+
+    def toBinary(self):
+        return [BINARY_TYPES.index(self.type), self.topic, self.values]
+
+class DeliverBatch(Message):
+    """Message delivering several publishes to a subscriber at once"""
+
+    def __init__(self, messages: List[Publish]):
+        super().__init__("DeliverBatch")
+        self.messages = messages
+
+    def __repr__(self):
+        messages = [{"topic": m.topic, "value": str(m.value), **({"offset": m.offset} if m.offset is not None else {})}
+                    for m in self.messages]
+        return f'{{"type": "{self.type}", "messages": {json.dumps(messages)}}}'
+
+    def toXML(self):
+        messages = "".join("<messages topic={} value={}{}/>".format(
+            quoteattr(m.topic), quoteattr(str(m.value)), "" if m.offset is None else " offset=\"{}\"".format(m.offset))
+            for m in self.messages)
+        return "<?xml version=\"1.0\"?><data type=\"{}\">{}</data>".format(self.type, messages)
+
+    def toPickle(self):
+        return {"type": self.type, "messages": [m.toPickle() for m in self.messages]}
+
+    def toBinary(self):
+        fields = []                 # flat: topic1, value1, offset1, topic2, ...
+        for m in self.messages:
+            fields += (m.topic, m.value, m.offset)
+        return [BINARY_TYPES.index(self.type), fields]
+
+class Backpressure(Message):
+    """Message telling a producer to stop publishing on a topic (pause) or to go on (resume)"""
+
+    def __init__(self, topic, state):
+        super().__init__("Backpressure")
+        self.topic = topic
+        self.state = state
+
+    def __repr__(self):
+        return f'{{"type": "{self.type}", "topic": "{self.topic}", "state": "{self.state}"}}'
+
+    def toXML(self):
+        return "<?xml version=\"1.0\"?><data type=\"{}\" topic=\"{}\" state=\"{}\"></data>".format(
+            self.type, self.topic, self.state)
+
+    def toPickle(self):
+        return {"type": self.type, "topic": self.topic, "state": self.state}
+
+    def toBinary(self):
+        return [BINARY_TYPES.index(self.type), self.topic, self.state]
+
 
 class PubSubProtocol:
     @classmethod
-    def subscribe(cls, topic) -> Subscribe:
-        return Subscribe(topic)
+    def subscribe(cls, topic, offset=None, since=None) -> Subscribe:
+        return Subscribe(topic, offset, since)
 
     @classmethod
-    def publish(cls, topic, value) -> Publish:
-        return Publish(topic, value) 
+    def publish(cls, topic, value, offset=None) -> Publish:
+        return Publish(topic, value, offset)
 
     @classmethod
     def topicListRequest(cls) -> TopicListRequest:
@@ -143,61 +258,162 @@ class PubSubProtocol:
         return Acknowledge(language)
 
     @classmethod
-    def sendMsg(cls, conn: socket, serializerCode, msg: Message):
-        """Send a message."""
+    def backpressure(cls, topic, state) -> Backpressure:
+        return Backpressure(topic, state)
+
+    @classmethod
+    def publishBatch(cls, topic, values) -> PublishBatch:
+        return PublishBatch(topic, values)
 
+    @classmethod
+    def deliverBatch(cls, messages) -> DeliverBatch:
+        return DeliverBatch(messages)
+
+    @classmethod
+    def serializerCode(cls, serializerCode) -> int:
+        """Serializer given as None, str, int or Serializer, as its code."""
         if serializerCode == None: serializerCode = 0
         if type(serializerCode) == str: serializerCode = int(serializerCode)
         if isinstance(serializerCode, enum.Enum): serializerCode = serializerCode.value
+        return serializerCode
 
-        conn.send(serializerCode.to_bytes(1, 'big'))            # first we send the serializer
-        if serializerCode == 0 or serializerCode == Serializer.JSON:
+    @classmethod
+    def encode(cls, serializerCode, msg: Message) -> bytes:
+        """Body of msg in the serializer with serializerCode."""
+        if serializerCode == 0:
             temp = json.loads(msg.__repr__())
-            jsonMsg = json.dumps(temp).encode('utf-8')          # get message in JSON
-            conn.send(len(jsonMsg).to_bytes(2, 'big'))          # send header
-            conn.send(jsonMsg)                                  # send message
-        elif serializerCode == 1 or serializerCode == Serializer.XML:
-            xmlMsg = msg.toXML().encode('utf-8')                # get message in XML
-            conn.send(len(xmlMsg).to_bytes(2, 'big'))           # send header
-            conn.send(xmlMsg)                                   # send message
-        elif serializerCode == 2 or serializerCode == Serializer.PICKLE:
-            pickleMsg = pickle.dumps(msg.toPickle())            # get message in Pickle
-            conn.send(len(pickleMsg).to_bytes(2, 'big'))        # send header
-            conn.send(pickleMsg)                                # send message
+            return json.dumps(temp).encode('utf-8')             # get message in JSON
+        elif serializerCode == 1:
+            return msg.toXML().encode('utf-8')                  # get message in XML
+        elif serializerCode == 2:
+            return pickle.dumps(msg.toPickle())                 # get message in Pickle
+        elif serializerCode == 3:
+            return binary.packb(msg.toBinary())                 # get message in binary
+
+    @classmethod
+    def frame(cls, serializerCode, msg: Message) -> Tuple[bytes, bytes]:
+        """Header (serializer and length) and body of msg, ready for sendFrame."""
+        serializerCode = cls.serializerCode(serializerCode)
+        body = cls.encode(serializerCode, msg)
+        if len(body) > MAX_BODY:
+            raise ValueError("message of {} bytes, at most {} fit in a frame".format(len(body), MAX_BODY))
+        return HEADER.pack(serializerCode, len(body)), body
+
+    @classmethod
+    def frames(cls, serializerCode, msg: Message) -> List[Tuple[bytes, bytes]]:
+        """Frames of msg, a batch too big for one frame split in as many as it takes."""
+        try:
+            return [cls.frame(serializerCode, msg)]
+        except ValueError:
+            if msg.type == "PublishBatch" and len(msg.values) > 1:
+                half = len(msg.values) // 2
+                parts = [cls.publishBatch(msg.topic, msg.values[:half]), cls.publishBatch(msg.topic, msg.values[half:])]
+            elif msg.type == "DeliverBatch" and len(msg.messages) > 1:
+                half = len(msg.messages) // 2
+                parts = [cls.deliverBatch(msg.messages[:half]), cls.deliverBatch(msg.messages[half:])]
+            else:
+                raise
+            return cls.frames(serializerCode, parts[0]) + cls.frames(serializerCode, parts[1])
+
+    @classmethod
+    def sendMsg(cls, conn: socket, serializerCode, msg: Message):
+        """Send a message."""
+        cls.sendFrame(conn, cls.frame(serializerCode, msg))
+
+    @classmethod
+    def sendFrame(cls, conn: socket, frame: Tuple[bytes, bytes]):
+        """Send a frame as a single write, finishing it if only part of it went out.
+
+        The same frame can be sent to any number of connections.
+        """
+        header, body = frame
+        if not hasattr(conn, "sendmsg"):                        # no scatter-gather on this platform
+            conn.sendall(header + body)
+            return
+        sent = conn.sendmsg([header, body])
+        if sent < len(header):
+            conn.sendall(header[sent:] + body)
+        elif sent < len(header) + len(body):
+            conn.sendall(memoryview(body)[sent - len(header):])
+
+    @classmethod
+    def fromBinary(cls, fields) -> Message:
+        """Message of the fields a binary body holds."""
+        kind = BINARY_TYPES[fields[0]]
+        if kind == "Publish":
+            return cls.publish(*fields[1:])
+        elif kind == "DeliverBatch":
+            flat = fields[1]
+            return cls.deliverBatch([cls.publish(flat[i], flat[i + 1], flat[i + 2]) for i in range(0, len(flat), 3)])
+        elif kind == "PublishBatch":
+            return cls.publishBatch(*fields[1:])
+        elif kind == "Subscribe":
+            return cls.subscribe(*fields[1:])
+        elif kind == "TopicListRequest":
+            return cls.topicListRequest()
+        elif kind == "TopicListReply":
+            return cls.topicListReply(*fields[1:])
+        elif kind == "CancelSubscription":
+            return cls.cancelSubscription(*fields[1:])
+        elif kind == "Acknowledge":
+            return cls.acknowledge(*fields[1:])
+        elif kind == "Backpressure":
+            return cls.backpressure(*fields[1:])
+
+    @classmethod
+    def recvExact(cls, conn: socket, size):
+        """Receive exactly size bytes, None if the connection closes first."""
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            count = conn.recv_into(view[received:])
+            if count == 0: return None
+            received += count
+        return data
 
     @classmethod
     def recvMsg(cls, conn: socket) -> Message:
         """Receive a message."""
 
-        serializerCode = int.from_bytes(conn.recv(1), 'big')    # get serializer
-        header = int.from_bytes(conn.recv(2), 'big')            # get header which contains message length
-        if header == 0: return None
+        header = cls.recvExact(conn, HEADER.size)
+        if header is None: return None
+        serializerCode, length = HEADER.unpack(header)          # get serializer and message length
+        if length == 0: return None
+        payload = cls.recvExact(conn, length)                   # get content with header size
+        if payload is None: return None
+        return cls.decode(serializerCode, payload)
+
+    @classmethod
+    def decode(cls, serializerCode, payload) -> Message:
+        """Message in payload (bytes or memoryview), in the serializer with serializerCode."""
 
         try:
             if serializerCode == 0 or serializerCode == Serializer.JSON or serializerCode == None:
-                payload = conn.recv(header).decode('utf-8')     # get content with header size
-                if payload == "": return None                   
-                msg = json.loads(payload)                       # decode content into message
+                msg = json.loads(str(payload, 'utf-8'))         # decode content into message
             elif serializerCode == 1 or serializerCode == Serializer.XML:
-                payload = conn.recv(header).decode('utf-8')     # get content with header size
-                if payload == "": return None
                 msg = {}                                        # decode content into message
-                root = et.fromstring(payload)
+                root = et.fromstring(str(payload, 'utf-8'))
                 for element in root.keys():
                     msg[element] = root.get(element)
+                for child in root:                              # lists, an element per item
+                    item = dict(child.attrib) if child.attrib else (child.text or "")
+                    msg.setdefault(child.tag, []).append(item)
             elif serializerCode == 2 or serializerCode == Serializer.PICKLE:
-                payload = conn.recv(header)                     #  get content with header size
-                if payload == "": return None
                 msg = pickle.loads(payload)                     # decode content into message
+            elif serializerCode == 3 or serializerCode == Serializer.BINARY:
+                return cls.fromBinary(binary.unpackb(payload))  # fields in order, no names to look up
 
-
-        except json.JSONDecodeError as err:
-            raise PubSubProtocolBadFormat(payload)
+        except (json.JSONDecodeError, ValueError, IndexError, TypeError, struct.error) as err:
+            raise PubSubProtocolBadFormat(bytes(payload))
 
         if msg["type"] == "Subscribe":
-            return cls.subscribe(msg["topic"])
+            offset, since = msg.get("offset"), msg.get("since")       # numbers, or strings in XML
+            return cls.subscribe(msg["topic"], None if offset is None else int(offset),
+                                 None if since is None else float(since))
         elif msg["type"] == "Publish":
-            return cls.publish(msg["topic"], msg["value"])
+            offset = msg.get("offset")
+            return cls.publish(msg["topic"], msg["value"], None if offset is None else int(offset))
         elif msg["type"] == "TopicListRequest":
             return cls.topicListRequest()
         elif msg["type"] == "TopicListReply":
@@ -206,10 +422,82 @@ class PubSubProtocol:
             return cls.cancelSubscription(msg["topic"])
         elif msg["type"] == "Acknowledge":
             return cls.acknowledge(msg["language"])
+        elif msg["type"] == "PublishBatch":
+            return cls.publishBatch(msg["topic"], msg["values"])
+        elif msg["type"] == "DeliverBatch":
+            return cls.deliverBatch([cls.publish(m["topic"], m["value"], None if m.get("offset") is None
+                                                 else int(m["offset"])) for m in msg["messages"]])
+        elif msg["type"] == "Backpressure":
+            return cls.backpressure(msg["topic"], msg["state"])
         else: # error if it got here lol
             print("couldn't parse (?) type")
             return None
 
+
+class Connection:
+    """Socket with a receive buffer that whole frames are parsed from.
+
+    Each read is a single recv_into the buffer, taking whatever arrived:
+    several pipelined messages come out of one read, and a message split
+    across reads waits in the buffer for the rest of it.
+    """
+
+    def __init__(self, sock: socket, size=2 * (HEADER.size + MAX_BODY)):
+        self.sock = sock
+        self.buffer = bytearray(size)   # holds at least one whole frame besides a partial one
+        self.view = memoryview(self.buffer)
+        self.start = 0                  # first byte not parsed yet
+        self.end = 0                    # end of the bytes received
+        self.pending = deque()          # messages parsed but not returned by recv yet
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def fill(self) -> bool:
+        """Receive what the socket has (waiting for something if need be), False once it is closed."""
+        if self.end == len(self.buffer):                        # move the partial frame to the front
+            unparsed = self.end - self.start
+            self.view[:unparsed] = self.view[self.start:self.end]
+            self.start, self.end = 0, unparsed
+        count = self.sock.recv_into(self.view[self.end:])
+        if count == 0: return False
+        self.end += count
+        return True
+
+    def messages(self) -> List[Message]:
+        """Decode every whole message in the buffer."""
+        messages = []
+        while self.end - self.start >= HEADER.size:
+            serializerCode, length = HEADER.unpack_from(self.buffer, self.start)
+            stop = self.start + HEADER.size + length
+            if stop > self.end: break                           # rest of the frame not here yet
+            body = self.view[self.start + HEADER.size:stop]
+            self.start = stop
+            if length == 0: continue
+            msg = PubSubProtocol.decode(serializerCode, body)
+            if msg is not None: messages.append(msg)
+        if self.start == self.end:
+            self.start = self.end = 0
+        return messages
+
+    def recv(self) -> Message:
+        """Block until a whole message arrives and return it, None once the connection is closed."""
+        while not self.pending:
+            if not self.fill(): return None
+            self.pending.extend(self.messages())
+        return self.pending.popleft()
+
+    def ready(self) -> bool:
+        """Whether recv has something to return without waiting."""
+        if self.pending: return True
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        return bool(readable)
+
+    def send(self, serializerCode, msg: Message):
+        """Send a message."""
+        PubSubProtocol.sendMsg(self.sock, serializerCode, msg)
+
+
 class PubSubProtocolBadFormat(Exception):
     """Exception when source message is not PubSubProtocol"""
 
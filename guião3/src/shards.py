@@ -0,0 +1,365 @@
+"""Broker sharded by root topic across worker processes, behind a front that hands connections over."""
+import multiprocessing
+import selectors
+import socket
+import zlib
+from typing import List
+
+from src.broker import Broker
+from src.protocol import HEADER, MAX_BODY, PubSubProtocol, PubSubProtocolBadFormat, Connection
+
+# control messages between the front and a worker, one per packet: kind (1 byte) | data
+DATA = b"D"         # front -> worker: part of what was read from the connection handed over next
+HANDOFF = b"C"      # front -> worker: the connection passed along, data is the rest of what was read from it
+TOPIC = b"T"        # either way: data is a topic that got its first value in some shard
+PACKET = 2 * (HEADER.size + MAX_BODY) + 1
+FRAME = HEADER.size + MAX_BODY
+OUTGOING = 64 * FRAME   # bytes waiting to be written to a relayed client, or a link of it, before it is dropped
+
+
+def root_topic(topic: str) -> str:
+    """First segment of topic ("weather" for /weather/humidity)."""
+    segments = topic.split("/")
+    return segments[1] if topic.startswith("/") and len(segments) > 1 else segments[0]
+
+
+def shard_of(topic: str, shards: int) -> int:
+    """Shard owning topic: its root topic's crc32, split into shards equal ranges."""
+    return zlib.crc32(root_topic(topic).encode("utf-8")) * shards >> 32
+
+
+def spans_shards(topic: str) -> bool:
+    """Whether topic's root is a wildcard, standing for root topics of every shard."""
+    return root_topic(topic) in ("+", "#")
+
+
+def whole_frames(connection: Connection):
+    """Yield every whole frame in connection's buffer (a view into it), moving past each."""
+    while connection.end - connection.start >= HEADER.size:
+        _, length = HEADER.unpack_from(connection.buffer, connection.start)
+        stop = connection.start + HEADER.size + length
+        if stop > connection.end: break                         # rest of the frame not here yet
+        frame = connection.view[connection.start:stop]
+        connection.start = stop
+        yield frame
+    if connection.start == connection.end:
+        connection.start = connection.end = 0
+
+
+def decode_frame(frame):
+    """Message in frame, None for an empty one."""
+    serializerCode, length = HEADER.unpack_from(frame)
+    return PubSubProtocol.decode(serializerCode, frame[HEADER.size:]) if length > 0 else None
+
+
+class ShardWorker(Broker):
+    """Broker for the root topics of one shard, getting its clients from the front.
+
+    Topics stored in other shards are told by the front as they appear, so
+    list_topics covers every shard (a new one may show up a moment late).
+    """
+
+    def __init__(self, control: socket.socket):
+        """Initialize worker on its end of the control socket to the front."""
+        super().__init__(sock=control)
+        self.others = {}            # {topic1: None, ...} -> topics with values in other shards, in order
+        self.incoming = bytearray()     # read from the connection handed over next, sent ahead of it
+
+    def accept(self, control, mask):
+        """Adopt a connection the front handed over, or note a topic of another shard."""
+        data, fds, _, _ = socket.recv_fds(control, PACKET, 1)
+        if not data:                # front is gone
+            self.canceled = True
+            self.sel.unregister(control)
+            return
+        if data[:1] == TOPIC:
+            self.others[data[1:].decode("utf-8")] = None
+            return
+        if data[:1] == DATA:
+            self.incoming += data[1:]
+            return
+
+        conn = socket.socket(fileno=fds[0])
+        self.connections[conn] = Connection(conn)
+        read, self.incoming = self.incoming + data[1:], bytearray()     # what the front read from it
+        self.sel.register(conn, selectors.EVENT_READ, self.read)
+        try:
+            for start in range(0, len(read), FRAME):
+                self.feed(conn, read[start:start + FRAME])
+        except (PubSubProtocolBadFormat, KeyError):
+            self.disconnect(conn)       # not a message of the protocol
+
+    def feed(self, conn, data):
+        """Handle the messages of conn in data (a frame long at most), as if just read from it."""
+        connection = self.connections[conn]
+        if connection.end + len(data) > len(connection.buffer):    # move the partial frame to the front
+            unparsed = connection.end - connection.start
+            connection.view[:unparsed] = connection.view[connection.start:connection.end]
+            connection.start, connection.end = 0, unparsed
+        connection.view[connection.end:connection.end + len(data)] = data
+        connection.end += len(data)
+        for received in self.coalesce(connection.messages()):
+            self.handle(conn, received)
+
+    def put_topic(self, topic, value):
+        """Store in topic the value, telling the other shards of a topic new here."""
+        new = self.messages.get(topic) is None and value is not None
+        offset = super().put_topic(topic, value)
+        if new:
+            self.broker.send(TOPIC + topic.encode("utf-8"))
+        return offset
+
+    def list_topics(self) -> List[str]:
+        """Returns a list of strings containing all topics containing values, in every shard."""
+        return super().list_topics() + list(self.others)
+
+
+def serve_shard(control: socket.socket):
+    """Run a shard worker (the target of its process)."""
+    ShardWorker(control).run()
+
+
+class ShardedBroker:
+    """Front of a broker split in shards worker processes, each owning a range of root topics.
+
+    A client connection is read only until it names a topic (subscribe,
+    publish or cancel). It is then handed to the worker owning that topic's
+    root, together with what was read from it, and is served there from
+    then on: a client should keep to topics under one root topic, like
+    each Queue does. Topic lists asked for before are answered here.
+
+    A topic whose root is a wildcard ("#", "/+/temperature") stands for
+    topics of every shard. A client naming one first stays here instead:
+    the front subscribes it in every worker, through a link of its own to
+    each, and relays what they deliver. Its later messages go to the
+    worker owning their topic, or to all of them for another wildcard.
+    What is relayed is written as the other end has room, so a slow client
+    holds up nobody else; one with over OUTGOING bytes waiting is dropped.
+    """
+
+    def __init__(self, host="localhost", port=5000, shards=multiprocessing.cpu_count()):
+        """Initialize front and start the workers."""
+        self.canceled = False
+        self._host = host
+        self._port = port
+        self.broker = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.broker.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.broker.bind((self._host, self._port))
+        self.broker.listen()
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.broker, selectors.EVENT_READ, self.accept)
+
+        self.topics = {}            # {topic1: None, ...} -> topics with values in any shard, in order
+        self.connections = {}       # {conn1: Connection1, ...} -> clients not handed over yet
+        self.kept = {}              # {conn1: frame1, ...} -> last Acknowledge of each, for the worker to read
+        self.proxied = {}           # {conn1: [link1 to shard 0, ...], ...} -> clients relayed to every worker
+        self.links = {}             # {link1: (conn1, Connection1), ...} -> front end of each link, and its client
+        self.outgoing = {}          # {sock1: bytearray1, ...} -> waiting for room in each relayed client and link
+        self.workers = []           # [(control1, process1), ...] -> shard i is workers[i]
+        for _ in range(shards):
+            control, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            # spawned, as forked ones would hold the other workers' control sockets open too
+            process = multiprocessing.get_context("spawn").Process(target=serve_shard, args=(remote,), daemon=True)
+            process.start()
+            remote.close()
+            self.workers.append((control, process))
+            self.sel.register(control, selectors.EVENT_READ, self.relay)
+
+    def accept(self, broker, mask):
+        """Accept a connection, kept here until it names a topic."""
+        conn, addr = broker.accept()
+        self.connections[conn] = Connection(conn)
+        self.kept[conn] = b""
+        self.sel.register(conn, selectors.EVENT_READ, self.read)
+
+    def read(self, conn, mask):
+        """Look for the first topic conn names, handing it over to that topic's shard."""
+        connection = self.connections[conn]
+        if not connection.fill():
+            self.forget(conn)
+            conn.close()
+            return
+
+        try:
+            for frame in whole_frames(connection):
+                received = decode_frame(frame)
+                if received is None:
+                    continue
+                if received.type == "TopicListRequest":
+                    self.answer_topics(conn, frame)
+                elif received.type == "Acknowledge":
+                    self.kept[conn] = bytes(frame)      # only the last one matters to the worker
+                elif hasattr(received, "topic"):
+                    read = self.kept[conn] + frame
+                    if spans_shards(received.topic):
+                        self.proxy(conn, read)
+                    else:
+                        read += connection.view[connection.start:connection.end]
+                        self.hand_over(conn, shard_of(received.topic, len(self.workers)), read)
+                    return
+        except PubSubProtocolBadFormat:
+            self.forget(conn)
+            conn.close()
+
+    def answer_topics(self, conn, frame):
+        """Answer the TopicListRequest in frame, in its serializer; False if conn is relayed and had to be dropped."""
+        serializerCode, _ = HEADER.unpack_from(frame)
+        reply = PubSubProtocol.topicListReply(list(self.topics))
+        if conn not in self.proxied:
+            PubSubProtocol.sendMsg(conn, serializerCode, reply)
+            return True
+        return self.send(conn, b"".join(PubSubProtocol.frame(serializerCode, reply)))
+
+    def send_handoff(self, shard, conn, read):
+        """Pass conn, and what was read from it, to worker shard; the data goes in packets ahead of it."""
+        control, _ = self.workers[shard]
+        read = bytes(read)
+        last = max(len(read) - 1, 0) // (PACKET - 1) * (PACKET - 1)
+        for start in range(0, last, PACKET - 1):
+            control.send(DATA + read[start:start + PACKET - 1])
+        socket.send_fds(control, [HANDOFF + read[last:]], [conn.fileno()])
+
+    def hand_over(self, conn, shard, read):
+        """Pass conn, and what was read from it, to worker shard."""
+        self.send_handoff(shard, conn, read)
+        self.forget(conn)
+        conn.close()                # the worker holds its own descriptor for it
+
+    def proxy(self, conn, read):
+        """Keep conn here, subscribed in every worker through a link to each; read is what they get first."""
+        links = self.proxied[conn] = []
+        conn.setblocking(False)     # written to as it has room, never waited on
+        self.outgoing[conn] = bytearray()
+        for shard in range(len(self.workers)):
+            link, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.send_handoff(shard, remote, read)
+            remote.close()
+            link.setblocking(False)
+            links.append(link)
+            self.links[link] = (conn, Connection(link))
+            self.outgoing[link] = bytearray()
+            self.sel.register(link, selectors.EVENT_READ, self.relay_back)
+        self.sel.modify(conn, selectors.EVENT_READ, self.forward)
+        self.forward(conn, 0)       # what followed the topic in the last read
+
+    def forward(self, conn, mask):
+        """Pass what a client relayed here sent on to the workers, and write it what is waiting."""
+        if conn not in self.proxied:    # dropped since the selector told of it
+            return
+        if mask & selectors.EVENT_WRITE and not self.flush(conn):
+            self.drop(conn)
+            return
+        if mask & selectors.EVENT_READ and not self.connections[conn].fill():
+            self.drop(conn)
+            return
+        try:
+            if not self.forward_frames(conn):
+                self.drop(conn)
+        except PubSubProtocolBadFormat:
+            self.drop(conn)
+
+    def forward_frames(self, conn):
+        """Send each whole frame of relayed client conn to the worker owning its topic, or to all of them;
+        False once conn has too much waiting to be written somewhere."""
+        links = self.proxied[conn]
+        for frame in whole_frames(self.connections[conn]):
+            received = decode_frame(frame)
+            if received is None:
+                continue
+            if received.type == "TopicListRequest":
+                sent = self.answer_topics(conn, frame)
+            elif hasattr(received, "topic") and not spans_shards(received.topic):
+                sent = self.send(links[shard_of(received.topic, len(links))], frame)
+            else:
+                sent = all([self.send(link, frame) for link in links])
+            if not sent:
+                return False
+        return True
+
+    def relay_back(self, link, mask):
+        """Pass what a worker delivered through link on to its client, and write the worker what is waiting."""
+        if link not in self.links:      # dropped since the selector told of it
+            return
+        conn, connection = self.links[link]
+        if mask & selectors.EVENT_WRITE and not self.flush(link):
+            self.drop(conn)
+            return
+        if not mask & selectors.EVENT_READ:
+            return
+        if not connection.fill():   # worker died
+            self.drop(conn)
+            return
+        for frame in whole_frames(connection):
+            if not self.send(conn, frame):
+                self.drop(conn)
+                return
+
+    def send(self, sock, data) -> bool:
+        """Write data to a relayed client or a link as it has room, the rest when the selector says so;
+        False if sock is gone or has more than OUTGOING bytes waiting."""
+        if not self.outgoing[sock]:
+            try:
+                data = data[sock.send(data):]
+            except BlockingIOError:
+                pass
+            except OSError:
+                return False
+            if not data:
+                return True
+            self.sel.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self.sel.get_key(sock).data)
+        self.outgoing[sock] += data
+        return len(self.outgoing[sock]) <= OUTGOING
+
+    def flush(self, sock) -> bool:
+        """Write what is waiting for sock, as much as it takes now; False if it is gone."""
+        waiting = self.outgoing[sock]
+        try:
+            del waiting[:sock.send(waiting)]
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        if not waiting:
+            self.sel.modify(sock, selectors.EVENT_READ, self.sel.get_key(sock).data)
+        return True
+
+    def drop(self, conn):
+        """Close relayed client conn and its links."""
+        for link in self.proxied.pop(conn):
+            self.sel.unregister(link)
+            del self.links[link], self.outgoing[link]
+            link.close()
+        del self.outgoing[conn]
+        self.forget(conn)
+        conn.close()
+
+    def forget(self, conn):
+        self.sel.unregister(conn)
+        del self.connections[conn]
+        del self.kept[conn]
+
+    def relay(self, control, mask):
+        """Note a topic a worker got its first value in, and tell the other workers."""
+        data = control.recv(PACKET)
+        if not data:                # worker died
+            self.sel.unregister(control)
+            return
+        self.topics[data[1:].decode("utf-8")] = None
+        for other, _ in self.workers:
+            if other is not control:
+                other.send(data)
+
+    def list_topics(self) -> List[str]:
+        """Returns a list of strings containing all topics containing values, in every shard."""
+        return list(self.topics)
+
+    def run(self):
+        """Run until canceled, then stop the workers."""
+        while not self.canceled:
+            for key, mask in self.sel.select(timeout=0.1):
+                callback = key.data
+                callback(key.fileobj, mask)
+        for control, process in self.workers:
+            control.close()         # the worker stops once it sees the end of it
+            process.join(timeout=5)
+        self.broker.close()
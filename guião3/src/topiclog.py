@@ -0,0 +1,219 @@
+"""Durable log of every value published on each topic, kept in segment files the broker replays from."""
+import mmap
+import os
+import pickle
+import struct
+import time
+from typing import Any, Iterator, List, Tuple
+from urllib.parse import quote, unquote
+
+# record: offset (8 bytes) | timestamp, seconds since the epoch (8 bytes) | value length (4 bytes) | value (pickled)
+RECORD = struct.Struct(">QdI")
+# start of the name of each topic's directory, so that no topic ("", "." or "..") names one outside of the log's
+PREFIX = "topic-"
+
+
+class Segment:
+    """File with the records of a topic from offset base on, in order."""
+
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base            # offset of its first record
+        self.next = base            # offset its next record gets
+        self.size = 0               # bytes of whole records
+        self.first = None           # timestamp of its first record
+        self.last = None            # timestamp of its last record
+
+    def records(self, start=0) -> Iterator[Tuple[int, float, bytes, int]]:
+        """(offset, timestamp, value, position) of the records from byte start on, read through mmap."""
+        with open(self.path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return              # nothing to map
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                position = start
+                while position + RECORD.size <= len(data):
+                    offset, timestamp, length = RECORD.unpack_from(data, position)
+                    end = position + RECORD.size + length
+                    if end > len(data): break                   # cut short by a crash
+                    yield offset, timestamp, data[position + RECORD.size:end], position
+                    position = end
+
+    def recover(self):
+        """Take in the records in the file, dropping a last one only partly written."""
+        for offset, timestamp, value, position in self.records():
+            if self.first is None:
+                self.first = timestamp
+            self.last = timestamp
+            self.next = offset + 1
+            self.size = position + RECORD.size + len(value)
+        if os.path.getsize(self.path) > self.size:
+            os.truncate(self.path, self.size)
+
+
+class TopicLog:
+    """Append-only log of one topic, split in segments.
+
+    The last segment is written to through a buffered file; once it holds
+    segment_bytes, or its first record is segment_seconds old, a new one is
+    started and the oldest are deleted while the log holds over
+    retention_bytes, or their records are all older than retention_seconds
+    (None keeps them).
+    """
+
+    def __init__(self, directory, segment_bytes, segment_seconds, retention_bytes, retention_seconds, clock):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.clock = clock
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = []          # [segment1, segment2, ...] -> oldest first, the last one written to
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".log"):
+                segment = Segment(os.path.join(directory, name), int(name[:-4]))
+                segment.recover()
+                self.segments.append(segment)
+        if not self.segments:
+            self.segments.append(Segment(self.path(0), 0))
+        self.file = open(self.segments[-1].path, "ab")
+        self.dirty = False          # written to since flushed
+        self.clean()
+
+    def path(self, base):
+        return os.path.join(self.directory, "{:020d}.log".format(base))
+
+    @property
+    def next(self) -> int:
+        """Offset the next value gets."""
+        return self.segments[-1].next
+
+    def append(self, value) -> int:
+        """Write value at the end of the log, returning its offset."""
+        now = self.clock()
+        active = self.segments[-1]
+        if active.size >= self.segment_bytes or (
+                self.segment_seconds is not None and active.first is not None
+                and now - active.first >= self.segment_seconds):
+            active = self.roll()
+
+        data = pickle.dumps(value)
+        self.file.write(RECORD.pack(active.next, now, len(data)))
+        self.file.write(data)
+        self.dirty = True
+        if active.first is None:
+            active.first = now
+        active.last = now
+        active.size += RECORD.size + len(data)
+        active.next += 1
+        return active.next - 1
+
+    def roll(self) -> Segment:
+        """Start a new segment, and apply retention to the ones before it."""
+        self.file.close()
+        self.dirty = False
+        segment = Segment(self.path(self.next), self.next)
+        self.segments.append(segment)
+        self.file = open(segment.path, "ab")
+        self.clean()
+        return segment
+
+    def clean(self):
+        """Delete the oldest segments that are past retention, never the one written to."""
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            too_big = self.retention_bytes is not None and \
+                sum(segment.size for segment in self.segments) > self.retention_bytes
+            too_old = self.retention_seconds is not None and \
+                (oldest.last is None or self.clock() - oldest.last > self.retention_seconds)
+            if not (too_big or too_old):
+                break
+            os.remove(oldest.path)
+            del self.segments[0]
+
+    def read(self, offset=None, since=None) -> Iterator[Tuple[int, float, Any]]:
+        """(offset, timestamp, value) of the records from offset, or from timestamp since, on.
+
+        Starts at the oldest record kept if those are gone already.
+        """
+        self.flush()
+        start = 0
+        for i, segment in enumerate(self.segments):
+            if (offset is not None and segment.base <= offset) or \
+                    (since is not None and segment.first is not None and segment.first <= since):
+                start = i
+        for segment in self.segments[start:]:
+            for record_offset, timestamp, value, _ in segment.records():
+                if offset is not None and record_offset < offset: continue
+                if since is not None and timestamp < since: continue
+                yield record_offset, timestamp, pickle.loads(value)
+
+    def last(self):
+        """(offset, timestamp, value) of the newest record, None if there is none."""
+        return next(self.read(offset=self.next - 1), None) if self.next > 0 else None
+
+    def flush(self):
+        """Hand what was appended to the operating system."""
+        if self.dirty:
+            self.file.flush()
+            self.dirty = False
+
+    def close(self):
+        self.file.close()
+
+
+class MessageLog:
+    """Logs of every topic, each in a directory of its own under directory.
+
+    Written to through buffered files: flush makes what was appended
+    survive the broker going down (not the machine, there is no fsync).
+    """
+
+    def __init__(self, directory, segment_bytes=1 << 20, segment_seconds=None, retention_bytes=None,
+                 retention_seconds=None, clock=time.time):
+        """
+        Parameters:
+            directory: where the logs are, reopened if there already
+            segment_bytes: size a segment is closed at
+            segment_seconds: age of its first record a segment is closed at (None for any)
+            retention_bytes: most bytes kept per topic, in whole segments (None for no limit)
+            retention_seconds: age of its last record a segment is deleted at (None for never)
+            clock: time source in seconds since the epoch
+        """
+        self.directory = directory
+        self.options = (segment_bytes, segment_seconds, retention_bytes, retention_seconds, clock)
+        self.logs = {}              # {topic1: TopicLog1, ...}
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.startswith(PREFIX) and os.path.isdir(os.path.join(directory, name)):
+                self.logs[unquote(name[len(PREFIX):])] = TopicLog(os.path.join(directory, name), *self.options)
+
+    def topics(self) -> List[str]:
+        return list(self.logs)
+
+    def append(self, topic, value) -> int:
+        """Append value to the log of topic, returning its offset there."""
+        log = self.logs.get(topic)
+        if log is None:
+            log = self.logs[topic] = TopicLog(os.path.join(self.directory, PREFIX + quote(topic, safe="")),
+                                              *self.options)
+        return log.append(value)
+
+    def read(self, topic, offset=None, since=None) -> Iterator[Tuple[int, float, Any]]:
+        """(offset, timestamp, value) of the records of topic from offset, or timestamp since, on."""
+        if topic not in self.logs:
+            return iter(())
+        return self.logs[topic].read(offset, since)
+
+    def last(self, topic):
+        """(offset, timestamp, value) of the newest record of topic, None if there is none."""
+        return self.logs[topic].last() if topic in self.logs else None
+
+    def flush(self):
+        for log in self.logs.values():
+            log.flush()
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
@@ -0,0 +1,154 @@
+"""Tests the asyncio broker: per-subscriber queues and what happens when one fills up."""
+import socket
+import threading
+import time
+
+import pytest
+
+from src.async_broker import AsyncBroker, Overflow
+from src.protocol import HEADER, Connection, PubSubProtocol, Serializer
+
+VALUE = "x" * 30000     # big publishes fill socket buffers quickly
+
+
+@pytest.fixture()
+def start():
+    started = []
+
+    def start(**kwargs):
+        broker = AsyncBroker(port=0, **kwargs)     # a free port, see address()
+        thread = threading.Thread(target=broker.run, daemon=True)
+        thread.start()
+        started.append((broker, thread))
+        return broker
+
+    yield start
+    for broker, thread in started:
+        broker.canceled = True
+        thread.join(timeout=5)
+
+
+def connect(broker, topic=None, rcvbuf=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if rcvbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.connect(broker.broker.getsockname())
+    if topic is not None:
+        PubSubProtocol.sendMsg(sock, 0, PubSubProtocol.acknowledge(Serializer.JSON.value))
+        PubSubProtocol.sendMsg(sock, Serializer.JSON, PubSubProtocol.subscribe(topic))
+    return sock
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def receive(sock, count, received):
+    connection = Connection(sock)
+    for _ in range(count):
+        msg = connection.recv()
+        if msg is None:
+            return
+        received.append(msg)
+
+
+def test_delivery(start):
+    broker = start()
+    consumer = connect(broker, "/t")
+    wait_for(lambda: len(broker.list_subscriptions("/t")) == 1)
+    producer = connect(broker)
+    for i in range(3):
+        PubSubProtocol.sendMsg(producer, Serializer.PICKLE, PubSubProtocol.publish("/t", i))
+    received = []
+    receive(consumer, 3, received)
+    assert [msg.value for msg in received] == ["0", "1", "2"]
+    assert broker.get_topic("/t") == 2
+
+
+def test_slow_consumer_drops_oldest(start):
+    broker = start(queue_size=10, overflow=Overflow.DROP_OLDEST)
+    slow = connect(broker, "/t", rcvbuf=4096)     # never reads
+    fast = connect(broker, "/t")
+    wait_for(lambda: len(broker.list_subscriptions("/t")) == 2)
+    received = []
+    reader = threading.Thread(target=receive, args=(fast, 500, received))
+    reader.start()
+
+    producer = connect(broker)
+    for i in range(500):
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.publish("/t", VALUE))
+    reader.join(timeout=10)
+    # the fast one got everything, while the other one's queue overflowed
+    assert len(received) == 500
+    client = next(client for client in broker.clients if client.dropped)
+    assert client.queue.qsize() == 10
+    slow.close()
+
+
+def test_slow_consumer_disconnected(start):
+    broker = start(queue_size=10, overflow="disconnect")
+    slow = connect(broker, "/t", rcvbuf=4096)
+    wait_for(lambda: len(broker.list_subscriptions("/t")) == 1)
+    producer = connect(broker)
+    for i in range(500):
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.publish("/t", VALUE))
+    wait_for(lambda: broker.list_subscriptions("/t") == [])
+    # what reached the socket before it was closed, and then the end of the connection
+    received = []
+    receive(slow, 500, received)
+    assert 0 < len(received) < 500
+
+
+def test_producer_paused_and_resumed(start):
+    broker = start(queue_size=1, overflow=Overflow.BLOCK)
+    slow = connect(broker, "/t", rcvbuf=4096)
+    wait_for(lambda: len(broker.list_subscriptions("/t")) == 1)
+    producer = connect(broker)
+    signals = Connection(producer)
+    sender = threading.Thread(target=lambda: [
+        PubSubProtocol.sendMsg(producer, Serializer.XML, PubSubProtocol.publish("/t", VALUE)) for _ in range(200)])
+    sender.start()
+
+    msg = signals.recv()
+    assert (msg.type, msg.topic, msg.state) == ("Backpressure", "/t", "pause")
+    # nothing was lost: the consumer gets every publish, and the producer is let go
+    received = []
+    receive(slow, 200, received)
+    assert len(received) == 200
+    sender.join(timeout=10)
+    time.sleep(0.2)
+    states = [msg.state]
+    while signals.ready():
+        states.append(signals.recv().state)
+    assert states == ["pause", "resume"] * (len(states) // 2)
+
+
+def test_blocked_subscriber_gets_every_stored_value(start):
+    broker = start(queue_size=1, overflow=Overflow.BLOCK)
+    producer = connect(broker)
+    for i in range(50):
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.publish("/s/{}".format(i), VALUE))
+    wait_for(lambda: broker.get_topic("/s/49") == VALUE)
+
+    consumer = connect(broker, "/s", rcvbuf=4096)   # 50 values for a queue of 1
+    consumer.settimeout(5)
+    PubSubProtocol.sendMsg(consumer, Serializer.JSON, PubSubProtocol.topicListRequest())
+    received = []
+    receive(consumer, 51, received)
+    assert [msg.topic for msg in received[:50]] == ["/s/{}".format(i) for i in range(50)]
+    assert received[50].type == "TopicListReply"
+    assert all(client.dropped == 0 for client in broker.clients)
+
+
+def test_malformed_message_closes_client(start):
+    broker = start()
+    bad = connect(broker)
+    bad.sendall(HEADER.pack(Serializer.JSON.value, 9) + b"not json!")
+    bad.settimeout(5)
+    assert bad.recv(1) == b""
+    wait_for(lambda: not broker.clients)
+    good = connect(broker, "/t")
+    wait_for(lambda: len(broker.list_subscriptions("/t")) == 1)
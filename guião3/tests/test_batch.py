@@ -0,0 +1,71 @@
+"""Tests batched publishes and deliveries."""
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from src.broker import Broker
+from src.clients import Consumer, Producer
+from src.middleware import MiddlewareType, PickleQueue, XMLQueue
+from src.protocol import MAX_BODY, PubSubProtocol, Serializer
+
+TOPIC = "/batch"
+
+
+def test_coalesce():
+    publish = PubSubProtocol.publish
+    messages = [publish("/a", 1), publish("/a", 2), publish("/b", 3), PubSubProtocol.subscribe("/a"),
+                publish("/a", 4), publish("/a", 5), publish("/a", 6)]
+    coalesced = Broker.coalesce(messages)
+    assert [msg.type for msg in coalesced] == ["PublishBatch", "Publish", "Subscribe", "PublishBatch"]
+    assert coalesced[0].values == [1, 2] and coalesced[3].values == [4, 5, 6]
+
+
+def test_batch_split_in_frames():
+    values = ["x" * 1000] * 200
+    frames = PubSubProtocol.frames(Serializer.JSON, PubSubProtocol.publishBatch(TOPIC, values))
+    assert len(frames) > 1 and all(len(body) <= MAX_BODY for _, body in frames)
+    assert sum(len(PubSubProtocol.decode(0, body).values) for _, body in frames) == 200
+
+
+def test_batched_producer_to_consumers(broker):
+    consumers = [Consumer(TOPIC, PickleQueue), Consumer(TOPIC, XMLQueue)]
+    threads = [threading.Thread(target=consumer.run, args=(25,), daemon=True) for consumer in consumers]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+
+    producer = Producer(TOPIC, lambda: iter([len(producer.produced)]), PickleQueue, batch_size=10, linger=0.05)
+    producer.run(25)        # two full batches, the last 5 sent when the linger is up
+    for thread in threads:
+        thread.join(timeout=2)
+    assert consumers[0].received == list(range(25))
+    assert consumers[1].received == list(range(25))
+    assert broker.get_topic(TOPIC) == 24
+
+
+def test_batch_needs_a_linger(broker):
+    with pytest.raises(ValueError):
+        PickleQueue(TOPIC, MiddlewareType.PRODUCER, batch_size=10, linger=0)
+
+
+def test_close_sends_the_batch(broker):
+    queue = PickleQueue("/batch/closed", MiddlewareType.PRODUCER, batch_size=10, linger=60)
+    for i in range(3):
+        queue.push(i)
+    queue.close()           # long before the linger is up
+    deadline = time.time() + 2
+    while broker.get_topic("/batch/closed") is None and time.time() < deadline:
+        time.sleep(0.01)
+    assert broker.get_topic("/batch/closed") == 2
+
+
+def test_backpressure_checked_once_a_batch(broker):
+    queue = PickleQueue("/batch/flow", MiddlewareType.PRODUCER, batch_size=10, linger=60)
+    with patch.object(queue, "flow", wraps=queue.flow) as flow:
+        for i in range(25):
+            queue.push(i)
+        assert flow.call_count == 2
+        queue.close()
+        assert flow.call_count == 3
@@ -0,0 +1,83 @@
+"""Tests the binary serializer: the MessagePack encoding, messages in it, and a BinaryQueue end to end."""
+import struct
+import threading
+import time
+
+import pytest
+
+from src import binary
+from src.broker import Serializer
+from src.clients import Consumer, Producer
+from src.middleware import BinaryQueue, JSONQueue
+from src.protocol import PubSubProtocol, PubSubProtocolBadFormat
+
+VALUES = [None, True, False, 0, 127, 128, 65535, 65536, 2**32, 2**64 - 1, -1, -32, -33, -129, -2**63, 1.5,
+          "", "a" * 31, "é" * 20, "b" * 300, "c" * 70000, b"\x00\xff", [], list(range(20)),
+          {"k": [1, {"n": None}]}, {str(i): i for i in range(20)}]
+
+
+@pytest.mark.parametrize("value", VALUES)
+def test_round_trip(value):
+    assert binary.unpackb(binary.packb(value)) == value
+
+
+def test_msgpack_format():
+    assert binary.packb([1, "ab", None, -1]) == b"\x94\x01\xa2ab\xc0\xff"
+    assert binary.packb({"a": 1.0}) == b"\x81\xa1a\xcb" + struct.pack(">d", 1.0)
+    assert binary.packb(300) == b"\xcd\x01\x2c" and binary.packb(-100) == b"\xd0\x9c"
+
+
+def test_rejected():
+    with pytest.raises(TypeError):
+        binary.packb(object())
+    with pytest.raises(ValueError):
+        binary.unpackb(b"\x01\x02")             # something after the value
+    with pytest.raises(PubSubProtocolBadFormat):
+        PubSubProtocol.decode(3, b"\xc1")       # never used in MessagePack
+
+
+@pytest.mark.parametrize("data", [
+    b"", b"\x92\x01", b"\x91\xa5ab", b"\x91\xcd\x01", b"\xcd\x01", b"\xda\x01", b"\xdd\xff\xff\xff\xff\x01",
+    b"\x81\x91\x01\x02", b"\x91" * 5000 + b"\xc0", b"\x81\xa1k" * 5000 + b"\xc0"])
+def test_malformed(data):
+    with pytest.raises(ValueError):
+        binary.unpackb(data)
+    with pytest.raises(PubSubProtocolBadFormat):
+        PubSubProtocol.decode(3, data)
+
+
+def test_nesting_limit():
+    deep = None
+    for _ in range(binary.MAX_DEPTH):
+        deep = [deep]
+    assert binary.unpackb(binary.packb(deep)) == deep
+    with pytest.raises(ValueError):
+        binary.unpackb(binary.packb([deep]))
+
+
+def test_messages():
+    publish = PubSubProtocol.publish
+    messages = [PubSubProtocol.subscribe("/a", 3), publish("/a", 1.5, 2), PubSubProtocol.topicListRequest(),
+                PubSubProtocol.topicListReply(["/a", "/b"]), PubSubProtocol.cancelSubscription("/a"),
+                PubSubProtocol.acknowledge(3), PubSubProtocol.publishBatch("/a", [1, "x", None]),
+                PubSubProtocol.backpressure("/a", "pause")]
+    for msg in messages:
+        body = PubSubProtocol.encode(Serializer.BINARY.value, msg)
+        assert vars(PubSubProtocol.decode(Serializer.BINARY.value, body)) == vars(msg)
+        assert len(body) < len(PubSubProtocol.encode(Serializer.JSON.value, msg))
+    batch = PubSubProtocol.deliverBatch([publish("/a", -70000, 1), publish("/b", "é", None)])
+    decoded = PubSubProtocol.decode(3, PubSubProtocol.encode(3, batch))
+    assert [vars(msg) for msg in decoded.messages] == [vars(msg) for msg in batch.messages]
+
+
+def test_binary_queue(broker):
+    consumer = Consumer("/binary", BinaryQueue)
+    thread = threading.Thread(target=consumer.run, args=(5,), daemon=True)
+    thread.start()
+    time.sleep(0.1)
+    assert broker.list_subscriptions("/binary")[0][1] == Serializer.BINARY
+
+    producer = Producer("/binary", lambda: iter([len(producer.produced)]), JSONQueue)
+    producer.run(5)         # published in JSON, delivered in binary
+    thread.join(timeout=2)
+    assert consumer.received == [0, 1, 2, 3, 4]
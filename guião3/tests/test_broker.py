@@ -1,9 +1,13 @@
 """Test simple consumer/producer interaction."""
+import socket
+import time
 from unittest.mock import MagicMock, patch
 
 import pytest
 
 from src.broker import Serializer
+from src import protocol
+from src.protocol import HEADER, Connection, PubSubProtocol
 
 
 def test_subscriptions(broker):
@@ -38,3 +42,44 @@ def test_topics(broker):
     assert len(broker.list_topics()) >= 2  # t3, t4 and the topic from basic
     assert "/t3" in broker.list_topics()
     assert "/t4" in broker.list_topics()
+
+
+def test_unexpected_and_malformed_messages(broker):
+    client = Connection(socket.create_connection(("localhost", 5000)))
+    client.sock.settimeout(5)
+    pickle = protocol.Serializer.PICKLE
+    client.send(pickle, PubSubProtocol.acknowledge(pickle.value))
+    # only the broker sends these: ignored
+    client.send(pickle, PubSubProtocol.backpressure("/t5", "pause"))
+    client.send(pickle, PubSubProtocol.deliverBatch([PubSubProtocol.publish("/t5", 1)]))
+    client.send(pickle, PubSubProtocol.topicListReply(["/t5"]))
+    client.send(pickle, PubSubProtocol.topicListRequest())
+    assert client.recv().type == "TopicListReply"
+
+    for body in (b"{{{", b'{"topic": "/t5"}'):     # not JSON, no type: the connection is closed
+        bad = socket.create_connection(("localhost", 5000))
+        bad.settimeout(5)
+        bad.sendall(HEADER.pack(0, len(body)) + body)
+        assert bad.recv(1) == b""
+        bad.close()
+
+    client.send(pickle, PubSubProtocol.topicListRequest())
+    assert client.recv().type == "TopicListReply"
+    client.sock.close()
+
+
+def test_disconnect_forgets_serializer(broker):
+    client = Connection(socket.create_connection(("localhost", 5000)))
+    client.sock.settimeout(5)
+    pickle = protocol.Serializer.PICKLE
+    client.send(pickle, PubSubProtocol.acknowledge(pickle.value))
+    client.send(pickle, PubSubProtocol.topicListRequest())
+    client.recv()
+    conn, = [conn for conn in list(broker.connections) if conn.getpeername() == client.sock.getsockname()]
+    assert conn in broker.serialTypes
+
+    client.sock.close()
+    deadline = time.time() + 5
+    while conn in broker.connections and time.time() < deadline:
+        time.sleep(0.01)
+    assert conn not in broker.connections and conn not in broker.serialTypes
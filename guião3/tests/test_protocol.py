@@ -0,0 +1,72 @@
+"""Test message framing: one write per frame, buffered reads of whole frames."""
+import socket
+import threading
+
+import pytest
+
+from src.protocol import Connection, PubSubProtocol, Serializer
+
+
+@pytest.fixture
+def pair():
+    left, right = socket.socketpair()
+    yield left, right
+    left.close()
+    right.close()
+
+
+def test_pipelined_messages_in_one_read(pair):
+    left, right = pair
+    for serializer in Serializer:
+        PubSubProtocol.sendMsg(left, serializer, PubSubProtocol.publish("/t", serializer.value))
+    PubSubProtocol.sendMsg(left, Serializer.JSON, PubSubProtocol.subscribe("/t"))
+
+    connection = Connection(right)
+    assert connection.fill()
+    received = connection.messages()
+    assert [(msg.type, msg.topic) for msg in received] == [("Publish", "/t")] * 4 + [("Subscribe", "/t")]
+    assert [str(msg.value) for msg in received[:4]] == ["0", "1", "2", "3"]
+
+
+def test_message_split_across_reads(pair):
+    left, right = pair
+    body = PubSubProtocol.encode(0, PubSubProtocol.publish("/t", "x" * 60000))
+    frame = bytes([0]) + len(body).to_bytes(2, "big") + body
+
+    connection = Connection(right, size=len(frame) + 10)
+    left.sendall(frame[:2])
+    connection.fill()
+    assert connection.messages() == []
+    # the rest of it and the next one, more than the buffer holds
+    sender = threading.Thread(target=left.sendall, args=(frame[2:] + frame,))
+    sender.start()
+    received = []
+    while len(received) < 2:
+        assert connection.fill()
+        received += connection.messages()
+    sender.join()
+    assert [msg.value for msg in received] == ["x" * 60000] * 2
+
+
+def test_blocking_recv(pair):
+    left, right = pair
+    PubSubProtocol.sendMsg(left, Serializer.PICKLE, PubSubProtocol.publish("/t", 1))
+    PubSubProtocol.sendMsg(left, Serializer.XML, PubSubProtocol.cancelSubscription("/t"))
+    left.close()
+
+    connection = Connection(right)
+    assert connection.recv().value == 1
+    assert connection.recv().type == "CancelSubscription"
+    assert connection.recv() is None
+
+
+def test_recv_msg_without_buffer(pair):
+    left, right = pair
+    PubSubProtocol.sendMsg(left, Serializer.JSON, PubSubProtocol.publish("/t", "y" * 50000))
+    assert PubSubProtocol.recvMsg(right).value == "y" * 50000
+
+
+def test_too_large(pair):
+    left, _ = pair
+    with pytest.raises(ValueError):
+        PubSubProtocol.sendMsg(left, Serializer.PICKLE, PubSubProtocol.publish("/t", "z" * 70000))
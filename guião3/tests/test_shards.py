@@ -0,0 +1,115 @@
+"""Tests the sharded broker: topics split by root across worker processes, clients handed over."""
+import socket
+import threading
+import time
+
+import pytest
+
+from src.protocol import Connection, PubSubProtocol, Serializer
+from src.shards import ShardedBroker, root_topic, shard_of, spans_shards
+
+TOPICS = ["/a/x", "/b", "/c/y", "/d"]       # in shards 2, 1, 0 and 1 of 3
+
+
+@pytest.fixture(scope="module")
+def sharded():
+    broker = ShardedBroker(port=0, shards=3)
+    thread = threading.Thread(target=broker.run, daemon=True)
+    thread.start()
+    yield broker
+    broker.canceled = True
+    thread.join(timeout=10)
+
+
+def connect(sharded):
+    return socket.create_connection(sharded.broker.getsockname())
+
+
+def test_shard_of():
+    assert root_topic("/weather/humidity") == root_topic("/weather") == "weather"
+    assert shard_of("/weather/humidity", 4) == shard_of("/weather/pressure", 4)
+    assert [shard_of(topic, 3) for topic in TOPICS] == [2, 1, 0, 1]
+    assert {shard_of("/{}".format(i), 4) for i in range(100)} == {0, 1, 2, 3}
+    assert spans_shards("#") and spans_shards("/+/temperature") and not spans_shards("/weather/+")
+
+
+def test_published_across_shards(sharded):
+    consumers = []
+    for topic in TOPICS:
+        sock = connect(sharded)
+        PubSubProtocol.sendMsg(sock, Serializer.PICKLE, PubSubProtocol.acknowledge(Serializer.PICKLE.value))
+        PubSubProtocol.sendMsg(sock, Serializer.PICKLE, PubSubProtocol.subscribe(topic))
+        consumers.append(Connection(sock))
+    time.sleep(0.5)     # subscribed once the workers read it
+
+    for i, topic in enumerate(TOPICS):
+        PubSubProtocol.sendMsg(connect(sharded), Serializer.JSON, PubSubProtocol.publish(topic, i))
+    for i, (topic, consumer) in enumerate(zip(TOPICS, consumers)):
+        received = consumer.recv()
+        assert (received.topic, received.value) == (topic, str(i))   # published in JSON
+
+    # every shard knows every topic, and so does the front
+    time.sleep(0.2)
+    assert sorted(sharded.list_topics()) == sorted(TOPICS)
+    PubSubProtocol.sendMsg(consumers[0].sock, Serializer.PICKLE, PubSubProtocol.topicListRequest())
+    assert sorted(consumers[0].recv().lst) == sorted(TOPICS)
+    producer = Connection(connect(sharded))
+    producer.send(Serializer.PICKLE, PubSubProtocol.topicListRequest())
+    assert sorted(producer.recv().lst) == sorted(TOPICS)
+
+
+def test_wildcard_subscription_across_shards(sharded):
+    consumer = Connection(connect(sharded))
+    consumer.sock.settimeout(5)
+    consumer.send(Serializer.PICKLE, PubSubProtocol.acknowledge(Serializer.PICKLE.value))
+    consumer.send(Serializer.PICKLE, PubSubProtocol.subscribe("/+/w"))
+    time.sleep(0.5)
+
+    for topic in ["/a/w", "/b/w", "/c/w", "/a/v"]:     # roots in shards 2, 1 and 0
+        PubSubProtocol.sendMsg(connect(sharded), Serializer.JSON, PubSubProtocol.publish(topic, topic))
+    consumer.send(Serializer.PICKLE, PubSubProtocol.publish("/d/w", "own"))   # goes on to the shard of /d
+    received = {consumer.recv().topic for _ in range(4)}
+    assert received == {"/a/w", "/b/w", "/c/w", "/d/w"}
+    consumer.sock.close()
+
+
+def test_pipelined_before_and_after_the_topic(sharded):
+    frames = [PubSubProtocol.frame(Serializer.PICKLE, PubSubProtocol.acknowledge(Serializer.PICKLE.value))] * 5000
+    frames.append(PubSubProtocol.frame(Serializer.PICKLE, PubSubProtocol.subscribe("/e")))
+    values = ["{}".format(i) * 20000 for i in range(6)]     # more than the front reads at once
+    frames += [PubSubProtocol.frame(Serializer.PICKLE, PubSubProtocol.publish("/e", value)) for value in values]
+    consumer = Connection(connect(sharded))
+    consumer.sock.settimeout(5)
+    consumer.sock.sendall(b"".join(part for frame in frames for part in frame))
+
+    received = []
+    while len(received) < len(values):
+        msg = consumer.recv()       # runs read at once come as a batch
+        received += [m.value for m in msg.messages] if msg.type == "DeliverBatch" else [msg.value]
+    assert received == values
+    consumer.sock.close()
+
+
+def test_slow_wildcard_client_holds_up_nobody(sharded):
+    slow = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    slow.connect(sharded.broker.getsockname())
+    PubSubProtocol.sendMsg(slow, Serializer.PICKLE, PubSubProtocol.acknowledge(Serializer.PICKLE.value))
+    PubSubProtocol.sendMsg(slow, Serializer.PICKLE, PubSubProtocol.subscribe("/+/slow"))
+    time.sleep(0.5)
+
+    producer = connect(sharded)
+    producer.settimeout(10)
+    for _ in range(200):    # some 12 MB the slow client never reads
+        PubSubProtocol.sendMsg(producer, Serializer.PICKLE, PubSubProtocol.publish("/f/slow", "x" * 60000))
+    # the front still answers others
+    other = Connection(connect(sharded))
+    other.sock.settimeout(5)
+    other.send(Serializer.PICKLE, PubSubProtocol.topicListRequest())
+    assert "/f/slow" in other.recv().lst
+
+    # and the slow client was dropped, once too much waited for it
+    slow.settimeout(5)
+    while slow.recv(1 << 16):
+        pass
+    producer.close()
@@ -0,0 +1,109 @@
+"""Tests the durable topic log: segments, retention, and replaying it to subscribers."""
+import os
+import socket
+import threading
+import time
+
+from src.broker import Broker
+from src.protocol import Connection, PubSubProtocol, Serializer
+from src.topiclog import RECORD, MessageLog
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_segments_and_recovery(tmp_path):
+    log = MessageLog(str(tmp_path), segment_bytes=100)
+    offsets = [log.append("/a", "value{}".format(i)) for i in range(10)]
+    assert offsets == list(range(10))
+    assert [value for _, _, value in log.read("/a", offset=7)] == ["value7", "value8", "value9"]
+    segments = sorted(os.listdir(tmp_path / "topic-%2Fa"))
+    assert len(segments) > 2 and segments[0] == "{:020d}.log".format(0)
+    log.close()
+
+    # a record only partly written is dropped, and its offset given again
+    last = tmp_path / "topic-%2Fa" / segments[-1]
+    with open(last, "ab") as file:
+        file.write(RECORD.pack(10, 0, 50) + b"cut")
+    log = MessageLog(str(tmp_path), segment_bytes=100)
+    assert log.last("/a")[::2] == (9, "value9")
+    assert log.append("/a", "again") == 10
+    assert [offset for offset, _, _ in log.read("/a")] == list(range(11))
+
+
+def test_retention(tmp_path):
+    clock = Clock()
+    log = MessageLog(str(tmp_path), segment_bytes=100, retention_seconds=60, clock=clock)
+    for i in range(10):
+        log.append("/a", i)
+        clock.now += 10
+    assert [value for _, _, value in log.read("/a", since=1045)] == [5, 6, 7, 8, 9]
+    # the segments with nothing newer than 60 seconds are gone once a segment is closed
+    clock.now += 100
+    for i in range(10, 20):
+        log.append("/a", i)
+    offsets = [offset for offset, _, _ in log.read("/a")]
+    assert 0 < offsets[0] <= 10 and offsets[-1] == 19     # the segment 10 went to may hold older ones
+    # asking for an offset no longer kept starts at the oldest there is
+    assert next(log.read("/a", offset=0))[0] == offsets[0]
+
+    log = MessageLog(str(tmp_path / "sized"), segment_bytes=100, retention_bytes=300)
+    for i in range(100):
+        log.append("/b", i)
+    assert sum(os.path.getsize(tmp_path / "sized" / "topic-%2Fb" / name)
+               for name in os.listdir(tmp_path / "sized" / "topic-%2Fb")) <= 300 + 100
+
+
+def test_topic_names_stay_inside(tmp_path):
+    log = MessageLog(str(tmp_path / "log"))
+    for topic in ["..", ".", "", "/a/../.."]:
+        log.append(topic, topic)
+    log.flush()
+    (tmp_path / "log" / "stray").write_bytes(b"")     # not a topic's directory
+    assert os.listdir(tmp_path) == ["log"]
+
+    log = MessageLog(str(tmp_path / "log"))
+    assert sorted(log.topics()) == ["", ".", "..", "/a/../.."]
+    assert [value for _, _, value in log.read("..")] == [".."]
+
+
+def test_replay_to_subscriber(tmp_path):
+    broker = Broker(port=0, log=MessageLog(str(tmp_path)))
+    thread = threading.Thread(target=broker.run, daemon=True)
+    thread.start()
+    producer = socket.create_connection(broker.broker.getsockname())
+    for i in range(5):
+        PubSubProtocol.sendMsg(producer, Serializer.PICKLE, PubSubProtocol.publish("/t/x", i))
+        PubSubProtocol.sendMsg(producer, Serializer.PICKLE, PubSubProtocol.publish("/t/x/y", -i))
+    PubSubProtocol.sendMsg(producer, Serializer.PICKLE, PubSubProtocol.publish("/u", "other"))
+    deadline = time.time() + 5
+    while broker.get_topic("/u") is None and time.time() < deadline:    # every publish read
+        time.sleep(0.01)
+
+    consumer = Connection(socket.create_connection(broker.broker.getsockname()))
+    consumer.sock.settimeout(5)
+    consumer.send(Serializer.PICKLE, PubSubProtocol.acknowledge(Serializer.PICKLE.value))
+    consumer.send(Serializer.PICKLE, PubSubProtocol.subscribe("/t/x", offset=3))
+    marker = consumer.recv()
+    assert (marker.type, marker.topic, marker.offset) == ("Subscribe", "/t/x", 3)
+    # the offset is in the log of /t/x alone, not of its subtopic /t/x/y
+    replayed = [consumer.recv() for _ in range(2)]
+    assert [(msg.topic, msg.value, msg.offset) for msg in replayed] == [("/t/x", 3, 3), ("/t/x", 4, 4)]
+    # and then what is published from now on, numbered on
+    PubSubProtocol.sendMsg(producer, Serializer.PICKLE, PubSubProtocol.publish("/t/x", 5))
+    live = consumer.recv()
+    assert (live.topic, live.value, live.offset) == ("/t/x", 5, 5)
+    broker.canceled = True
+    producer.close()        # wakes the broker up to see it
+    thread.join(timeout=5)
+    broker.broker.close()
+
+    # restarted on the same log, the last values are back
+    broker = Broker(port=0, log=MessageLog(str(tmp_path)))
+    assert broker.get_topic("/t/x") == 5 and broker.get_topic("/u") == "other"
+    broker.broker.close()
@@ -0,0 +1,100 @@
+"""Test the topic trie: subtopics, wildcards and unsubscribing."""
+from unittest.mock import MagicMock
+
+from src.broker import Serializer, TopicTrie
+
+
+def test_subtopics():
+    trie = TopicTrie()
+    trie.add("/weather", "a")
+    trie.add("/weather/temperature", "b")
+    trie.add("/weather/temperature", "a")  # already covered, delivered once
+
+    assert trie.match("/weather/temperature/celsius") == ["a", "b"]
+    assert trie.match("/weather") == ["a"]
+    assert trie.match("/weatherman") == []
+
+
+def test_wildcards():
+    trie = TopicTrie()
+    trie.add("/+/temperature", "plus")
+    trie.add("/weather/#", "hash")
+    trie.add("#", "all")
+
+    assert set(trie.match("/weather/temperature")) == {"all", "plus", "hash"}
+    assert set(trie.match("/house/temperature/celsius")) == {"all", "plus"}
+    assert trie.match("/house/humidity") == ["all"]
+    assert set(trie.match("/weather")) == {"all", "hash"}
+
+    assert TopicTrie.matches("/+/temperature", "/house/temperature")
+    assert TopicTrie.matches("/+/temperature", "/house/temperature/celsius")
+    assert not TopicTrie.matches("/+/temperature", "/house/humidity")
+    assert TopicTrie.matches("/weather/#", "/weather")
+    assert not TopicTrie.matches("/weather/+", "/weather")
+
+
+def test_match_agrees_with_matches():
+    patterns = ["/a", "/a/b", "/+", "/+/b", "/a/+", "/+/+", "/#", "/a/#", "/+/b/#", "#", "/ab"]
+    topics = ["/a", "/b", "/ab", "/a/b", "/a/c", "/c/b", "/a/b/c", "/a/b/c/d", "/b/b/b"]
+    trie = TopicTrie()
+    for pattern in patterns:
+        trie.add(pattern, pattern)
+    for topic in topics:
+        assert set(trie.match(topic)) == {pattern for pattern in patterns if TopicTrie.matches(pattern, topic)}, topic
+
+
+def test_remove_prunes():
+    trie = TopicTrie()
+    trie.add("/a/b/c", "x")
+    trie.add("/a", "y")
+    trie.remove("/a/b/c", "x")
+    trie.remove("/a/b", "x")  # never subscribed
+
+    assert trie.match("/a/b/c") == ["y"]
+    assert list(trie.root.children[""].children["a"].children) == []
+
+
+def test_unsubscribe_is_per_segment(broker):
+    temp, temperature = MagicMock(), MagicMock()
+    broker.subscribe("/sensors/temp", temp, Serializer.JSON)
+    broker.subscribe("/sensors/temp/max", temp, Serializer.JSON)
+    broker.subscribe("/sensors/temperature", temperature, Serializer.JSON)
+    broker.subscribe("/sensors/temperature", temp, Serializer.JSON)
+
+    broker.unsubscribe("/sensors/temp", temp)
+
+    assert broker.list_subscriptions("/sensors/temp/max") == []
+    assert broker.list_subscriptions("/sensors/temperature") == [
+        (temperature, Serializer.JSON), (temp, Serializer.JSON)]
+
+    broker.unsubscribe("", temp)
+    assert broker.list_subscriptions("/sensors/temperature") == [(temperature, Serializer.JSON)]
+    assert temp not in broker.subscribed
+
+
+def test_wildcard_subscription_gets_stored_messages(broker):
+    consumer = MagicMock()
+    consumer.sendmsg.side_effect = lambda buffers: sum(map(len, buffers))
+    broker.put_topic("/rooms/kitchen/light", "on")
+    broker.put_topic("/rooms/hall/light", "off")
+    broker.put_topic("/rooms/hall/door", "open")
+
+    broker.subscribe("/rooms/+/light", consumer, Serializer.JSON)
+
+    sent = b"".join(b"".join(call[0][0]) for call in consumer.sendmsg.call_args_list)
+    assert b"kitchen" in sent and b"/rooms/hall/light" in sent and b"door" not in sent
+    assert broker.list_subscriptions("/rooms/hall/light") == [(consumer, Serializer.JSON)]
+
+
+def test_subscription_gets_stored_messages_of_subtopics(broker):
+    consumer = MagicMock()
+    consumer.sendmsg.side_effect = lambda buffers: sum(map(len, buffers))
+    broker.put_topic("/floors/first/lamp", "on")
+    broker.put_topic("/floors/second/lamp/bulb", "off")
+    broker.put_topic("/floorplan", "draft")
+
+    broker.subscribe("/floors/+", consumer, Serializer.JSON)  # publishes on both lamps would reach it
+
+    sent = b"".join(b"".join(call[0][0]) for call in consumer.sendmsg.call_args_list)
+    assert b"/floors/first/lamp" in sent and b"/floors/second/lamp/bulb" in sent and b"draft" not in sent
+    assert broker.list_subscriptions("/floors/second/lamp/bulb") == [(consumer, Serializer.JSON)]
@@ -20,10 +20,11 @@ def test_simple_producer_JSON(broker):
 
     producer = Producer(TOPIC, gen, JSONQueue)
 
-    with patch("socket.socket.send", MagicMock()) as send:
+    # a whole frame goes out in one scatter-gather write
+    with patch("socket.socket.sendmsg", MagicMock(side_effect=lambda buffers: sum(map(len, buffers)))) as send:
         producer.run(1)
 
-        data_sent = send.call_args[0][0]
+        data_sent = b"".join(send.call_args[0][0])
 
         assert b"{" in data_sent
         assert b"}" in data_sent
@@ -37,10 +38,11 @@ def test_simple_producer_XML(broker):
 
     producer = Producer(TOPIC, gen, XMLQueue)
 
-    with patch("socket.socket.send", MagicMock()) as send:
+    # a whole frame goes out in one scatter-gather write
+    with patch("socket.socket.sendmsg", MagicMock(side_effect=lambda buffers: sum(map(len, buffers)))) as send:
         producer.run(1)
 
-        data_sent = send.call_args[0][0]
+        data_sent = b"".join(send.call_args[0][0])
 
         assert b"<" in data_sent
         assert b">" in data_sent